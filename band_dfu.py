@@ -1,158 +1,169 @@
 #!/usr/bin/env python
 
 import argparse
+import fnmatch
 import logging as log
-import sha
-import struct
 import sys
-import time
 
+import hello.dfu
 import hello.pybt as pybt
-
-uuid_dfu_service = '00001530-1212-EFDE-1523-785FEABCD123'
-uuid_dfu_control_state_characteristic = '00001531-1212-EFDE-1523-785FEABCD123'
-uuid_dfu_packet_characteristic = '00001532-1212-EFDE-1523-785FEABCD123'
+import hello.pybt.pacing as pacing
+from hello.dfu import PACKET_SIZE
+from hello.dfu.checkpoint import Checkpoint
+from hello.dfu.fleet import Fleet, FIND_TIMEOUT
+from hello.dfu.image import FirmwareImage
 
 log.basicConfig(level=log.DEBUG)
 
 #
 
-PACKET_SIZE = 20
-
-class OpCodes(object):
-    START_DFU = 1
-    INITIALIZE_DFU = 2
-    RECEIVE_FIRMWARE_IMAGE = 3
-    VALIDATE_FIRMWARE_IMAGE = 4
-    ACTIVATE_FIRMWARE_AND_RESET = 5
-    SYSTEM_RESET = 6
-    REQ_PKT_RCPT_NOTIF = 8
-    RESPONSE = 16
-    PKT_RCPT_NOTIF = 17
-
-op_codes = dict(zip(OpCodes.__dict__.values(), OpCodes.__dict__.keys()))
-
-status_code_lookup = {
-    1: "SUCCESS",
-    2: "Invalid State",
-    3: "Not Supported",
-    4: "Data Size Exceeds Limit",
-    5: "CRC Error",
-    6: "Operation Failed"
-}
-
-def uint32_bytearray(value):
-    return bytearray(struct.pack('<I', value))
-
-def uint16_bytearray(value):
-    return bytearray(struct.pack('<H', value))
-
-def validate_dfu_response(data):
-    op_code = data[0]
-
-    if op_code == OpCodes.PKT_RCPT_NOTIF:
-        print('Received PKT_RCPT_NOTIF for %d bytes' % struct.unpack('<H', str(data[0:2])))
-    elif op_code == OpCodes.RESPONSE:
-        request_op_code = int(data[1])
-        request_op_code_text = op_codes.get(request_op_code, '(unknown op code)')
-
-        response_value = int(data[2])
-        response_text = status_code_lookup.get(response_value, '(unknown response value)')
-
-        print('Received response OpCode %s (%d): %s (%d)' % (
-            request_op_code_text,
-            request_op_code,
-            response_text,
-            response_value))
-    else:
-        dataText = ''
-        for c in data:
-            dataText += '%x' % ord(c)
-        print('Received unknown response (%s): %s' % (type(data), dataText))
+def is_pattern(name):
+    return any(c in name for c in '*?[')
+
+def find_band_names(patterns, timeout):
+    """Expands shell-style patterns like 'Band*' against the names of
+    peripherals seen within timeout seconds; names without wildcards are
+    kept as they are."""
+
+    if not any(is_pattern(pattern) for pattern in patterns):
+        return patterns
+
+    seen = [peripheral.name() for peripheral in pybt.find_all_peripherals(timeout=timeout)]
+
+    names = []
+    for pattern in patterns:
+        matches = fnmatch.filter(seen, pattern) if is_pattern(pattern) else [pattern]
+        if not matches:
+            print >> sys.stderr, "no Band matching %s" % pattern
+        names += [name for name in matches if name not in names]
+    return names
 
 def main(argv):
     arg_parser = argparse.ArgumentParser(description='Send firmware to Band.')
     arg_parser.add_argument(
-        'band_name',
-        help='name of the Band, e.g. Band, Andre')
+        'band_names',
+        nargs='+',
+        metavar='band_name',
+        help='name of the Band, e.g. Band, Andre. Give several names, or a pattern such as "Band*", to update many Bands at once')
     arg_parser.add_argument(
         'firmware_path',
         help='path to firmware .bin file')
     arg_parser.add_argument(
         '-w', '--wait',
         dest='packet_notification_count',
-        help='wait for acknowledgement from Band when sending data after PACKET_NOTIFICATION_COUNT packets (where one packet is %d bytes)' % PACKET_SIZE,
+        help='ask the Band to acknowledge every PACKET_NOTIFICATION_COUNT packets (where one packet is PACKET_SIZE bytes, %d by default), and keep a window of unacknowledged packets in flight' % PACKET_SIZE,
         type=int,
         default=0)
+    arg_parser.add_argument(
+        '--window',
+        help='initial number of unacknowledged packets in flight when using --wait; defaults to twice PACKET_NOTIFICATION_COUNT',
+        type=int,
+        default=None)
+    arg_parser.add_argument(
+        '--packet-size',
+        help='send packets of PACKET_SIZE bytes, or with "mtu", as large as the link allows. Defaults to %d, which the Nordic legacy bootloader was written for; only use more with a bootloader known to take them' % PACKET_SIZE,
+        type=hello.dfu.packet_size_argument,
+        default=None)
+    arg_parser.add_argument(
+        '-r', '--resume',
+        action='store_true',
+        help='resume an interrupted transfer of the same firmware from its checkpoint, if the Band still has the data. Otherwise, start over.')
+    arg_parser.add_argument(
+        '--checkpoint',
+        dest='checkpoint_path',
+        help='where to save transfer progress. Defaults to FIRMWARE_PATH.BAND_NAME.checkpoint. Only for a single Band',
+        default=None)
+    arg_parser.add_argument(
+        '-j', '--jobs',
+        help='number of Bands to update at the same time. Defaults to 4',
+        type=int,
+        default=4)
+    arg_parser.add_argument(
+        '--retries',
+        help='number of times to retry a Band that fails, resuming where possible. Defaults to 0',
+        type=int,
+        default=0)
+    arg_parser.add_argument(
+        '--rate',
+        help='send at most RATE packets a second; by default packets go as fast as the Bluetooth stack is ready for them',
+        type=float,
+        default=None)
+    arg_parser.add_argument(
+        '--scan-time',
+        help='seconds to scan for Bands matching a pattern. Defaults to 5',
+        type=int,
+        default=5)
     args = arg_parser.parse_args(argv[1:])
 
-    firmware_data = bytearray(open(args.firmware_path, 'rb').read())
+    firmware_image = FirmwareImage(args.firmware_path)
 
-    firmware_size = len(firmware_data)
+    firmware_size = len(firmware_image)
     print "firmware is %d bytes" % firmware_size
+    print "firmware SHA1 is %s" % firmware_image.sha1.hexdigest()
 
-    sha_object = sha.new(firmware_data)
-    firmware_sha1 = sha_object.digest()
-    print "firmware SHA1 is %s" % sha_object.hexdigest() 
-
-    pybt.start_scan()
-
-    packet_notification_count = args.packet_notification_count
-
-    # need to implement data_received_handler
-
-    peripheral = pybt.find_peripheral_by_name(args.band_name)
-    print peripheral
-
-    dfu = peripheral[uuid_dfu_service]
-    print dfu.UUID()
-    dfu_control_point = dfu[uuid_dfu_control_state_characteristic]
-    print dfu_control_point.UUID()
-    dfu_packet = dfu[uuid_dfu_packet_characteristic]
-    print dfu_packet.UUID()
-    
-    control_point_subscription = dfu_control_point.subscribe()
-
-    did_write = dfu_control_point.write_confirm(bytearray([OpCodes.START_DFU]))
-    print "wrote START_DFU: %d" % did_write
-    dfu_packet.write_no_confirm(uint32_bytearray(firmware_size))
-    print "wrote firmware_size=%d" % firmware_size
-    validate_dfu_response(control_point_subscription.read())
+    def checkpoint_path(band_name):
+        return '%s.%s.checkpoint' % (args.firmware_path, band_name)
 
-    did_write = dfu_control_point.write_confirm(bytearray([OpCodes.INITIALIZE_DFU]))
-    print "wrote INITIALIZE_DFU: %d" % did_write
-    dfu_packet.write_no_confirm(bytearray(firmware_sha1))
-    print "wrote firmware_sha1=%r" % firmware_sha1
+    if args.rate:
+        pacing.set_rate(args.rate)
 
-    if packet_notification_count > 0:
-        did_write = dfu_control_point.write_confirm(
-            bytearray([OpCodes.REQ_PKT_RCPT_NOTIF])
-            + uint16_bytearray(packet_notification_count))
-        print "wrote REQ_PKT_RCPT_NOTIF: %d" % did_write
-
-    did_write = dfu_control_point.write_confirm(bytearray([OpCodes.RECEIVE_FIRMWARE_IMAGE]))
-    print "wrote RECEIVE_FIRMWARE_IMAGE: %d" % did_write
-    validate_dfu_response(control_point_subscription.read())
-
-    for packet_count, i in enumerate(range(0, firmware_size, PACKET_SIZE)):
-        data = firmware_data[i:i+PACKET_SIZE]
-        dfu_packet.write_no_confirm(data)
-        sys.stdout.write('.')
-
-        if packet_notification_count > 0 and packet_count % packet_notification_count == 0:
-            validate_dfu_response(control_point_subscription.read())
-
-    print '\nwrote %d bytes (%d packets)' % (firmware_size, packet_count)
-
-    did_write = dfu_control_point.write_confirm(bytearray([OpCodes.VALIDATE_FIRMWARE_IMAGE]))
-    print "wrote VALIDATE_FIRMWARE_IMAGE: %d" % did_write
-    validate_dfu_response(control_point_subscription.read())
-
-    time.sleep(1)
+    pybt.start_scan()
 
-    did_write = dfu_control_point.write_confirm(bytearray([OpCodes.ACTIVATE_FIRMWARE_AND_RESET]))
-    print "wrote ACTIVATE_FIRMWARE_AND_RESET: %d" % did_write
-    validate_dfu_response(control_point_subscription.read())
+    band_names = find_band_names(args.band_names, args.scan_time)
+    if not band_names:
+        return 1
+
+    if len(band_names) > 1 or band_names != args.band_names:
+        if args.checkpoint_path:
+            arg_parser.error('--checkpoint only works with a single Band')
+
+        fleet = Fleet(
+            pybt.find_peripheral_by_name,
+            firmware_image,
+            jobs=args.jobs,
+            retries=args.retries,
+            checkpoint_path=checkpoint_path,
+            resume=args.resume,
+            packet_notification_count=args.packet_notification_count,
+            window=args.window,
+            packet_size=args.packet_size)
+        results = fleet.run(band_names)
+
+        print fleet.progress()
+        for result in results:
+            print result
+        return 0 if all(result.succeeded for result in results) else 1
+
+    band_name = band_names[0]
+    path = args.checkpoint_path or checkpoint_path(band_name)
+    if args.resume:
+        checkpoint = Checkpoint.load(path)
+    else:
+        checkpoint = Checkpoint(path)
+
+    for attempt in range(1, args.retries + 2):
+        try:
+            peripheral = pybt.find_peripheral_by_name(band_name, FIND_TIMEOUT)
+            print peripheral
+
+            stats = hello.dfu.flash(
+                peripheral,
+                firmware_image,
+                args.packet_notification_count,
+                window=args.window,
+                checkpoint=checkpoint,
+                packet_size=args.packet_size,
+                progress=lambda sent, total: sys.stdout.write('.'))
+            break
+        except Exception as e:
+            if attempt > args.retries:
+                raise
+            log.warning('%s: attempt %d failed: %s' % (band_name, attempt, e))
+
+    print '\n%s' % stats
+    write_queue = pacing.queue(peripheral.name())
+    if write_queue.writes:
+        print write_queue
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
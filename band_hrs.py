@@ -7,6 +7,8 @@ import time
 
 import hello.band
 
+log.basicConfig(level=log.DEBUG)
+
 def main(argv):
     band = hello.band.Band('TEST')
     band.connect()
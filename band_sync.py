@@ -1,102 +1,164 @@
 #!/usr/bin/env python
 
 import argparse
+import fnmatch
 import logging as log
-import sha
-import struct
 import sys
-import time
 
+import hello.band.sync as sync
+from hello.band.collector import Collector
+import hello.band.upload as upload
 import hello.pybt as pybt
 
-uuid_alpha0_service = '0000BA5E-1212-EFDE-1523-785FEABCD123'
-uuid_control_characteristic = 'DEED'
-uuid_control_response_characteristic = 'D00D'
-uuid_data_characteristic = 'FEED'
-uuid_data_response_characteristic = 'F00D'
-
 log.basicConfig(level=log.DEBUG)
 
 #
 
-PACKET_SIZE = 20
-
-class ControlCodes(object):
-    SEND_SENSOR_DATA = 2
+def is_pattern(name):
+    return any(c in name for c in '*?[')
+
+def find_peripherals(patterns, timeout):
+    """The peripherals advertising the sync service seen within timeout
+    seconds whose names match the shell-style patterns like 'Band*', or
+    all of them without any."""
+
+    # so that the Collector does not connect to every phone in range
+    seen = [result.peripheral for result in pybt.scan([sync.UUID_SERVICE], timeout=timeout)]
+    if not patterns:
+        return seen
+    peripherals = []
+    for pattern in patterns:
+        matches = [peripheral for peripheral in seen if fnmatch.fnmatchcase(peripheral.name(), pattern)]
+        if not matches:
+            print >> sys.stderr, "no Band matching %s" % pattern
+        peripherals += [peripheral for peripheral in matches if peripheral not in peripherals]
+    return peripherals
 
 def main(argv):
     arg_parser = argparse.ArgumentParser(description='Read sensor data from Band and upload it to Ingress server.')
     arg_parser.add_argument(
-        'band_name',
-        help='name of the Band, e.g. Band, Andre')
+        'band_names',
+        nargs='*',
+        metavar='band_name',
+        help='name of the Band, e.g. Band, Andre. Give several names, or a pattern such as "Band*", to sync many Bands at once, or none to sync every Band in range')
+    arg_parser.add_argument(
+        '-o', '--output',
+        help='file to write the sensor data to, as it arrives. Only for a single Band')
+    arg_parser.add_argument(
+        '-j', '--jobs',
+        help='number of Bands to sync at the same time. Defaults to 4',
+        type=int,
+        default=4)
+    arg_parser.add_argument(
+        '--retries',
+        help='number of times to retry a Band whose transfer fails. Defaults to 0',
+        type=int,
+        default=0)
+    arg_parser.add_argument(
+        '--scan-time',
+        help='seconds to scan for Bands, without a name or with a pattern. Defaults to 5',
+        type=int,
+        default=5)
+    arg_parser.add_argument(
+        '--packet-timeout',
+        help='seconds to wait for each packet before giving up on the transfer. Defaults to 10.',
+        type=float,
+        default=10.0)
+    arg_parser.add_argument(
+        '--size',
+        help='bytes of sensor data each Band sends. Needed if that takes %d packets or more, which the Band cannot count' % sync.SEQUENCE_NUMBERS,
+        type=int)
+    arg_parser.add_argument(
+        '--spool',
+        help='directory verified sensor data is kept in until it is uploaded. Defaults to spool.',
+        default='spool')
+    arg_parser.add_argument(
+        '-u', '--ingest-url',
+        help='URL of the ingest server to upload the spool to. Without one, the data stays spooled.')
+    arg_parser.add_argument(
+        '--upload-timeout',
+        help='seconds to wait for the spool to be uploaded before leaving the rest for next time. Defaults to 60.',
+        type=float,
+        default=60.0)
     args = arg_parser.parse_args(argv[1:])
 
+    spool = upload.Spool(args.spool)
+    # uploads what previous runs left while this one talks to the Band
+    uploader = upload.Uploader(args.ingest_url, spool) if args.ingest_url else None
+    try:
+        if len(args.band_names) == 1 and not is_pattern(args.band_names[0]):
+            return sync_band(args, spool)
+        if args.output:
+            arg_parser.error('--output only works with a single Band')
+        return sync_bands(args, spool)
+    finally:
+        if uploader:
+            if not uploader.close(args.upload_timeout):
+                print "Upload timed out; %d transfers left in %s" % (len(spool.pending()), args.spool)
+            print uploader
+
+def sync_bands(args, spool):
     pybt.start_scan()
 
-    peripheral = pybt.find_peripheral_by_name(args.band_name)
-    print peripheral
-
-    service = peripheral[uuid_alpha0_service]
-    print service.UUID()
-
-    control_characteristic = service[uuid_control_characteristic]
-    print control_characteristic.UUID()
-
-    # control_response_characteristic = peripheral[uuid_control_response_characteristic]
-    # print control_response_characteristic.UUID()
+    peripherals = find_peripherals(args.band_names, args.scan_time)
+    if not peripherals:
+        return 1
 
-    data_characteristic = service[uuid_data_characteristic]
-    print data_characteristic.UUID()
+    collector = Collector(spool, jobs=args.jobs, retries=args.retries, packet_timeout=args.packet_timeout,
+        size=args.size)
+    results = collector.run(peripherals)
+    for result in results:
+        if result.is_band:
+            print result
+    print collector.progress()
+    return 0 if all(result.succeeded for result in results if result.is_band) else 1
 
-    # data_response_characteristic = peripheral[uuid_data_response_characteristic]
-    # print data_response_characteristic.UUID()
+def sync_band(args, spool):
+    band_name = args.band_names[0]
 
-    data_subscription = data_characteristic.subscribe()
-
-    control_characteristic.write_no_confirm(bytearray([ControlCodes.SEND_SENSOR_DATA]))
-    print "Wrote 0x02 to 0xDEED"
-
-    packets = [bytearray()] * 15
-    expected_packets = 0
-    received_packets = 0
-
-    while True:
-        data = data_subscription.read()
-
-        print "Received %d bytes: %r" % (len(data), data)
-        received_packets += 1
-
-        sequence_number = data[0]
-        if sequence_number == 0:
-            print "Got header packet"
-
-            expected_packets = data[1]
-            packets = packets[:expected_packets]
-
-            packet = data[2:]
-        else:
-            packet = data[1:]
-
-        packets[sequence_number] = packet
-
-        print "Received %d of %d packets" % (received_packets, expected_packets)
-        if received_packets == expected_packets:
-            # last packet received; now remove SHA-1 from packets and compute it
-            all_data = reduce(lambda lhs, rhs: lhs+rhs, packets[0:expected_packets-1])
-
-            actual_sha1 = bytearray(sha.new(all_data).digest()[0:19])
-
-            expected_sha1 = packets[-1]
-
-            print "Actual SHA-1: %r" % actual_sha1
-            print "Expected SHA-1: %r" % expected_sha1
+    pybt.start_scan()
 
-            if actual_sha1 == expected_sha1:
-                print "Data integrity verified."
-            else:
-                print "Uh oh"
+    peripheral = pybt.find_peripheral_by_name(band_name)
+    print peripheral
 
-            break
+    output = open(args.output, 'wb') if args.output else None
+    writer = spool.writer(band=band_name)
+    sink = Tee(writer, output) if output else writer
+    committed = False
+    try:
+        try:
+            reassembler = sync.receive(peripheral, sink, args.packet_timeout, size=args.size)
+        except (pybt.TimeoutError, sync.SyncError) as e:
+            print e
+            return 1
+        finally:
+            if output:
+                output.close()
+
+        print "Received %d bytes in %d packets (%d duplicates)" % (
+            reassembler.length, reassembler.received, reassembler.duplicates)
+        print "Actual SHA-1: %r" % reassembler.sha1.digest()[:len(reassembler.expected_sha1)]
+        print "Expected SHA-1: %r" % reassembler.expected_sha1
+
+        if not reassembler.verified:
+            print "Uh oh"
+            return 1
+        writer.commit(sha1=reassembler.sha1.hexdigest())
+        committed = True
+        print "Data integrity verified; spooled as %s." % writer.name
+    finally:
+        # whatever went wrong, e.g. a SyncError, nothing else would clean
+        # up the .tmp file
+        if not committed:
+            writer.discard()
+
+class Tee(object):
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for file in self.files:
+            file.write(data)
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
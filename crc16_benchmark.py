@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Check hello.dfu.crc16 against the original byte-at-a-time implementation
+from pill_dfu.py, then time both.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import hello.dfu.crc16
+
+# The original pill_dfu.crc16, kept here as the reference.
+
+def uint32_t(num):
+    return num % 2**32
+
+def uint16_t(num):
+    return num % 2**16
+
+def uint8_t(num):
+    return num % 2**8
+
+def reference_crc16(data):
+    crc = 0xffff
+    for i in range(0, len(data)):
+        crc = uint16_t(uint8_t(crc >> 8) | (crc << 8))
+        crc ^= uint16_t(data[i])
+        crc ^= uint16_t(uint8_t(crc & 0xff) >> 4)
+        crc ^= uint16_t(uint32_t(crc << 8) << 4)
+        crc ^= uint16_t(((crc & 0xff) << 4) << 1)
+
+    return crc
+
+GOLDEN_VECTORS = [
+    (bytearray(), 0xffff),
+    (bytearray([0]), 0xe1f0),
+    (bytearray('123456789'), 0x29b1),
+    (bytearray([0xff] * 20), 0x45ea),
+]
+
+def check(data):
+    expected = reference_crc16(data)
+
+    assert hello.dfu.crc16.crc16(data) == expected
+    assert hello.dfu.crc16.crc16(str(data)) == expected
+    assert hello.dfu.crc16.crc16(memoryview(data)) == expected
+
+    assert hello.dfu.crc16.crc16(list(data)) == expected
+    assert hello.dfu.crc16.table_update(0xffff, data) == expected
+
+    # ragged chunk boundaries must not matter
+    for chunk_size in range(1, 42):
+        crc = hello.dfu.crc16.CRC16()
+        for i in range(0, len(data), chunk_size):
+            crc.update(data[i:i+chunk_size])
+        assert crc.value == expected, chunk_size
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description='Check and time hello.dfu.crc16.')
+    arg_parser.add_argument(
+        '-s', '--size',
+        help='size of the random image to time, in bytes. Defaults to 256KB.',
+        type=int,
+        default=256*1024)
+    args = arg_parser.parse_args(argv[1:])
+
+    for data, crc in GOLDEN_VECTORS:
+        assert reference_crc16(data) == crc
+        check(data)
+    for size in [1, 19, 20, 21, 31, 32, 33, 1000, 4099]:
+        check(bytearray(os.urandom(size)))
+    print "hello.dfu.crc16 matches pill_dfu.crc16"
+
+    image = bytearray(os.urandom(args.size))
+
+    def time_it(label, function):
+        seconds = min(timeit.repeat(function, number=1, repeat=3))
+        print "%-32s %8.4fs %10.1f MB/s" % (label, seconds, args.size / seconds / 1e6)
+        return seconds
+
+    reference = time_it('reference crc16', lambda: reference_crc16(image))
+    table = time_it('hello.dfu.crc16.table_update', lambda: hello.dfu.crc16.table_update(0xffff, image))
+    bulk = time_it('hello.dfu.crc16.crc16', lambda: hello.dfu.crc16.crc16(image))
+
+    def streamed():
+        crc = hello.dfu.crc16.CRC16()
+        for i in range(0, len(image), 20):
+            crc.update(image[i:i+20])
+    packets = time_it('CRC16.update, 20-byte packets', streamed)
+
+    print "speedup over reference: %.1fx table, %.0fx bulk, %.1fx 20-byte packets" % (
+        reference / table, reference / bulk, reference / packets)
+
+if __name__ == '__main__':
+    main(sys.argv)
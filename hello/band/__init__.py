@@ -1,11 +1,13 @@
 import logging as log
+import os
 import struct
 import sys
 import time
 
 import hello.pybt as pybt
 
-log.basicConfig(level=log.DEBUG)
+# numpy is imported where it is used, so that importing hello.band, as
+# every script does before it parses its arguments, stays quick
 
 CMD_START_HRS = 0x33
 CMD_CAL_HRS = 0x35
@@ -19,8 +21,18 @@ CONF_VIBRATE = 0x4
 STATE_HRS_DONE = 0x34
 STATE_IDLE = 0x66
 
+HRS_BLOCK_SIZE = 1000  # samples per hrs_stream() block: ten seconds' worth
+
+# each IMU packet is one sample: accelerometer x, y, z then gyroscope x, y,
+# z, as little-endian int16s; IMU_DTYPE is the numpy dtype, as a spec
 IMU_PACKET_SIZE = 12
-IMU_SAMPLES = 480
+IMU_SAMPLES = 480  # bytes per CMD_START_ACCEL_GYRO burst
+IMU_DTYPE = [
+    ('accel_x', '<i2'), ('accel_y', '<i2'), ('accel_z', '<i2'),
+    ('gyro_x', '<i2'), ('gyro_y', '<i2'), ('gyro_z', '<i2')]
+
+# a Band resets into DFU mode without acknowledging CMD_ENTER_DFU
+DFU_RESET_TIMEOUT = 2.0
 
 class UUID:
     class SERVICE:
@@ -35,18 +47,22 @@ class UUID:
         #DATA = '00001531-1212-EFDE-1523-785FEABCD123'
 
 class Band(object):
+    """Methods that take a timeout raise pybt.TimeoutError if they take
+    longer than that many seconds."""
+
     def __init__(self, name):
         self.name = name
 
-    def connect(self):
+    def connect(self, timeout=None):
         pybt.start_scan()
         log.debug('Connecting to %s...' % self.name)
-        self.peripheral = pybt.find_peripheral_by_name(self.name)
-        log.debug('Found %s' % self.name)
-        self.debug_service = self.peripheral[UUID.SERVICE.DEBUG]
-        log.debug('Found debug service: %s' % self.debug_service.UUID())
-        self.control = self.debug_service[UUID.CHARACTERISTIC.CONTROL]
-        log.debug('Found control characteristic: %s' % self.control.UUID())
+        with pybt.deadline(timeout):
+            self.peripheral = pybt.find_peripheral_by_name(self.name)
+            log.debug('Found %s' % self.name)
+            self.debug_service = self.peripheral[UUID.SERVICE.DEBUG]
+            log.debug('Found debug service: %s' % self.debug_service.UUID())
+            self.control = self.debug_service[UUID.CHARACTERISTIC.CONTROL]
+            log.debug('Found control characteristic: %s' % self.control.UUID())
 
     # heart rate
 
@@ -70,26 +86,71 @@ class Band(object):
         log.debug("Sending %s" % repr(command))
         self.control.write_confirm(command)
 
-    def hrs_read(self, samples):
-        self.data = self.debug_service[UUID.CHARACTERISTIC.DATA]
-        log.debug('Found data characteristic: %s' % self.data.UUID())
-
-        self.data_subscription = self.data.subscribe()
-        log.debug('Subscribed to data characteristic')
-
+    def hrs_read(self, samples, timeout=None):
+        """Returns the run hrs_start() recorded, as a bytearray of samples."""
         data = bytearray()
-        self.control.write_confirm(bytearray([CMD_SEND_DATA]))
-        log.debug('Wrote CMD_SEND_DATA to control characteristic')
-
-        PACKET_SIZE = 20
-
-        for i in range(0, samples / PACKET_SIZE):
-            packet = self.data_subscription.read()
-            text = ' '.join([str(value) for value in packet])
-            log.debug('<- ' + text)
-            data += packet
+        for block in self._hrs_blocks(samples, samples, timeout):
+            data = block
         return data
 
+    def hrs_stream(self, samples, block_size=HRS_BLOCK_SIZE, timeout=None):
+        """Yields the run hrs_start() recorded as it arrives, in numpy
+        uint8 arrays of block_size samples; the last one has whatever is
+        left over.  Each block is yielded as soon as it fills, and only
+        the one being filled is buffered, however long the run.
+
+        timeout bounds the whole run, but not the time the caller spends
+        between blocks."""
+
+        import numpy
+
+        for block in self._hrs_blocks(samples, block_size, timeout):
+            yield numpy.frombuffer(block, dtype=numpy.uint8)
+
+    def _hrs_blocks(self, samples, block_size, timeout):
+        """Sends CMD_SEND_DATA and yields a new bytearray for every
+        block_size samples received."""
+
+        until = time.time() + timeout if timeout is not None else None
+        def remaining():
+            return max(0.0, until - time.time()) if until is not None else None
+
+        # not one with-block around the generator: the deadline is
+        # per-thread, and would hold for the caller between blocks
+        with pybt.deadline(remaining()):
+            self.data = self.debug_service[UUID.CHARACTERISTIC.DATA]
+            log.debug('Found data characteristic: %s' % self.data.UUID())
+
+            self.data_subscription = self.data.subscribe()
+            log.debug('Subscribed to data characteristic')
+
+        try:
+            with pybt.deadline(remaining()):
+                self.control.write_confirm(bytearray([CMD_SEND_DATA]))
+                log.debug('Wrote CMD_SEND_DATA to control characteristic')
+
+            # the last packet of a run carries whatever is left over, and
+            # read_into() takes a partial one as readily as a full one
+            left = samples
+            while left > 0:
+                block = bytearray(min(block_size, left))
+                with pybt.deadline(remaining()):
+                    self._read_into(block)
+                left -= len(block)
+                yield block
+        finally:
+            self.data_subscription.unsubscribe()
+
+    def _read_into(self, data):
+        """Fills data from the data subscription, taking whatever
+        notifications are queued in each call."""
+
+        received = 0
+        while received < len(data):
+            count = self.data_subscription.read_into(data, received)
+            log.debug('<- %d bytes (%d of %d)' % (count, received + count, len(data)))
+            received += count
+
     def vibrate(self):
         self.config = self.debug_service[UUID.CHARACTERISTIC.CONFIG]
         log.debug('Found config characteristic: %s' % self.config.UUID())
@@ -98,33 +159,81 @@ class Band(object):
 
     # accelerometer/gyroscope
 
-    def test_imu(self, samples=IMU_SAMPLES):
-        self.data = self.debug_service[UUID.CHARACTERISTIC.DATA]
-        log.debug('Found data characteristic: %s' % self.data.UUID())
-
-        self.data_subscription = self.data.subscribe()
-        log.debug('Subscribed to data characteristic')
-
-        self.control.write_confirm(bytearray([CMD_START_ACCEL_GYRO]))
-        log.debug("Wrote CMD_START_ACCEL_GYRO to control characteristic")
-
-        data = bytearray()
-        for i in range(0, samples / IMU_PACKET_SIZE):
-            packet = self.data_subscription.read()
-            data += packet
-
-            text = ' '.join(['%2x' % value for value in packet])
-            log.debug('<- ' + text)
-
-            #print len(packet)
-            #print type(packet)
-
-            #values = list(struct.unpack('<hhhhh', str(packet)))
-            #print ' '.join(['%6hd' % value for value in values])
-        return data
+    def test_imu(self, samples=IMU_SAMPLES, timeout=None):
+        """Returns one burst of samples bytes of raw IMU packets; see
+        decode_imu()."""
+        for burst in self._imu_bursts(samples, 1, timeout):
+            return burst
+
+    def imu_stream(self, bursts=None, samples=IMU_SAMPLES, structured=False, timeout=None):
+        """Yields IMU bursts of samples bytes, decoded as decode_imu()
+        does, back to back: bursts of them, or until the generator is
+        closed if bursts is None.  timeout bounds each burst."""
+
+        for burst in self._imu_bursts(samples, bursts, timeout):
+            yield decode_imu(burst, structured)
+
+    def _imu_bursts(self, samples, bursts, timeout):
+        """Subscribes once, then sends CMD_START_ACCEL_GYRO and yields a
+        new bytearray with the packets it brings, bursts times (for ever
+        if None)."""
+
+        with pybt.deadline(timeout):
+            self.data = self.debug_service[UUID.CHARACTERISTIC.DATA]
+            log.debug('Found data characteristic: %s' % self.data.UUID())
+
+            self.data_subscription = self.data.subscribe()
+            log.debug('Subscribed to data characteristic')
+
+        try:
+            count = 0
+            while bursts is None or count < bursts:
+                data = bytearray(samples // IMU_PACKET_SIZE * IMU_PACKET_SIZE)
+                with pybt.deadline(timeout):
+                    self.control.write_confirm(bytearray([CMD_START_ACCEL_GYRO]))
+                    log.debug("Wrote CMD_START_ACCEL_GYRO to control characteristic")
+                    self._read_into(data)
+                count += 1
+                yield data
+        finally:
+            self.data_subscription.unsubscribe()
 
     # DFU
 
-    def reset_to_DFU(self):
-        print >> sys.stderr, "Sending DFU command; %s will reset. You will need to Ctrl-Z and kill %%1 me." % self.name
-        self.control.write_confirm(bytearray([CMD_ENTER_DFU]))
+    def reset_to_DFU(self, timeout=DFU_RESET_TIMEOUT):
+        print >> sys.stderr, "Sending DFU command; %s will reset." % self.name
+        try:
+            self.control.write_confirm(bytearray([CMD_ENTER_DFU]), timeout)
+        except pybt.TimeoutError:
+            log.debug('%s reset without acknowledging CMD_ENTER_DFU' % self.name)
+
+def decode_imu(data, structured=False):
+    """Decodes raw IMU packets in one go: returns an (N, 6) int16 array of
+    accel_x, accel_y, accel_z, gyro_x, gyro_y, gyro_z rows, or if
+    structured, an array of N IMU_DTYPE records with those fields.
+    Trailing bytes short of a whole packet are ignored.  The result
+    shares data's memory when data is a bytearray."""
+
+    import numpy
+
+    count = len(data) // IMU_PACKET_SIZE
+    if structured:
+        return numpy.frombuffer(data, dtype=IMU_DTYPE, count=count)
+    return numpy.frombuffer(data, dtype='<i2', count=count * 6).reshape(count, 6)
+
+def load_imu(path, structured=False):
+    """Reads a file of raw IMU packets, as bandsh's imu_record writes,
+    decoded as decode_imu() does, without reading it all into memory
+    first."""
+
+    import numpy
+
+    # a capture cut short may end in part of a packet
+    count = os.path.getsize(path) // IMU_PACKET_SIZE
+    if count:
+        records = numpy.memmap(path, dtype=IMU_DTYPE, mode='r', shape=(count,))
+    else:
+        records = numpy.empty(0, dtype=IMU_DTYPE)
+    if structured:
+        return records
+    return records.view('<i2').reshape(len(records), 6)
@@ -0,0 +1,203 @@
+"""An append-only binary store for sample runs, such as bandsh's HRS
+captures.
+
+A capture file is the magic string, then one record per run:
+
+    RUN_HEADER      'RUN1', metadata length, sample count, as '<4sIQ'
+    metadata        JSON, padded with spaces to a multiple of 8 bytes
+    samples         sample count items of metadata['dtype'], padded with
+                    zeroes to a multiple of 8 bytes
+
+Each header gives the lengths of what follows it, so Capture finds every
+run by reading only the headers, and then hands out each run's samples
+as a numpy view of the memory-mapped file: nothing is parsed, and
+nothing is read until it is used.  A run is written header first, so
+CaptureWriter can stream its samples in as they arrive; a run cut short
+reads back with the samples that made it.
+
+    with CaptureWriter('research/Band.hrscap') as writer:
+        writer.begin_run(samples, 'u1', power_level=50, delay=0)
+        for block in band.hrs_stream(samples):
+            writer.append(block)
+
+    capture = Capture('research/Band.hrscap')
+    print capture[-1].metadata['power_level'], capture[-1].samples.mean()
+"""
+
+import json
+import os
+import struct
+import time
+
+import numpy
+
+MAGIC = 'HELLOCAP'
+RUN_MAGIC = 'RUN1'
+RUN_HEADER = struct.Struct('<4sIQ')
+ALIGNMENT = 8
+
+def _padding(length):
+    return -length % ALIGNMENT
+
+class CaptureWriter(object):
+    def __init__(self, path, overwrite=False):
+        exists = not overwrite and os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, 'r+b' if exists else 'wb')
+        if exists:
+            self._repair(Capture(path).index)
+        else:
+            self.file.write(MAGIC)
+        self.header_offset = None
+        self.count = 0
+        self.remaining = 0
+        self.itemsize = 1
+
+    def _repair(self, index):
+        """Whatever was writing the last run may have stopped part way,
+        so its header claims more samples than follow it.  Shortens the
+        header to what is there, so the runs appended after it are found."""
+
+        end = len(MAGIC)
+        if index:
+            metadata, offset, count, header_offset, declared = index[-1]
+            if count < declared:
+                self.file.seek(header_offset + 8)
+                self.file.write(struct.pack('<Q', count))
+            end = offset + count * numpy.dtype(str(metadata['dtype'])).itemsize
+        self.file.seek(end)
+        self.file.truncate()
+        self._pad()
+
+    def begin_run(self, sample_count, dtype, **metadata):
+        """Starts a run of sample_count samples of dtype, to be written
+        with append().  metadata has to be JSON-serializable; the dtype,
+        and the time the run started, are added to it."""
+
+        self._finish_run()
+
+        dtype = numpy.dtype(dtype)
+        metadata = dict(metadata, dtype=dtype.str, started=time.time())
+        encoded = json.dumps(metadata, sort_keys=True)
+        encoded += ' ' * _padding(RUN_HEADER.size + len(encoded))
+
+        self.header_offset = self.file.tell()
+        self.file.write(RUN_HEADER.pack(RUN_MAGIC, len(encoded), sample_count))
+        self.file.write(encoded)
+        self.count = self.remaining = sample_count
+        self.itemsize = dtype.itemsize
+        if not sample_count:
+            self._pad()
+
+    def append(self, samples):
+        """Writes the next of the run's samples: a numpy array, or for
+        single-byte dtypes, anything with the buffer interface."""
+
+        data = samples.tostring() if isinstance(samples, numpy.ndarray) else str(samples)
+        count = len(data) // self.itemsize
+        if count > self.remaining:
+            raise ValueError('%d samples more than the run has room for' % (count - self.remaining))
+        self.file.write(data)
+        self.file.flush()
+        self.remaining -= count
+        if self.remaining == 0:
+            self._pad()
+
+    def write_run(self, samples, **metadata):
+        samples = numpy.asarray(samples)
+        self.begin_run(len(samples), samples.dtype, **metadata)
+        self.append(samples)
+
+    def _pad(self):
+        self.file.write('\0' * _padding(self.file.tell()))
+        self.file.flush()
+
+    def _finish_run(self):
+        # a run abandoned part way gets a header with the samples it has
+        if self.remaining:
+            end = self.file.tell()
+            self.file.seek(self.header_offset + 8)
+            self.file.write(struct.pack('<Q', self.count - self.remaining))
+            self.file.seek(end)
+            self.remaining = 0
+            self._pad()
+
+    def close(self):
+        self._finish_run()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Run(object):
+    def __init__(self, index, metadata, samples):
+        self.index = index
+        self.metadata = metadata
+        self.samples = samples
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __repr__(self):
+        return '<Run %d: %d samples, %r>' % (self.index, len(self.samples), self.metadata)
+
+class Capture(object):
+    """The runs in a capture file, in the order they were written."""
+
+    def __init__(self, path):
+        self.path = path
+        size = os.path.getsize(path)
+        self.data = numpy.memmap(path, dtype=numpy.uint8, mode='r') if size else numpy.empty(0, numpy.uint8)
+        if size and self.data[:len(MAGIC)].tostring() != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        """(metadata, samples offset, sample count, header offset, sample
+        count in the header) for every run, from the headers.  The counts
+        differ for a run that was cut short; a header cut short is left
+        out."""
+
+        index = []
+        offset = len(MAGIC)
+        while offset + RUN_HEADER.size <= len(self.data):
+            header_offset = offset
+            magic, metadata_length, declared = RUN_HEADER.unpack(self.data[offset:offset+RUN_HEADER.size].tostring())
+            if magic != RUN_MAGIC:
+                raise ValueError('%s: no run at offset %d' % (self.path, offset))
+            offset += RUN_HEADER.size
+            if offset + metadata_length > len(self.data):
+                break
+            metadata = json.loads(self.data[offset:offset+metadata_length].tostring())
+            offset += metadata_length
+
+            itemsize = numpy.dtype(str(metadata['dtype'])).itemsize
+            count = min(declared, (len(self.data) - offset) // itemsize)
+            index.append((metadata, offset, count, header_offset, declared))
+            offset += declared * itemsize
+            offset += _padding(offset)
+        return index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        metadata, offset, count = self.index[i][:3]
+        dtype = numpy.dtype(str(metadata['dtype']))
+        samples = self.data[offset:offset + count * dtype.itemsize].view(dtype)
+        return Run(i if i >= 0 else len(self.index) + i, metadata, samples)
+
+    def __iter__(self):
+        for i in range(len(self.index)):
+            yield self[i]
+
+    def find(self, **criteria):
+        """The runs whose metadata has all of criteria's values."""
+        return [self[i] for i, entry in enumerate(self.index)
+                if all(entry[0].get(key) == value for key, value in criteria.items())]
+
+def write_csv(samples, file):
+    """Writes one sample per line, as bandsh used to."""
+    numpy.savetxt(file, samples, fmt='%u')
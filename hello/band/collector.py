@@ -0,0 +1,188 @@
+import logging as log
+import Queue
+import threading
+import time
+
+import hello.band.sync as sync
+import hello.pybt as pybt
+
+class SyncResult(object):
+    """What happened to one peripheral in a Collector run."""
+
+    def __init__(self, peripheral):
+        self.peripheral = peripheral
+        self.name = peripheral.name()
+        self.is_band = None  # whether it has the sync service, once looked at
+        self.reassembler = None
+        self.bytes_received = 0
+        self.spooled = None  # the transfer's name in the spool
+        self.attempts = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    @property
+    def succeeded(self):
+        return self.done and self.is_band and self.error is None and bool(self.reassembler.verified)
+
+    @property
+    def throughput(self):
+        """Bytes per second over the last attempt."""
+        elapsed = (self.finished or time.time()) - self.started
+        return self.bytes_received / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        if not self.done:
+            state = 'received %d bytes' % self.bytes_received
+        elif not self.is_band:
+            state = 'not a Band'
+        elif self.error is not None:
+            state = 'FAILED after %d attempts: %s' % (self.attempts, self.error)
+        else:
+            state = '%d bytes in %.1fs (%.0f bytes/sec, %d packets, %d duplicates, %d attempts)%s' % (
+                self.bytes_received,
+                self.finished - self.started,
+                self.throughput,
+                self.reassembler.received,
+                self.reassembler.duplicates,
+                self.attempts,
+                '' if self.reassembler.verified else ', SHA-1 MISMATCH')
+        return '%s: %s' % (self.name, state)
+
+class Collector(object):
+    """Syncs the sensor data of many Bands at once.
+
+    Up to jobs peripherals are synced concurrently, each by
+    hello.band.sync.receive() on its own worker thread.  Peripherals
+    without the sync service, which the scan finds too, are skipped
+    after probe_timeout seconds.  A transfer that fails or does not
+    verify is retried up to retries more times, without holding up the
+    other Bands.
+
+    With a spool (see hello.band.upload), each verified transfer streams
+    into it, named after the Band; otherwise it is kept in its result's
+    reassembler.
+
+    size is the number of bytes each Band sends, if known; transfers too
+    long for their header to count need it (see hello.band.sync).
+    """
+
+    def __init__(self, spool=None, jobs=4, retries=0, packet_timeout=10.0, timeout=None, probe_timeout=5.0,
+            report_interval=5.0, size=None):
+        self.spool = spool
+        self.jobs = jobs
+        self.retries = retries
+        self.packet_timeout = packet_timeout
+        self.timeout = timeout
+        self.probe_timeout = probe_timeout
+        self.report_interval = report_interval
+        self.size = size
+
+        self.results = []
+        self.condition = threading.Condition()
+        self.started = None
+        self.finished = None
+
+    def run(self, peripherals):
+        """Syncs every Band among peripherals and returns a SyncResult
+        for each peripheral, in the same order."""
+
+        self.results = [SyncResult(peripheral) for peripheral in peripherals]
+        self.started = time.time()
+
+        pending = Queue.Queue()
+        for result in self.results:
+            pending.put(result)
+
+        workers = []
+        for i in range(min(self.jobs, len(self.results))):
+            worker = threading.Thread(target=self._work, args=(pending,), name='sync-%d' % i)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        with self.condition:
+            while not all(result.done for result in self.results):
+                self.condition.wait(self.report_interval)
+                log.info(self.progress())
+
+        for worker in workers:
+            worker.join()
+        self.finished = time.time()
+
+        return self.results
+
+    def _work(self, pending):
+        while True:
+            try:
+                result = pending.get_nowait()
+            except Queue.Empty:
+                return
+            self._sync(result)
+            with self.condition:
+                result.finished = time.time()
+                self.condition.notify_all()
+
+    def _probe(self, result):
+        try:
+            with pybt.deadline(self.probe_timeout):
+                result.peripheral[sync.UUID_SERVICE]
+            return True
+        except (KeyError, pybt.TimeoutError):
+            return False
+
+    def _sync(self, result):
+        result.started = time.time()
+        result.is_band = self._probe(result)
+        if not result.is_band:
+            return
+
+        def progress(length):
+            result.bytes_received = length
+
+        while result.attempts <= self.retries:
+            result.attempts += 1
+            result.started = time.time()
+            result.bytes_received = 0
+            writer = self.spool.writer(band=result.name) if self.spool else None
+            try:
+                result.reassembler = sync.receive(
+                    result.peripheral, writer, self.packet_timeout, self.timeout, progress, self.size)
+                if not result.reassembler.verified:
+                    raise sync.SyncError('SHA-1 mismatch')
+                if writer:
+                    writer.commit(sha1=result.reassembler.sha1.hexdigest())
+                    result.spooled = writer.name
+                result.error = None
+                return
+            except Exception as e:
+                if writer:
+                    writer.discard()
+                log.warning('%s: attempt %d failed: %s' % (result.name, result.attempts, e))
+                result.error = e
+
+    def progress(self):
+        """A one-line summary of every Band's progress."""
+
+        bands = [result for result in self.results if result.is_band is not False]
+        done = [result for result in bands if result.done]
+        failed = [result for result in done if not result.succeeded]
+        received = sum(result.bytes_received for result in bands)
+        elapsed = (self.finished or time.time()) - self.started
+
+        devices = ', '.join(
+            '%s %s' % (result.name, 'failed' if result in failed else '%d bytes' % result.bytes_received)
+            for result in bands if result.started)
+
+        return '%d of %d Bands done (%d failed, %d other peripherals), %d bytes received at %.0f bytes/sec: %s' % (
+            len(done),
+            len(bands),
+            len(failed),
+            len(self.results) - len(bands),
+            received,
+            received / elapsed if elapsed > 0 else 0.0,
+            devices)
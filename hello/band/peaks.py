@@ -0,0 +1,127 @@
+"""Heartbeat detection on HRS runs, as they stream in or from a capture.
+
+    detector = PeakDetector(HRS_SAMPLE_RATE)
+    for block in band.hrs_stream(samples):
+        detector.feed(block)
+        print detector.bpm
+
+Each block is detrended against a trailing moving average with numpy,
+which also finds where it crosses the threshold and the baseline; only
+those crossings, a few per beat, are looked at one by one.  State
+carries over between blocks, so feeding a run in blocks finds the same
+peaks as feeding it whole.
+"""
+
+import collections
+
+import numpy
+
+HRS_SAMPLE_RATE = 100
+
+def _trailing_means(history, values, window):
+    """The mean of each of values and the window - 1 values before it,
+    with history holding what came before values; near the start, of
+    what there is."""
+
+    x = numpy.concatenate((history, values))
+    sums = numpy.cumsum(numpy.concatenate(([0.0], x)))
+    ends = numpy.arange(len(history), len(x)) + 1
+    starts = numpy.maximum(0, ends - window)
+    return (sums[ends] - sums[starts]) / (ends - starts), x[max(0, len(x) - (window - 1)):]
+
+class PeakDetector(object):
+    """Finds heartbeats in photoplethysmogram samples.
+
+    The samples are detrended by subtracting their moving average over
+    window seconds.  Wherever that rises above threshold, or with no
+    threshold, half the signal's typical amplitude over the last
+    amplitude_window seconds, the highest sample before it falls back to
+    the baseline is a peak, unless it comes within refractory seconds of
+    the last one (0.3s allows up to 200 BPM).  bpm is estimated from the
+    median of the last intervals peak-to-peak intervals.
+    """
+
+    def __init__(self, sample_rate=HRS_SAMPLE_RATE, threshold=None, window=1.0, amplitude_window=3.0,
+                 refractory=0.3, intervals=8):
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.window = max(1, int(round(window * sample_rate)))
+        self.amplitude_window = max(1, int(round(amplitude_window * sample_rate)))
+        self.refractory = int(round(refractory * sample_rate))
+
+        self.count = 0  # samples fed so far
+        self.history = numpy.empty(0)  # the samples the moving average still needs
+        self.squares = numpy.empty(0)  # the squared detrended samples the amplitude still needs
+        self.crest = None  # (index, value) of the highest sample since rising above the threshold
+        self.last_peak = None
+        self.peaks = []
+        self.intervals = collections.deque(maxlen=intervals)
+
+    def feed(self, samples):
+        """Adds the next samples, and returns the indexes, counted from
+        the first sample fed, of the peaks they complete.  A peak is only
+        complete once the signal has fallen back to the baseline."""
+
+        samples = numpy.asarray(samples, dtype=numpy.float64)
+        if not len(samples):
+            return []
+
+        baseline, self.history = _trailing_means(self.history, samples, self.window)
+        detrended = samples - baseline
+        if self.threshold is not None:
+            threshold = self.threshold
+        else:
+            mean_squares, self.squares = _trailing_means(self.squares, detrended ** 2, self.amplitude_window)
+            threshold = 0.5 * numpy.sqrt(2 * mean_squares)
+
+        # a crest starts when the signal rises above the threshold, and
+        # ends when it falls back below the baseline, so noise around the
+        # threshold does not split it in two
+        above = numpy.flatnonzero(detrended >= threshold)
+        below = numpy.flatnonzero(detrended < 0)
+        found = []
+        position = 0
+        while position < len(detrended):
+            if self.crest is None:
+                rise = numpy.searchsorted(above, position)
+                if rise == len(above):
+                    break
+                position = above[rise]
+            fall = numpy.searchsorted(below, position)
+            end = below[fall] if fall < len(below) else len(detrended)
+            if end > position:
+                top = position + int(numpy.argmax(detrended[position:end]))
+                if self.crest is None or detrended[top] > self.crest[1]:
+                    self.crest = (self.count + top, detrended[top])
+            if end == len(detrended):
+                break
+            self._peak(self.crest[0], found)
+            self.crest = None
+            position = end
+
+        self.count += len(samples)
+        self.peaks.extend(found)
+        return found
+
+    def _peak(self, index, found):
+        if self.last_peak is not None:
+            if index - self.last_peak < self.refractory:
+                return
+            self.intervals.append(index - self.last_peak)
+        self.last_peak = index
+        found.append(index)
+
+    @property
+    def bpm(self):
+        """The heart rate in beats per minute, or None until two peaks
+        have been found."""
+        if not self.intervals:
+            return None
+        return 60.0 * self.sample_rate / numpy.median(self.intervals)
+
+def detect(samples, sample_rate=HRS_SAMPLE_RATE, threshold=None):
+    """Runs a PeakDetector over a whole run, e.g. a capture's, and
+    returns it."""
+    detector = PeakDetector(sample_rate, threshold)
+    detector.feed(samples)
+    return detector
@@ -0,0 +1,182 @@
+"""A Band's debug service, without a radio, and a stand-in for the
+ingest server it is synced to.
+
+    band = SimulatedBand('Band', link=hello.pybt.simulated.Link(latency=0.01))
+    hello.pybt.simulated.add_peripheral(band.peripheral)
+
+hello.band.Band('Band') then talks to it through the simulated backend.
+"""
+
+import BaseHTTPServer
+import math
+import random
+import SocketServer
+import struct
+import threading
+import time
+
+from hello.band import UUID, CMD_START_HRS, CMD_CAL_HRS, CMD_START_HRS2, CMD_SEND_DATA, CMD_ENTER_DFU, \
+    CMD_START_ACCEL_GYRO, CONF_VIBRATE, IMU_PACKET_SIZE, IMU_SAMPLES
+import hello.band.sync as sync
+import hello.band.upload as upload
+from hello.pybt.simulated import NO_RESPONSE, SimulatedCharacteristic, SimulatedDescriptor, SimulatedPeripheral, \
+    SimulatedService
+
+HRS_SAMPLE_RATE = 100
+
+class SimulatedBand(object):
+    """Answers the commands hello.band.Band sends.
+
+    An HRS run records a synthetic photoplethysmogram with heart_rate
+    beats per minute, which CMD_SEND_DATA then notifies in packets as
+    large as the link's MTU allows.  CMD_START_ACCEL_GYRO notifies
+    imu_samples bytes of accelerometer/gyroscope packets, at rest with
+    some noise.  SEND_SENSOR_DATA on the sync service notifies
+    sensor_data, or sensor_data_size random bytes, as hello.band.sync
+    expects, also in packets as large as the MTU allows.
+
+    Device Information and Battery services round out the GATT layout,
+    so that discovering all of it costs what it does on a Band.
+    """
+
+    def __init__(self, name='Band', heart_rate=72, imu_samples=IMU_SAMPLES, firmware_revision='1.0', link=None, seed=None,
+                 sensor_data=None, sensor_data_size=1000):
+        self.heart_rate = heart_rate
+        self.imu_samples = imu_samples
+        self.random = random.Random(seed)
+
+        self.hrs_samples = bytearray()
+        self.vibrations = 0
+        self.dfu_requested = threading.Event()
+        if sensor_data is None:
+            sensor_data = bytearray(self.random.getrandbits(8) for i in range(sensor_data_size))
+        self.sensor_data = bytearray(sensor_data)
+
+        self.control = SimulatedCharacteristic(UUID.CHARACTERISTIC.CONTROL, self._control_written)
+        self.config = SimulatedCharacteristic(UUID.CHARACTERISTIC.CONFIG, self._config_written)
+        self.data = SimulatedCharacteristic(UUID.CHARACTERISTIC.DATA, descriptors=[SimulatedDescriptor('2902')])
+        self.sync_data = SimulatedCharacteristic(sync.UUID_DATA, descriptors=[SimulatedDescriptor('2902')])
+        self.peripheral = SimulatedPeripheral(name, [
+            SimulatedService(UUID.SERVICE.DEBUG, [self.control, self.config, self.data]),
+            SimulatedService(sync.UUID_SERVICE, [
+                SimulatedCharacteristic(sync.UUID_CONTROL, self._sync_control_written), self.sync_data]),
+            SimulatedService('180A', [
+                SimulatedCharacteristic('2A29', read=lambda: 'Hello'),
+                SimulatedCharacteristic('2A24', read=lambda: 'Band'),
+                SimulatedCharacteristic('2A26', read=lambda: firmware_revision),
+                SimulatedCharacteristic('2A28', read=lambda: firmware_revision)]),
+            SimulatedService('180F', [
+                SimulatedCharacteristic('2A19', read=lambda: bytearray([100]), descriptors=[SimulatedDescriptor('2902')])]),
+        ], link)
+
+    def _control_written(self, data, confirm):
+        command = data[0]
+
+        if command in (CMD_START_HRS, CMD_CAL_HRS):
+            power_level, delay, samples = struct.unpack('<BHH', str(data[1:6]))
+            self.hrs_samples = self.hrs_waveform(samples)
+        elif command == CMD_START_HRS2:
+            power_level, delay, samples = struct.unpack('<BHH', str(data[1:6]))
+            self.hrs_samples = self.hrs_waveform(samples)
+        elif command == CMD_SEND_DATA:
+            self._send(self.hrs_samples, self.peripheral.link.max_payload)
+        elif command == CMD_START_ACCEL_GYRO:
+            self._send(self.imu_data(self.imu_samples / IMU_PACKET_SIZE), IMU_PACKET_SIZE)
+        elif command == CMD_ENTER_DFU:
+            # resets at once, without acknowledging
+            self.dfu_requested.set()
+            return NO_RESPONSE
+        else:
+            return False
+        return True
+
+    def _config_written(self, data, confirm):
+        if struct.unpack('<L', str(data[0:4]))[0] == CONF_VIBRATE:
+            self.vibrations += 1
+        return True
+
+    def _sync_control_written(self, data, confirm):
+        if data[0] != sync.SEND_SENSOR_DATA:
+            return False
+        for packet in sync.packets(self.sensor_data, self.peripheral.link.max_payload):
+            self.sync_data.notify(packet)
+        return True
+
+    def _send(self, data, packet_size):
+        for offset in range(0, len(data), packet_size):
+            self.data.notify(data[offset:offset+packet_size])
+
+    def hrs_waveform(self, samples):
+        frequency = self.heart_rate / 60.0
+        return bytearray(
+            max(0, min(255, int(128 + 60 * math.sin(2 * math.pi * frequency * i / HRS_SAMPLE_RATE) + self.random.gauss(0, 4))))
+            for i in range(samples))
+
+    def imu_data(self, samples):
+        data = bytearray()
+        for i in range(samples):
+            accel = [self.random.randint(-40, 40), self.random.randint(-40, 40), 4096 + self.random.randint(-40, 40)]
+            gyro = [self.random.randint(-20, 20) for axis in range(3)]
+            data += struct.pack('<hhhhhh', *(accel + gyro))
+        return data
+
+class _IngestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            status = server.failures.pop(0) if server.failures else 200
+            if status == 200:
+                server.batches.append(upload.decode_batch(body))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class SimulatedIngestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Accepts hello.band.upload batches on localhost, keeping each as a
+    list of (metadata, data) records in batches.  Requests are answered
+    after latency seconds; the next requests get the statuses in
+    failures instead of 200.
+
+        server = SimulatedIngestServer()
+        uploader = hello.band.upload.Uploader(server.url, spool)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, failures=()):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _IngestHandler)
+        self.latency = latency
+        self.failures = list(failures)
+        self.lock = threading.Lock()
+        self.batches = []
+        self.connections = 0
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/sensor-data' % self.server_address[1]
+
+    @property
+    def records(self):
+        with self.lock:
+            return [record for batch in self.batches for record in batch]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
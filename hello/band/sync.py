@@ -0,0 +1,236 @@
+"""Reassembles the sensor data a Band sends in response to
+SEND_SENSOR_DATA.
+
+The Band sends a numbered series of notifications:
+
+    header          0, packet count, first data
+    data            sequence number, data
+    ...
+    SHA-1           sequence number, the first 19 bytes of the data's SHA-1
+
+Sequence numbers are one byte, and wrap round.  Packets can arrive in any
+order, so Reassembler keeps a slot for every sequence number, and puts
+each packet in its own.  As the packets at the start of the window come
+in, they are hashed, handed to the sink, and their slots reused, so a
+transfer of any length takes linear time and a fixed amount of memory
+besides the sink.
+
+The header's packet count is one byte too, so a transfer of
+SEQUENCE_NUMBERS packets or more cannot be reassembled unless its size
+is known beforehand; see packet_count().
+
+A sequence number is taken to mean the nearest packet at or after the
+first missing one.  In a transfer the header can count, there is only
+one; in a longer one, a sequence number more than LONG_WINDOW packets
+ahead is taken to be a late duplicate of a packet already handed on, so
+packets can arrive at most that far out of order.
+
+    with open('sensor.dat', 'wb') as sink:
+        reassembler = receive(peripheral, sink, packet_timeout=5)
+    print reassembler.verified
+"""
+
+import hashlib
+
+import hello.pybt as pybt
+
+UUID_SERVICE = '0000BA5E-1212-EFDE-1523-785FEABCD123'
+UUID_CONTROL = 'DEED'
+UUID_DATA = 'FEED'
+
+SEND_SENSOR_DATA = 2
+
+PACKET_SIZE = 20  # at the smallest MTU; the Band sends up to pybt.max_payload()
+SEQUENCE_NUMBERS = 256
+LONG_WINDOW = SEQUENCE_NUMBERS // 2
+SLOT_SIZE = PACKET_SIZE - 1
+
+class SyncError(Exception):
+    pass
+
+class Reassembler(object):
+    """Packets go in with add(); the data comes out, in order, to
+    sink.write(), or without a sink, into data.  packet_count, including
+    the header and SHA-1 packets, comes from the header unless given,
+    e.g. for transfers too long for it to count.  Packets are up to
+    packet_size bytes.
+
+    Raises SyncError from add() if the header's count cannot be right:
+    if it disagrees with packet_count, or, when it is all there is to go
+    on, if it leaves no room for the SHA-1 or a packet numbered beyond
+    it arrives."""
+
+    def __init__(self, sink=None, packet_count=None, packet_size=PACKET_SIZE):
+        if packet_count is not None and packet_count < 2:
+            raise ValueError('packet_count must include the header and SHA-1 packets')
+
+        self.data = bytearray() if sink is None else None
+        self.sink = sink
+        self.packet_count = packet_count
+        self.counted_by_header = packet_count is None
+        self.packet_size = packet_size
+        self.slot_size = packet_size - 1
+
+        self.slots = bytearray(SEQUENCE_NUMBERS * self.slot_size)
+        self.lengths = [None] * SEQUENCE_NUMBERS  # of each slot's packet, or None if it is free
+        self.next = 0  # the first packet not yet handed on
+
+        self.sha1 = hashlib.sha1()
+        self.expected_sha1 = None
+        self.length = 0
+        self.received = 0
+        self.duplicates = 0
+
+    def add(self, packet):
+        """Adds a notification from the Band, and returns False if it was
+        a duplicate."""
+
+        if len(packet) < 1 or len(packet) > self.packet_size:
+            raise SyncError('%d-byte packet' % len(packet))
+
+        if self.counted_by_header and self.packet_count is not None and packet[0] >= self.packet_count:
+            raise SyncError('packet %d of a transfer the header counts as %d packets; give its size' % (
+                packet[0], self.packet_count))
+
+        ahead = (packet[0] - self.next) % SEQUENCE_NUMBERS
+        index = self.next + ahead
+        slot = index % SEQUENCE_NUMBERS
+        if (ahead >= self.window or self.lengths[slot] is not None or
+                self.packet_count is not None and index >= self.packet_count):
+            self.duplicates += 1
+            return False
+
+        if index == 0:
+            if len(packet) < 2:
+                raise SyncError('header packet without a packet count')
+            self._count(packet[1])
+            payload = buffer(packet, 2)
+        else:
+            payload = buffer(packet, 1)
+
+        offset = slot * self.slot_size
+        self.slots[offset:offset+len(payload)] = payload
+        self.lengths[slot] = len(payload)
+        self.received += 1
+
+        self._advance()
+        return True
+
+    def _count(self, count):
+        if not self.counted_by_header:
+            if count != self.packet_count % SEQUENCE_NUMBERS:
+                raise SyncError('header counts %d packets, not the %d expected (modulo %d)' % (
+                    count, self.packet_count, SEQUENCE_NUMBERS))
+            return
+        # 0 or 1 is a longer transfer's count wrapped round
+        if count < 2:
+            raise SyncError('header counts %d packets; give the size of a transfer this long' % count)
+        # the packets so far are numbered from 0, so sit in their own slots
+        beyond = [i for i in range(count, SEQUENCE_NUMBERS) if self.lengths[i] is not None]
+        if beyond:
+            raise SyncError('packet %d of a transfer the header counts as %d packets; give its size' % (
+                beyond[0], count))
+        self.packet_count = count
+
+    def _advance(self):
+        # the header comes first, so packet_count is known past it
+        while not self.complete and self.lengths[self.next % SEQUENCE_NUMBERS] is not None:
+            slot = self.next % SEQUENCE_NUMBERS
+            payload = buffer(self.slots, slot * self.slot_size, self.lengths[slot])
+            if self.next == self.packet_count - 1:
+                self.expected_sha1 = str(payload)
+            else:
+                self.sha1.update(payload)
+                self.length += len(payload)
+                if self.sink is None:
+                    self.data += payload
+                else:
+                    # a copy: the slot is reused as the window moves on
+                    self.sink.write(str(payload))
+            self.lengths[slot] = None
+            self.next += 1
+
+    @property
+    def window(self):
+        """How far ahead of the first missing packet a packet can be."""
+        if self.packet_count is not None and self.packet_count > SEQUENCE_NUMBERS:
+            return LONG_WINDOW
+        return SEQUENCE_NUMBERS
+
+    @property
+    def complete(self):
+        return self.packet_count is not None and self.next >= self.packet_count
+
+    @property
+    def verified(self):
+        """Whether the data matches the SHA-1 the Band sent; None until
+        the transfer is complete."""
+        if not self.complete:
+            return None
+        return self.sha1.digest()[:len(self.expected_sha1)] == self.expected_sha1
+
+    def missing(self):
+        """The packets in the window that have not arrived, which are the
+        gaps if the transfer stalls.  Until the header arrives, the end
+        of the transfer is unknown, so only the gaps before the last
+        packet received are counted."""
+
+        end = self.next + self.window
+        if self.packet_count is not None:
+            end = min(end, self.packet_count)
+        else:
+            received = [i for i in range(self.next, end) if self.lengths[i % SEQUENCE_NUMBERS] is not None]
+            end = received[-1] if received else self.next
+        return [i for i in range(self.next, end) if self.lengths[i % SEQUENCE_NUMBERS] is None]
+
+def packets(data, packet_size=PACKET_SIZE):
+    """The packets of up to packet_size bytes a Band sends data in; the
+    inverse of Reassembler.  The header counts the packets modulo 256,
+    so a Reassembler for a longer transfer has to be given the count."""
+
+    slot_size = packet_size - 1
+    first = packet_size - 2
+    chunks = [data[:first]] + [data[offset:offset+slot_size] for offset in range(first, len(data), slot_size)]
+    count = len(chunks) + 1
+    yield bytearray([0, count % SEQUENCE_NUMBERS]) + chunks[0]
+    for index, chunk in enumerate(chunks[1:], 1):
+        yield bytearray([index % SEQUENCE_NUMBERS]) + chunk
+    yield bytearray([(count - 1) % SEQUENCE_NUMBERS]) + hashlib.sha1(str(data)).digest()[:slot_size]
+
+def packet_count(size, packet_size=PACKET_SIZE):
+    """How many packets, including the header and SHA-1, packets()
+    sends size bytes in."""
+
+    first = packet_size - 2
+    slot_size = packet_size - 1
+    return 2 + (max(0, size - first) + slot_size - 1) // slot_size
+
+def receive(peripheral, sink=None, packet_timeout=None, timeout=None, progress=None, size=None):
+    """Asks the Band for its sensor data and returns the Reassembler it
+    went to.  Raises pybt.TimeoutError if the transfer takes more than
+    timeout seconds, or stalls for packet_timeout.  progress, if given,
+    is called with the number of bytes in order so far as they arrive.
+
+    size, the number of bytes the Band will send, is needed if they take
+    SEQUENCE_NUMBERS packets or more; otherwise the header's count is
+    used.  Raises SyncError if the header's count cannot be right."""
+
+    with pybt.deadline(timeout):
+        service = peripheral[UUID_SERVICE]
+        subscription = service[UUID_DATA].subscribe()
+        try:
+            service[UUID_CONTROL].write_no_confirm(bytearray([SEND_SENSOR_DATA]))
+
+            packet_size = pybt.max_payload(peripheral)
+            reassembler = Reassembler(sink, None if size is None else packet_count(size, packet_size), packet_size)
+            while not reassembler.complete:
+                try:
+                    reassembler.add(subscription.read(packet_timeout))
+                    if progress:
+                        progress(reassembler.length)
+                except pybt.TimeoutError:
+                    raise pybt.TimeoutError('sensor data stalled after %d packets, missing %s' % (
+                        reassembler.received, reassembler.missing()))
+            return reassembler
+        finally:
+            subscription.unsubscribe()
@@ -0,0 +1,365 @@
+"""Uploads verified sensor data to the ingest server, from a spool on disk.
+
+band_sync adds each verified transfer to a Spool, which only costs a
+local write, and carries on with the radio.  An Uploader's workers take
+the spooled transfers in batches, POST each batch to the ingest server
+over a keep-alive connection of their own, and remove them from the
+spool once the server has accepted them.  Transfers a run did not get to
+upload stay in the spool for the next run.
+
+A batch is POSTed as application/octet-stream, one record per transfer:
+
+    BATCH_RECORD    metadata length, data length, as '<II'
+    metadata        JSON
+    data
+
+    spool = Spool('spool')
+    uploader = Uploader('http://ingest.example.com/sensor-data', spool)
+    writer = spool.writer(band='Band')
+    reassembler = hello.band.sync.receive(peripheral, writer)
+    if reassembler.verified:
+        writer.commit(sha1=reassembler.sha1.hexdigest())
+    else:
+        writer.discard()
+    uploader.close(timeout=30)
+"""
+
+import json
+import logging as log
+import os
+import random
+import struct
+import threading
+import time
+import urlparse
+
+BATCH_RECORD = struct.Struct('<II')
+CONTENT_TYPE = 'application/octet-stream'
+
+# the server will not take these, however often they are sent
+REJECTED_STATUSES = (400, 403, 404, 413, 415, 422)
+
+class Spool(object):
+    """A directory of transfers waiting to be uploaded.  Each is a .dat
+    file of data and a .json file of metadata; both are written to a
+    temporary file, flushed to disk and renamed into place, the .json
+    last, so a transfer is either wholly spooled or not at all.  (A
+    crash can leave .tmp files behind, which are never uploaded.)
+
+    Workers claim() transfers, so that no two upload the same one, and
+    then remove() them once uploaded, or release() them to try again.
+    The server's refusals are reject()ed into the rejected directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rejected_path = os.path.join(path, 'rejected')
+        if not os.path.isdir(self.rejected_path):
+            os.makedirs(self.rejected_path)
+
+        self.condition = threading.Condition()
+        self.claimed = set()
+        self.closed = False
+        self.count = 0
+
+    def _name(self):
+        with self.condition:
+            self.count += 1
+            return '%.6f-%d-%d' % (time.time(), os.getpid(), self.count)
+
+    def writer(self, **metadata):
+        """A SpoolWriter to stream a transfer into the spool as it
+        arrives."""
+        return SpoolWriter(self, self._name(), metadata)
+
+    def add(self, data, **metadata):
+        """Spools data, and returns its name in the spool."""
+        with self.writer(**metadata) as writer:
+            writer.write(data)
+        return writer.name
+
+    def _committed(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def pending(self):
+        """The names of the spooled transfers, oldest first, including
+        the claimed ones."""
+        return sorted(entry[:-len('.json')] for entry in os.listdir(self.path) if entry.endswith('.json'))
+
+    def load(self, name):
+        """Returns the metadata and data of a spooled transfer."""
+        with open(os.path.join(self.path, name + '.json')) as file:
+            metadata = json.load(file)
+        with open(os.path.join(self.path, name + '.dat'), 'rb') as file:
+            data = file.read()
+        return metadata, data
+
+    def claim(self, count, timeout=None):
+        """Claims up to count unclaimed transfers, waiting up to timeout
+        seconds (None for ever) for there to be one, and returns their
+        names; none once the spool is closed.  Only transfers added in
+        this process wake a waiting claim."""
+
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.closed:
+                names = [name for name in self.pending() if name not in self.claimed][:count]
+                if names:
+                    self.claimed.update(names)
+                    return names
+                if deadline is None:
+                    self.condition.wait()
+                elif time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                else:
+                    break
+            return []
+
+    def release(self, names):
+        with self.condition:
+            self.claimed.difference_update(names)
+            self.condition.notify_all()
+
+    def _unlink(self, name, directory=None):
+        for extension in ('.json', '.dat'):
+            path = os.path.join(self.path, name + extension)
+            if not os.path.exists(path):
+                # e.g. a damaged transfer being rejected
+                continue
+            if directory is None:
+                os.remove(path)
+            else:
+                os.rename(path, os.path.join(directory, name + extension))
+
+    def remove(self, names):
+        for name in names:
+            self._unlink(name)
+        self.release(names)
+
+    def reject(self, names):
+        for name in names:
+            self._unlink(name, self.rejected_path)
+        self.release(names)
+
+    def wait_until_empty(self, timeout=None):
+        """Waits for every transfer to be uploaded or rejected, and
+        returns whether they were."""
+
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while self.pending():
+                if deadline is None:
+                    self.condition.wait()
+                elif time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                else:
+                    return False
+            return True
+
+    def close(self):
+        """Stops claim() handing out transfers, so workers wind down."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class SpoolWriter(object):
+    """A transfer on its way into a spool, which only appears there once
+    committed; the with statement commits it, unless it raises.  The
+    metadata has to be JSON-serializable; the data's length and the time
+    it was committed are added to it."""
+
+    def __init__(self, spool, name, metadata):
+        self.spool = spool
+        self.name = name
+        self.metadata = metadata
+        self.path = os.path.join(spool.path, name)
+        self.file = open(self.path + '.dat.tmp', 'wb')
+        self.length = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.length += len(data)
+
+    def _write_durably(self, file, extension):
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        os.rename(self.path + extension + '.tmp', self.path + extension)
+
+    def commit(self, **metadata):
+        """Spools the transfer, with metadata added to what it was given."""
+        self._write_durably(self.file, '.dat')
+        metadata = dict(self.metadata, length=self.length, spooled=time.time(), **metadata)
+        with open(self.path + '.json.tmp', 'w') as file:
+            file.write(json.dumps(metadata, sort_keys=True))
+            self._write_durably(file, '.json')
+        self.spool._committed()
+
+    def discard(self):
+        self.file.close()
+        # gone already if a commit() failed part way
+        if os.path.exists(self.path + '.dat.tmp'):
+            os.remove(self.path + '.dat.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+def encode_batch(records):
+    """The request body for (metadata, data) records."""
+    parts = []
+    for metadata, data in records:
+        encoded = json.dumps(metadata, sort_keys=True)
+        parts += [BATCH_RECORD.pack(len(encoded), len(data)), encoded, data]
+    return ''.join(parts)
+
+def decode_batch(body):
+    """The (metadata, data) records in a request body."""
+    records = []
+    offset = 0
+    while offset < len(body):
+        metadata_length, data_length = BATCH_RECORD.unpack_from(body, offset)
+        offset += BATCH_RECORD.size
+        metadata = json.loads(body[offset:offset+metadata_length])
+        offset += metadata_length
+        records.append((metadata, body[offset:offset+data_length]))
+        offset += data_length
+    return records
+
+class Uploader(object):
+    """Uploads a spool's transfers to url, on concurrency worker threads.
+
+    Each worker keeps its connection open between batches of up to
+    batch_size transfers.  A batch that fails, because the connection
+    did or the server answered with anything but 2xx, is retried after
+    backoff seconds, doubling with each failure in a row up to
+    max_backoff, with jitter so that workers do not retry in lockstep;
+    a batch the server refuses outright is rejected.
+    """
+
+    def __init__(self, url, spool, batch_size=16, concurrency=2, timeout=30.0, backoff=1.0, max_backoff=60.0):
+        self.url = urlparse.urlsplit(url)
+        if self.url.scheme not in ('http', 'https'):
+            raise ValueError('cannot upload to %s' % url)
+        self.spool = spool
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.uploaded = 0
+        self.rejected = 0
+        self.failures = 0
+        self.bytes_uploaded = 0
+
+        self.workers = [threading.Thread(target=self._work, name='uploader-%d' % i) for i in range(concurrency)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def _connect(self):
+        # httplib is imported here, where it is first needed, so that
+        # band_sync starts quickly without an ingest server
+        import httplib
+
+        connection_class = httplib.HTTPSConnection if self.url.scheme == 'https' else httplib.HTTPConnection
+        return connection_class(self.url.hostname, self.url.port, timeout=self.timeout)
+
+    def _post(self, connection, body):
+        path = self.url.path or '/'
+        if self.url.query:
+            path += '?' + self.url.query
+        connection.request('POST', path, body, {'Content-Type': CONTENT_TYPE})
+        response = connection.getresponse()
+        # what is left of a response holds up the connection's next request
+        response.read()
+        return response.status
+
+    def _load(self, names):
+        """The records of the transfers in names, less any that cannot be
+        read, which are rejected, as they would fail every batch."""
+
+        records = []
+        for name in list(names):
+            try:
+                records.append(self.spool.load(name))
+            except (IOError, OSError, ValueError) as e:
+                log.error('cannot read spooled transfer %s: %s' % (name, e))
+                names.remove(name)
+                self.spool.reject([name])
+                with self.lock:
+                    self.rejected += 1
+        return records
+
+    def _work(self):
+        connection = None
+        failures = 0
+        while True:
+            names = self.spool.claim(self.batch_size)
+            if not names:
+                break
+
+            records = self._load(names)
+            if not names:
+                continue
+            try:
+                connection = connection or self._connect()
+                status = self._post(connection, encode_batch(records))
+                error = 'HTTP %d' % status
+            except Exception as e:
+                # usually an HTTPException or socket.error; whatever it is,
+                # the batch is retried, and the worker carries on
+                status = None
+                error = e
+                if connection:
+                    connection.close()
+                connection = None
+
+            if status is not None and 200 <= status < 300:
+                self.spool.remove(names)
+                failures = 0
+                with self.lock:
+                    self.uploaded += len(names)
+                    self.bytes_uploaded += sum(len(data) for metadata, data in records)
+            elif status in REJECTED_STATUSES:
+                log.error('ingest server rejected %s: %s' % (', '.join(names), error))
+                self.spool.reject(names)
+                with self.lock:
+                    self.rejected += len(names)
+            else:
+                failures += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+                log.warning('uploading %d transfers failed (%s); retrying in %.1fs' % (len(names), error, delay))
+                with self.lock:
+                    self.failures += 1
+                # the batch stays claimed while backing off, so another
+                # worker does not go straight back to a failing server
+                self.stopping.wait(delay)
+                self.spool.release(names)
+
+        if connection:
+            connection.close()
+
+    def close(self, timeout=None):
+        """Waits up to timeout seconds (None for ever) for the spool to
+        empty, then stops the workers, and returns whether it emptied.
+        Whatever is left stays spooled."""
+
+        emptied = self.spool.wait_until_empty(timeout)
+        self.stopping.set()
+        self.spool.close()
+        for worker in self.workers:
+            worker.join()
+        return emptied
+
+    def __str__(self):
+        return '%d transfers (%d bytes) uploaded, %d rejected, %d failed attempts' % (
+            self.uploaded, self.bytes_uploaded, self.rejected, self.failures)
@@ -0,0 +1,466 @@
+import logging as log
+import Queue
+import struct
+import threading
+import time
+
+import hello.pybt as pybt
+
+uuid_dfu_service = '00001530-1212-EFDE-1523-785FEABCD123'
+uuid_dfu_control_state_characteristic = '00001531-1212-EFDE-1523-785FEABCD123'
+uuid_dfu_packet_characteristic = '00001532-1212-EFDE-1523-785FEABCD123'
+
+#
+
+# what every link can carry, and what the Nordic legacy bootloader, and
+# its PKT_RCPT_NOTIF counts, were written for
+PACKET_SIZE = 20
+# the packet_size for packets as large as the negotiated MTU allows, for
+# bootloaders known to take them
+MTU = 'mtu'
+
+def packet_size_argument(value):
+    """The argparse type of a --packet-size: bytes, or 'mtu'."""
+    return MTU if value == MTU else int(value)
+
+class OpCodes(object):
+    START_DFU = 1
+    INITIALIZE_DFU = 2
+    RECEIVE_FIRMWARE_IMAGE = 3
+    VALIDATE_FIRMWARE_IMAGE = 4
+    ACTIVATE_FIRMWARE_AND_RESET = 5
+    SYSTEM_RESET = 6
+    REPORT_RECEIVED_IMAGE_SIZE = 7
+    REQ_PKT_RCPT_NOTIF = 8
+    RESPONSE = 16
+    PKT_RCPT_NOTIF = 17
+
+op_codes = dict((value, key) for key, value in OpCodes.__dict__.items() if isinstance(value, int))
+
+STATUS_SUCCESS = 1
+STATUS_NOT_SUPPORTED = 3
+
+status_code_lookup = {
+    1: "SUCCESS",
+    2: "Invalid State",
+    3: "Not Supported",
+    4: "Data Size Exceeds Limit",
+    5: "CRC Error",
+    6: "Operation Failed"
+}
+
+def uint32_bytearray(value):
+    return bytearray(struct.pack('<I', value))
+
+def uint16_bytearray(value):
+    return bytearray(struct.pack('<H', value))
+
+def validate_dfu_response(data):
+    op_code = data[0]
+
+    if op_code == OpCodes.PKT_RCPT_NOTIF:
+        print('Received PKT_RCPT_NOTIF for %d bytes' % struct.unpack('<I', str(data[1:5])))
+    elif op_code == OpCodes.RESPONSE:
+        request_op_code = int(data[1])
+        request_op_code_text = op_codes.get(request_op_code, '(unknown op code)')
+
+        response_value = int(data[2])
+        response_text = status_code_lookup.get(response_value, '(unknown response value)')
+
+        print('Received response OpCode %s (%d): %s (%d)' % (
+            request_op_code_text,
+            request_op_code,
+            response_text,
+            response_value))
+    else:
+        dataText = ''
+        for c in data:
+            dataText += '%x' % c
+        print('Received unknown response (%s): %s' % (type(data), dataText))
+
+class DFUError(Exception):
+    pass
+
+# seconds to wait for a control point response before giving up on the
+# peripheral
+RESPONSE_TIMEOUT = 10.0
+
+#
+
+class TransferStats(object):
+    """Summary of one firmware transfer, as returned by
+    Session.send_firmware()."""
+
+    def __init__(self):
+        self.resumed_at = 0
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.packet_size = 0
+        self.bytes_acknowledged = 0
+        self.notifications = 0
+        self.stalls = 0
+        self.retries = 0
+        self.window = 0
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def bytes_per_second(self):
+        elapsed = self.elapsed
+        return self.bytes_sent / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return 'wrote %d bytes (%d packets of up to %d bytes) from offset %d in %.2fs: %.0f bytes/sec, %d notifications, %d stalls, %d retries, final window %d packets' % (
+            self.bytes_sent,
+            self.packets_sent,
+            self.packet_size,
+            self.resumed_at,
+            self.elapsed,
+            self.bytes_per_second,
+            self.notifications,
+            self.stalls,
+            self.retries,
+            self.window)
+
+class Session(object):
+    """Drives the DFU control point and packet characteristics of one
+    peripheral.
+
+    The control point is subscribed with a callback, so PKT_RCPT_NOTIF
+    notifications are consumed as they arrive instead of being read
+    synchronously between packets; everything else is queued for
+    read_response().
+    """
+
+    def __init__(self, control_point, packet, packet_size=PACKET_SIZE):
+        self.control_point = control_point
+        self.packet = packet
+        self.packet_size = packet_size
+
+        self.responses = Queue.Queue()
+        self.bytes_acknowledged = 0
+        self.notifications = 0
+        self.acknowledgements = []  # (bytes, time) since send_firmware() last looked
+        self.condition = threading.Condition()
+
+        self.subscription = control_point.subscribe(self._control_point_notified)
+
+    @classmethod
+    def from_peripheral(cls, peripheral, packet_size=None):
+        """A Session whose packets are packet_size bytes, PACKET_SIZE by
+        default, or with MTU, as large as the MTU negotiated with
+        peripheral allows; never larger than that."""
+
+        largest = pybt.max_payload(peripheral)
+        if packet_size == MTU:
+            packet_size = largest
+        dfu = peripheral[uuid_dfu_service]
+        return cls(dfu[uuid_dfu_control_state_characteristic], dfu[uuid_dfu_packet_characteristic],
+            min(largest, packet_size or PACKET_SIZE))
+
+    def _control_point_notified(self, characteristic, data):
+        if len(data) >= 5 and data[0] == OpCodes.PKT_RCPT_NOTIF:
+            with self.condition:
+                self.bytes_acknowledged = struct.unpack('<I', str(data[1:5]))[0]
+                self.notifications += 1
+                self.acknowledgements.append((self.bytes_acknowledged, time.time()))
+                self.condition.notify_all()
+        else:
+            self.responses.put(data)
+            with self.condition:
+                self.condition.notify_all()
+        return 0
+
+    def write_control(self, op_code, payload=None):
+        command = bytearray([op_code])
+        if payload is not None:
+            command += payload
+        return self.control_point.write_confirm(command)
+
+    def command(self, op_code, payload=None):
+        """Like write_control(), but raises DFUError if the write is not
+        confirmed."""
+        if not self.write_control(op_code, payload):
+            raise DFUError('could not write %s to DFU control point' % op_codes.get(op_code, op_code))
+
+    def write_packet(self, data):
+        return self.packet.write_no_confirm(data)
+
+    def read_response(self, timeout=None):
+        """Returns the next control point response that is not a
+        PKT_RCPT_NOTIF.  Raises DFUError if none arrives within timeout
+        seconds."""
+
+        try:
+            # Queue.get() without a timeout cannot be interrupted with ^C
+            return self.responses.get(True, timeout if timeout is not None else 2**31)
+        except Queue.Empty:
+            raise DFUError('no response from DFU control point after %.1fs' % timeout)
+
+    def expect_response(self, op_code, timeout=RESPONSE_TIMEOUT):
+        """Reads responses until the one for op_code arrives, and returns
+        it.  Raises DFUError if that or any other response reports a
+        failure."""
+
+        while True:
+            data = self.read_response(timeout)
+            if len(data) < 3 or data[0] != OpCodes.RESPONSE:
+                raise DFUError('unexpected control point notification %r' % data)
+            if data[2] != STATUS_SUCCESS:
+                raise DFUError('bootloader reported %s for %s' % (
+                    status_code_lookup.get(data[2], '(unknown response value)'),
+                    op_codes.get(data[1], '(unknown op code)')))
+            if data[1] == op_code:
+                return data
+            log.debug('skipping response for %s', op_codes.get(data[1], '(unknown op code)'))
+
+    def received_image_size(self, timeout=RESPONSE_TIMEOUT):
+        """Asks the bootloader how many bytes of the image it already has.
+        Returns None if it cannot say."""
+
+        self.write_control(OpCodes.REPORT_RECEIVED_IMAGE_SIZE)
+        try:
+            data = self.read_response(timeout)
+        except DFUError as e:
+            # bootloaders that do not know the op code may never answer
+            log.info('no received image size: %s', e)
+            return None
+        if len(data) < 7 or data[0] != OpCodes.RESPONSE or data[1] != OpCodes.REPORT_RECEIVED_IMAGE_SIZE or data[2] != STATUS_SUCCESS:
+            return None
+        return struct.unpack('<I', str(data[3:7]))[0]
+
+    def _pending_error(self):
+        # An error response while the image is streaming means the
+        # bootloader has given up on this transfer.
+        with self.responses.mutex:
+            for data in self.responses.queue:
+                if len(data) >= 3 and data[0] == OpCodes.RESPONSE and data[2] != STATUS_SUCCESS:
+                    return data
+        return None
+
+    def send_firmware(self, data, packet_notification_count=0, window=None, max_window=None,
+            lag_threshold=0.05, ack_timeout=10.0, packet_size=None, offset=0,
+            progress=None, acknowledged=None):
+        """Streams data, starting at offset, to the packet characteristic
+        in packets of packet_size bytes, by default the session's, and
+        returns a TransferStats.  progress(offset, size) is called after
+        every packet, and acknowledged(bytes) whenever a PKT_RCPT_NOTIF
+        arrives.
+
+        If packet_notification_count is nonzero, REQ_PKT_RCPT_NOTIF must
+        already have been written with the same value.  Up to window
+        packets are then kept in flight beyond the last acknowledged
+        byte.  Each PKT_RCPT_NOTIF gives a round trip time for the
+        packet it acknowledges: while round trips stay near the fastest
+        one seen, the window grows by one packet per notification; once
+        they exceed it by more than max(fastest, lag_threshold) seconds,
+        the bootloader is falling behind and the window is halved.  The
+        window never drops below packet_notification_count, since the
+        bootloader only notifies after that many packets.
+        """
+
+        if packet_size is None:
+            packet_size = self.packet_size
+
+        stats = TransferStats()
+        stats.resumed_at = offset
+        stats.packet_size = packet_size
+        size = len(data)
+
+        if packet_notification_count > 0:
+            min_window = packet_notification_count
+            if window is None:
+                window = 2 * packet_notification_count
+            if max_window is None:
+                max_window = 16 * packet_notification_count
+            window = max(min_window, min(window, max_window))
+        else:
+            window = min_window = max_window = 0
+        stats.window = window
+
+        with self.condition:
+            self.bytes_acknowledged = offset
+            self.notifications = 0
+            del self.acknowledgements[:]
+
+        sent_at = {}  # offset -> time, for offsets the bootloader will acknowledge
+        fastest_round_trip = None
+        recovery_offset = offset
+
+        while offset < size:
+            if window:
+                with self.condition:
+                    waited = 0.0
+                    while (offset - self.bytes_acknowledged) >= window * packet_size and not self._pending_error():
+                        if waited >= ack_timeout:
+                            raise DFUError('bootloader acknowledged %d of %d bytes sent, nothing for %.1fs' % (
+                                self.bytes_acknowledged, offset, waited))
+                        started_waiting = time.time()
+                        self.condition.wait(ack_timeout - waited)
+                        waited += time.time() - started_waiting
+
+                    acknowledgements = self.acknowledgements[:]
+                    del self.acknowledgements[:]
+                    stats.bytes_acknowledged = self.bytes_acknowledged
+                    stats.notifications = self.notifications
+
+                if acknowledgements and acknowledged:
+                    acknowledged(stats.bytes_acknowledged)
+
+                for bytes_acknowledged, received_at in acknowledgements:
+                    if bytes_acknowledged not in sent_at:
+                        continue
+                    round_trip = received_at - sent_at.pop(bytes_acknowledged)
+                    if fastest_round_trip is None or round_trip < fastest_round_trip:
+                        fastest_round_trip = round_trip
+
+                    if round_trip - fastest_round_trip > max(fastest_round_trip, lag_threshold):
+                        # packets sent before the last decrease are still
+                        # draining, so only react to lag once per window
+                        if bytes_acknowledged > recovery_offset:
+                            stats.stalls += 1
+                            window = max(min_window, window / 2)
+                            recovery_offset = offset
+                            log.debug('receipt lag of %.3fs at offset %d; window is now %d packets',
+                                round_trip - fastest_round_trip, bytes_acknowledged, window)
+                    else:
+                        window = min(max_window, window + 1)
+                stats.window = window
+
+            error = self._pending_error()
+            if error is not None:
+                raise DFUError('bootloader reported %s for %s during transfer at offset %d' % (
+                    status_code_lookup.get(error[2], '(unknown response value)'),
+                    op_codes.get(error[1], '(unknown op code)'),
+                    offset))
+
+            packet = data[offset:offset+packet_size]
+            if not self.write_packet(packet):
+                stats.retries += 1
+                window = max(min_window, window / 2)
+                recovery_offset = offset
+                if not self.write_packet(packet):
+                    raise DFUError('could not write packet at offset %d' % offset)
+
+            offset += len(packet)
+            stats.bytes_sent = offset - stats.resumed_at
+            stats.packets_sent += 1
+            if window and stats.packets_sent % packet_notification_count == 0:
+                sent_at[offset] = time.time()
+
+            if progress:
+                progress(offset, size)
+
+        stats.finished = time.time()
+        return stats
+
+    def unsubscribe(self):
+        self.subscription.unsubscribe()
+
+#
+
+class Phases(object):
+    STARTED = 'started'
+    RECEIVING = 'receiving'
+    RECEIVED = 'received'
+
+# seconds between checkpoint saves while the image is being sent
+CHECKPOINT_INTERVAL = 0.5
+
+def flash(peripheral, image, packet_notification_count=0, window=None, checkpoint=None, progress=None,
+        timeout=RESPONSE_TIMEOUT, packet_size=None):
+    """Sends image, a FirmwareImage, to the Band bootloader on
+    peripheral, validates and activates it, and returns the
+    TransferStats.
+
+    If checkpoint (a hello.dfu.checkpoint.Checkpoint) is given, the
+    protocol phase and PKT_RCPT_NOTIF byte counts are saved to it as the
+    transfer goes.  If it already records an unfinished transfer of the
+    same image and the bootloader can report how much of it has
+    arrived, sending resumes from there; otherwise it starts over.
+
+    Packets are packet_size bytes, by default PACKET_SIZE, or with MTU,
+    as large as the negotiated MTU allows; see Session.from_peripheral().
+
+    Raises DFUError if the bootloader fails the transfer or goes timeout
+    seconds without answering.
+    """
+
+    name = peripheral.name()
+    session = Session.from_peripheral(peripheral, packet_size)
+
+    try:
+        offset = None
+        if checkpoint is not None and checkpoint.phase == Phases.RECEIVING and checkpoint.matches(image):
+            offset = session.received_image_size(timeout)
+            if offset is None or offset > len(image):
+                log.info('%s: bootloader cannot resume, restarting DFU' % name)
+                offset = None
+            else:
+                log.info('%s: resuming DFU at %d bytes (checkpoint had %d acknowledged)' % (
+                    name, offset, checkpoint.bytes_acknowledged))
+
+        if offset is None:
+            offset = 0
+
+            session.command(OpCodes.START_DFU)
+            session.write_packet(uint32_bytearray(len(image)))
+            session.expect_response(OpCodes.START_DFU, timeout)
+            log.debug('%s: started DFU for %d bytes' % (name, len(image)))
+
+            session.command(OpCodes.INITIALIZE_DFU)
+            session.write_packet(bytearray(image.sha1.digest()))
+            log.debug('%s: sent SHA-1 %s' % (name, image.sha1.hexdigest()))
+
+            if checkpoint is not None:
+                checkpoint.update(image, Phases.STARTED, 0)
+
+        if packet_notification_count > 0:
+            session.command(OpCodes.REQ_PKT_RCPT_NOTIF, uint16_bytearray(packet_notification_count))
+        session.command(OpCodes.RECEIVE_FIRMWARE_IMAGE)
+
+        acknowledged = None
+        if checkpoint is not None:
+            checkpoint.update(image, Phases.RECEIVING, offset)
+
+            saved = [time.time()]
+            def acknowledged(bytes_acknowledged):
+                if time.time() - saved[0] >= CHECKPOINT_INTERVAL:
+                    checkpoint.update(bytes_acknowledged=bytes_acknowledged)
+                    saved[0] = time.time()
+
+        stats = session.send_firmware(
+            image,
+            packet_notification_count,
+            window=window,
+            ack_timeout=timeout,
+            offset=offset,
+            progress=progress,
+            acknowledged=acknowledged)
+        session.expect_response(OpCodes.RECEIVE_FIRMWARE_IMAGE, timeout)
+        log.info('%s: %s' % (name, stats))
+
+        if checkpoint is not None:
+            checkpoint.update(phase=Phases.RECEIVED, bytes_acknowledged=len(image))
+
+        session.command(OpCodes.VALIDATE_FIRMWARE_IMAGE)
+        session.expect_response(OpCodes.VALIDATE_FIRMWARE_IMAGE, timeout)
+        log.debug('%s: firmware validated' % name)
+
+        time.sleep(1)
+
+        session.command(OpCodes.ACTIVATE_FIRMWARE_AND_RESET)
+        log.info('%s: firmware activated' % name)
+
+        if checkpoint is not None:
+            checkpoint.remove()
+
+        return stats
+    finally:
+        if checkpoint is not None and checkpoint.phase == Phases.RECEIVING:
+            checkpoint.update(bytes_acknowledged=session.bytes_acknowledged)
+        session.unsubscribe()
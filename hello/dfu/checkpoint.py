@@ -0,0 +1,71 @@
+import json
+import logging as log
+import os
+
+class Checkpoint(object):
+    """How far a DFU transfer to one device got, kept in a small JSON
+    file so that an interrupted transfer can be resumed by a later run.
+
+    Every change is written straight to disk; the file is replaced
+    atomically, so a crash never leaves a half-written checkpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.image_sha1 = None
+        self.image_size = None
+        self.phase = None
+        self.bytes_acknowledged = 0
+
+    @classmethod
+    def load(cls, path):
+        """Returns the checkpoint saved at path, or an empty one if there
+        is none or it cannot be read."""
+
+        checkpoint = cls(path)
+        try:
+            with open(path) as file:
+                saved = json.load(file)
+            checkpoint.image_sha1 = saved['image_sha1']
+            checkpoint.image_size = saved['image_size']
+            checkpoint.phase = saved['phase']
+            checkpoint.bytes_acknowledged = saved['bytes_acknowledged']
+        except (IOError, ValueError, KeyError) as e:
+            if os.path.exists(path):
+                log.warning('ignoring unreadable DFU checkpoint %s: %s' % (path, e))
+            return cls(path)
+        return checkpoint
+
+    def matches(self, image):
+        return self.image_sha1 == image.sha1.hexdigest() and self.image_size == len(image)
+
+    def update(self, image=None, phase=None, bytes_acknowledged=None):
+        if image is not None:
+            self.image_sha1 = image.sha1.hexdigest()
+            self.image_size = len(image)
+        if phase is not None:
+            self.phase = phase
+        if bytes_acknowledged is not None:
+            self.bytes_acknowledged = bytes_acknowledged
+        self.save()
+
+    def save(self):
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({
+                'image_sha1': self.image_sha1,
+                'image_size': self.image_size,
+                'phase': self.phase,
+                'bytes_acknowledged': self.bytes_acknowledged,
+            }, file)
+            # on disk before the rename, or a power loss can leave an
+            # empty checkpoint in place of the last one
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(temporary_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.image_sha1 = self.image_size = self.phase = None
+        self.bytes_acknowledged = 0
@@ -0,0 +1,74 @@
+"""CRC-16/CCITT (polynomial 0x1021, initial value 0xffff, no reflection),
+which the Nordic bootloader uses to check a firmware image.
+
+    crc = CRC16()
+    for chunk in chunks:
+        crc.update(chunk)
+    crc.value
+
+update() hands anything with the buffer interface (bytearray, str,
+buffer, memoryview) to binascii.crc_hqx, which is the same table-driven
+CRC in C and beats the Python loop even for a single byte.  Anything
+else, e.g. a list of ints, goes through table_update().
+"""
+
+import binascii
+import struct
+
+POLYNOMIAL = 0x1021
+INITIAL_VALUE = 0xffff
+
+def _make_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for bit in range(8):
+            crc = (crc << 1) ^ POLYNOMIAL if crc & 0x8000 else crc << 1
+        table.append(crc & 0xffff)
+    return tuple(table)
+
+TABLE = _make_table()
+
+def table_update(crc, data):
+    """Returns crc extended by data, one table lookup per byte."""
+
+    table = TABLE
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xff00) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+def update(crc, data):
+    """Returns crc extended by data."""
+
+    try:
+        return binascii.crc_hqx(data, crc)
+    except TypeError:
+        return table_update(crc, data)
+
+def crc16(data):
+    return update(INITIAL_VALUE, data)
+
+class CRC16(object):
+    """Incremental CRC16, with an interface like hashlib's."""
+
+    digest_size = 2
+
+    def __init__(self, data=None):
+        self.value = INITIAL_VALUE
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self.value = update(self.value, data)
+
+    def copy(self):
+        other = CRC16()
+        other.value = self.value
+        return other
+
+    def digest(self):
+        """The CRC as INITIALIZE_DFU expects it: two bytes, little-endian."""
+        return struct.pack('<H', self.value)
+
+    def hexdigest(self):
+        return '%04x' % self.value
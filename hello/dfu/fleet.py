@@ -0,0 +1,159 @@
+import logging as log
+import Queue
+import threading
+import time
+
+import hello.dfu
+from hello.dfu.checkpoint import Checkpoint
+
+# how long a worker looks for a device before the attempt fails
+FIND_TIMEOUT = 30.0
+
+class DeviceResult(object):
+    """What happened to one device in a Fleet run."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.bytes_sent = 0
+        self.attempts = 0
+        self.stats = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    @property
+    def succeeded(self):
+        return self.done and self.error is None
+
+    def __str__(self):
+        if not self.done:
+            state = 'sent %d of %d bytes' % (self.bytes_sent, self.size)
+        elif self.error is not None:
+            state = 'FAILED after %d attempts: %s' % (self.attempts, self.error)
+        else:
+            state = 'done in %.1fs (%d attempts): %s' % (self.finished - self.started, self.attempts, self.stats)
+        return '%s: %s' % (self.name, state)
+
+class Fleet(object):
+    """Flashes the same image to many devices at once.
+
+    Up to jobs devices are updated concurrently, each by hello.dfu.flash()
+    on its own worker thread.  find_peripheral(name, timeout) is called
+    from the workers to look each device up, so a single scan started
+    beforehand (pybt.start_scan()) serves all of them; a device not found
+    within find_timeout seconds fails that attempt.  A device that fails is
+    retried up to retries more times, resuming from its checkpoint
+    where the bootloader allows; either way its failure does not hold up
+    the other devices.
+
+    If checkpoint_path(name) is given, each device's progress is saved
+    there, and with resume, a previous run's checkpoint is picked up.
+    """
+
+    def __init__(self, find_peripheral, image, jobs=4, retries=0, checkpoint_path=None, resume=False,
+            report_interval=5.0, find_timeout=FIND_TIMEOUT, **flash_options):
+        self.find_peripheral = find_peripheral
+        self.find_timeout = find_timeout
+        self.image = image
+        self.jobs = jobs
+        self.retries = retries
+        self.checkpoint_path = checkpoint_path
+        self.resume = resume
+        self.report_interval = report_interval
+        self.flash_options = flash_options
+
+        self.results = []
+        self.condition = threading.Condition()
+
+    def run(self, names):
+        """Flashes every device in names and returns a DeviceResult for
+        each, in the same order."""
+
+        self.results = [DeviceResult(name, len(self.image)) for name in names]
+        self.started = time.time()
+
+        pending = Queue.Queue()
+        for result in self.results:
+            pending.put(result)
+
+        workers = []
+        for i in range(min(self.jobs, len(self.results))):
+            worker = threading.Thread(target=self._work, args=(pending,), name='dfu-%d' % i)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        with self.condition:
+            while not all(result.done for result in self.results):
+                self.condition.wait(self.report_interval)
+                log.info(self.progress())
+
+        for worker in workers:
+            worker.join()
+
+        return self.results
+
+    def _work(self, pending):
+        while True:
+            try:
+                result = pending.get_nowait()
+            except Queue.Empty:
+                return
+            self._flash(result)
+            with self.condition:
+                result.finished = time.time()
+                self.condition.notify_all()
+
+    def _flash(self, result):
+        result.started = time.time()
+
+        checkpoint = None
+        if self.checkpoint_path:
+            path = self.checkpoint_path(result.name)
+            checkpoint = Checkpoint.load(path) if self.resume else Checkpoint(path)
+
+        def progress(sent, total):
+            result.bytes_sent = sent
+
+        while result.attempts <= self.retries:
+            result.attempts += 1
+            try:
+                peripheral = self.find_peripheral(result.name, self.find_timeout)
+                result.stats = hello.dfu.flash(
+                    peripheral,
+                    self.image,
+                    checkpoint=checkpoint,
+                    progress=progress,
+                    **self.flash_options)
+                result.error = None
+                return
+            except Exception as e:
+                log.warning('%s: attempt %d failed: %s' % (result.name, result.attempts, e))
+                result.error = e
+
+    def progress(self):
+        """A one-line summary of every device's progress."""
+
+        done = [result for result in self.results if result.done]
+        failed = [result for result in done if result.error is not None]
+        total = sum(result.size for result in self.results)
+        sent = sum(result.bytes_sent for result in self.results)
+        elapsed = time.time() - self.started
+
+        devices = ', '.join(
+            '%s %s' % (result.name, 'failed' if result in failed else '%d%%' % (100 * result.bytes_sent / max(1, result.size)))
+            for result in self.results if result.started)
+
+        return '%d of %d devices done (%d failed), %d of %d bytes sent at %.0f bytes/sec: %s' % (
+            len(done),
+            len(self.results),
+            len(failed),
+            sent,
+            total,
+            sent / elapsed if elapsed > 0 else 0.0,
+            devices)
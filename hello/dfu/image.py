@@ -0,0 +1,70 @@
+import hashlib
+import mmap
+import os
+
+from hello.dfu import PACKET_SIZE
+from hello.dfu.crc16 import CRC16
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+class FirmwareImage(object):
+    """A firmware .bin file, memory-mapped rather than read into memory.
+
+    Slicing an image returns a read-only buffer onto the mapping instead
+    of a copy, so it can be handed straight to Session.send_firmware().
+    The SHA-1 and CRC16 are computed together in one pass when the image
+    is opened.
+
+    (In Python 2, memoryview cannot wrap an mmap, so slices are buffer
+    objects.  Both are accepted by write_no_confirm, hashlib and
+    binascii.)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        # mmap refuses empty files
+        if self.size:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = ''
+
+        self.sha1 = hashlib.sha1()
+        self.crc16 = CRC16()
+        for offset in range(0, self.size, HASH_CHUNK_SIZE):
+            chunk = self.view(offset, HASH_CHUNK_SIZE)
+            self.sha1.update(chunk)
+            self.crc16.update(chunk)
+
+    def view(self, offset, length):
+        """Returns up to length bytes from offset without copying them."""
+        return buffer(self.data, offset, max(0, min(length, self.size - offset)))
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self.size)
+            if step != 1:
+                raise ValueError('FirmwareImage slices must be contiguous')
+            return self.view(start, stop - start)
+        return ord(self.data[item])
+
+    def packets(self, packet_size=PACKET_SIZE, offset=0):
+        """Yields (offset, packet) for every packet from offset on."""
+        for offset in range(offset, self.size, packet_size):
+            yield offset, self.view(offset, packet_size)
+
+    def close(self):
+        if self.size:
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,228 @@
+"""A bootloader that speaks the DFU protocol in OpCodes, without a radio.
+
+    bootloader = SimulatedBootloader(latency=0.05, packet_interval=0.001)
+    session = hello.dfu.Session.from_peripheral(bootloader.peripheral)
+
+bootloader.peripheral is a hello.pybt.simulated peripheral, so DFU code
+can also find it by name once it is added with
+hello.pybt.simulated.add_peripheral().
+"""
+
+import hashlib
+import Queue
+import random
+import struct
+import threading
+import time
+
+import hello.dfu as dfu
+from hello.dfu import OpCodes
+from hello.dfu.crc16 import crc16
+from hello.pybt.simulated import SimulatedCharacteristic, SimulatedPeripheral, SimulatedService
+
+class SimulatedBootloader(object):
+    """Accepts a firmware image the way the Nordic bootloader does.
+
+    latency is the one-way delay, in seconds, before each response or
+    PKT_RCPT_NOTIF reaches the central.  packet_interval is how long the
+    bootloader spends on every packet it receives, so a sender that
+    outruns it will see PKT_RCPT_NOTIF lag behind.  If fail_at is given,
+    the bootloader aborts RECEIVE_FIRMWARE_IMAGE with "Operation Failed"
+    once that many bytes have arrived.
+
+    Each packet written disconnects the link with probability
+    disconnect_probability.  While disconnected, writes fail and
+    notifications are lost until reconnect() is called.  A resumable
+    bootloader keeps the partial image across the disconnect and answers
+    REPORT_RECEIVED_IMAGE_SIZE; otherwise it starts from scratch and
+    replies "Not Supported".
+
+    link is the hello.pybt.simulated.Link to the central, if the radio
+    should be modelled too.
+    """
+
+    def __init__(self, name='Band (DFU Mode)', latency=0.0, packet_interval=0.0, fail_at=None,
+            resumable=False, disconnect_probability=0.0, seed=None, link=None):
+        self.latency = latency
+        self.packet_interval = packet_interval
+        self.fail_at = fail_at
+        self.resumable = resumable
+        self.disconnect_probability = disconnect_probability
+        self.random = random.Random(seed)
+
+        self.connected = True
+        self.disconnected = threading.Event()
+        self.disconnections = 0
+
+        self.control_point = SimulatedCharacteristic(dfu.uuid_dfu_control_state_characteristic, self._control_point_written)
+        self.packet = SimulatedCharacteristic(dfu.uuid_dfu_packet_characteristic, self._packet_written)
+        self.peripheral = SimulatedPeripheral(name, [
+            SimulatedService(dfu.uuid_dfu_service, [self.control_point, self.packet])], link)
+
+        self.activated = threading.Event()
+        self._reset()
+
+        # Writes are processed in order on one thread, as the bootloader
+        # would; notifications are delivered on another after latency.
+        self._writes = Queue.Queue()
+        self._notifications = Queue.Queue()
+        for target in (self._process_writes, self._deliver_notifications):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        """Stops the bootloader's threads."""
+        self._writes.put((None, None, None))
+        self._notifications.put((None, None))
+
+    def _reset(self):
+        self.state = None
+        self.image_size = None
+        self.init_data = None
+        self.image = bytearray()
+        self.packet_notification_count = 0
+        self.packets_since_notification = 0
+
+    # radio
+
+    def disconnect(self):
+        """Drops the link once the writes already sent have been
+        processed."""
+        self.connected = False
+        self._writes.put((self._handle_disconnect, None, None))
+
+    def reconnect(self):
+        self.disconnected.wait(2**31)
+        self.disconnected.clear()
+        self.connected = True
+
+    def _control_point_written(self, data, confirm):
+        if not self.connected:
+            return False
+        done = threading.Event()
+        self._writes.put((self._handle_control_point, data, done))
+        if confirm:
+            done.wait(2**31)
+        return True
+
+    def _packet_written(self, data, confirm):
+        if not self.connected:
+            return False
+        self._writes.put((self._handle_packet, data, None))
+        if self.disconnect_probability and self.random.random() < self.disconnect_probability:
+            self.disconnect()
+        return True
+
+    def _process_writes(self):
+        while True:
+            handler, data, done = self._writes.get()
+            if handler is None:
+                return
+            handler(data)
+            if done:
+                done.set()
+
+    def _deliver_notifications(self):
+        while True:
+            due, data = self._notifications.get()
+            if data is None:
+                return
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if self.connected:
+                self.control_point.notify(data)
+
+    def _notify(self, data):
+        self._notifications.put((time.time() + self.latency, data))
+
+    def _respond(self, op_code, status):
+        self._notify(bytearray([OpCodes.RESPONSE, op_code, status]))
+
+    def _handle_disconnect(self, data):
+        self.disconnections += 1
+        del self.control_point.subscriptions[:]
+        if not self.resumable:
+            self._reset()
+        self.disconnected.set()
+
+    # protocol
+
+    def _handle_control_point(self, data):
+        op_code = data[0]
+
+        if op_code == OpCodes.START_DFU:
+            self.state = op_code
+            self.image = bytearray()
+        elif op_code == OpCodes.INITIALIZE_DFU:
+            self.state = op_code
+        elif op_code == OpCodes.REPORT_RECEIVED_IMAGE_SIZE:
+            if self.resumable and self.image_size is not None:
+                self._notify(bytearray([OpCodes.RESPONSE, op_code, dfu.STATUS_SUCCESS]) + dfu.uint32_bytearray(len(self.image)))
+            else:
+                self._respond(op_code, dfu.STATUS_NOT_SUPPORTED)
+        elif op_code == OpCodes.REQ_PKT_RCPT_NOTIF:
+            self.packet_notification_count = struct.unpack('<H', str(data[1:3]))[0]
+            self.packets_since_notification = 0
+        elif op_code == OpCodes.RECEIVE_FIRMWARE_IMAGE:
+            if self.image_size is None:
+                self._respond(op_code, 2)
+            elif len(self.image) == self.image_size:
+                self.state = OpCodes.VALIDATE_FIRMWARE_IMAGE
+                self._respond(op_code, dfu.STATUS_SUCCESS)
+            else:
+                self.state = op_code
+        elif op_code == OpCodes.VALIDATE_FIRMWARE_IMAGE:
+            if self.state != OpCodes.VALIDATE_FIRMWARE_IMAGE:
+                self._respond(op_code, 2)
+            else:
+                self._respond(op_code, dfu.STATUS_SUCCESS if self.image_is_valid() else 5)
+        elif op_code == OpCodes.ACTIVATE_FIRMWARE_AND_RESET:
+            self.state = op_code
+            self.activated.set()
+        elif op_code == OpCodes.SYSTEM_RESET:
+            self._reset()
+        else:
+            self._respond(op_code, dfu.STATUS_NOT_SUPPORTED)
+
+    def _handle_packet(self, data):
+        if self.packet_interval:
+            time.sleep(self.packet_interval)
+
+        if self.state == OpCodes.START_DFU:
+            self.image_size = struct.unpack('<I', str(data[0:4]))[0]
+            self.state = None
+            self._respond(OpCodes.START_DFU, dfu.STATUS_SUCCESS)
+        elif self.state == OpCodes.INITIALIZE_DFU:
+            self.init_data = data
+            self.state = None
+            self._respond(OpCodes.INITIALIZE_DFU, dfu.STATUS_SUCCESS)
+        elif self.state == OpCodes.RECEIVE_FIRMWARE_IMAGE:
+            self.image += data
+            received = len(self.image)
+
+            if self.fail_at is not None and received >= self.fail_at:
+                self.state = None
+                self._respond(OpCodes.RECEIVE_FIRMWARE_IMAGE, 6)
+            elif received > self.image_size:
+                self.state = None
+                self._respond(OpCodes.RECEIVE_FIRMWARE_IMAGE, 4)
+            elif received == self.image_size:
+                self.state = OpCodes.VALIDATE_FIRMWARE_IMAGE
+                self._respond(OpCodes.RECEIVE_FIRMWARE_IMAGE, dfu.STATUS_SUCCESS)
+            elif self.packet_notification_count:
+                self.packets_since_notification += 1
+                if self.packets_since_notification == self.packet_notification_count:
+                    self.packets_since_notification = 0
+                    self._notify(bytearray([OpCodes.PKT_RCPT_NOTIF]) + dfu.uint32_bytearray(received))
+
+    def image_is_valid(self):
+        """Checks the received image against the INITIALIZE_DFU data,
+        which is either a CRC16 (pill) or a SHA-1 (Band)."""
+
+        if self.init_data is None or len(self.image) != self.image_size:
+            return False
+        if len(self.init_data) == 2:
+            return struct.unpack('<H', str(self.init_data))[0] == crc16(self.image)
+        return str(self.init_data) == hashlib.sha1(str(self.image)).digest()
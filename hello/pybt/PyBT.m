@@ -51,36 +51,90 @@
 
 //
 
+// Timeouts: the blocking functions below take a timeout in seconds, and a
+// negative one waits forever.  When it runs out they return nil (or
+// HEWriteTimedOut), and either way they remove the notification observers
+// they added.
+
+static NSDate* deadline_for_timeout(double timeout)
+{
+    return timeout < 0 ? nil : [NSDate dateWithTimeIntervalSinceNow:timeout];
+}
+
+// Waits on condition, which must be locked, until done() or deadline; a nil
+// deadline waits forever.  Returns done().
+static BOOL wait_until(NSCondition* condition, NSDate* deadline, BOOL (^done)(void))
+{
+    while(!done()) {
+        if(!deadline) {
+            [condition wait];
+        } else if(![condition waitUntilDate:deadline]) {
+            return done();
+        }
+    }
+    return YES;
+}
+
+//
+
 typedef int (*SubscriberCallback)(CBCharacteristic*, NSData*);
 
+// What a subscription does with a notification when its queue is full; the
+// order matches POLICIES in hello/pybt/ringbuffer.py.
+typedef enum {
+    HEOverflowBlock,        // wait up to blockTimeout for room, then drop it
+    HEOverflowDropOldest,   // drop the oldest queued notification
+    HEOverflowDropNewest,   // drop the new notification
+} HEOverflowPolicy;
+
 @interface HEBluetoothShellDelegateSubscription : NSObject
 
 @property (nonatomic) CBCharacteristic* characteristic;
-@property (nonatomic) NSCondition* condition;
+@property (nonatomic) NSCondition* condition; /* guards everything below */
 @property (nonatomic) id observer;
-@property (nonatomic) NSMutableArray* dataQueue;
 @property (nonatomic) SubscriberCallback callback;
 
+// A ring buffer of queued notifications: ring[head] is the oldest, and the
+// queue wraps around the end of ring.  ring's slots never move, so
+// enqueueing and dequeueing are O(1).
+@property (nonatomic) NSMutableArray* ring;
+@property (nonatomic) NSUInteger head;
+@property (nonatomic) NSUInteger count;
+@property (nonatomic) HEOverflowPolicy overflowPolicy;
+@property (nonatomic) NSTimeInterval blockTimeout;
+
+@property (nonatomic) NSUInteger highWaterMark;
+@property (nonatomic) NSUInteger received;
+@property (nonatomic) NSUInteger dropped;
+@property (nonatomic) NSUInteger blocked;
+
 @end
 
 //
 
 @implementation HEBluetoothShellDelegateSubscription
 
-- (id)initWithCharacteristic:(CBCharacteristic*)characteristic callback:(SubscriberCallback)callback
+// Returns nil if the peripheral does not confirm the subscription by
+// deadline.
+- (id)initWithCharacteristic:(CBCharacteristic*)characteristic callback:(SubscriberCallback)callback capacity:(NSUInteger)capacity overflowPolicy:(HEOverflowPolicy)overflowPolicy blockTimeout:(NSTimeInterval)blockTimeout untilDate:(NSDate*)deadline
 {
     self = [super init];
     if(!self) {
         return nil;
     }
     
-    self.dataQueue = [NSMutableArray array];
-    
+    self.characteristic = characteristic;
     self.callback = callback;
     
+    self.ring = [NSMutableArray arrayWithCapacity:MAX(capacity, 1)];
+    for(NSUInteger i = 0; i < MAX(capacity, 1); i++) {
+        [self.ring addObject:[NSNull null]];
+    }
+    self.overflowPolicy = overflowPolicy;
+    self.blockTimeout = blockTimeout;
+    
     self.condition = [[NSCondition alloc] init];
     [self.condition setName:[NSString stringWithFormat:@"%@", characteristic.UUID]];
-    [self.condition lock];
     
     self.observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidReadCharacteristic" object:characteristic queue:nil usingBlock:^(NSNotification* note) {
         NSData* data = note.userInfo[@"data"];
@@ -88,31 +142,40 @@ typedef int (*SubscriberCallback)(CBCharacteristic*, NSData*);
         if(callback) {
             callback(characteristic, data);
         } else {
-            [self.dataQueue addObject:data];
+            [self enqueue:data];
         }
-        
-        [self broadcast];
     }];
     
     NSCondition* condition = [[NSCondition alloc] init];
 
     __block BOOL receivedNotification = NO;
-    __block id observer = [[NSNotificationCenter defaultCenter]addObserverForName:@"HEBluetoothShellDelegateDidUpdateNotificationStateForCharacteristic" object:characteristic queue:Nil usingBlock:^(NSNotification* note) {
+    id observer = [[NSNotificationCenter defaultCenter]addObserverForName:@"HEBluetoothShellDelegateDidUpdateNotificationStateForCharacteristic" object:characteristic queue:Nil usingBlock:^(NSNotification* note) {
+        [condition lock];
         receivedNotification = YES;
         [condition broadcast];
-        [[NSNotificationCenter defaultCenter] removeObserver:observer];
+        [condition unlock];
     }];
     
     [condition lock];
     [[[characteristic service] peripheral] setNotifyValue:YES forCharacteristic:characteristic];
-    while(!receivedNotification) {
-        [condition wait];
-    }
+    BOOL subscribed = wait_until(condition, deadline, ^BOOL{ return receivedNotification; });
     [condition unlock];
     
+    [[NSNotificationCenter defaultCenter] removeObserver:observer];
+    
+    if(!subscribed) {
+        [self unsubscribe];
+        return nil;
+    }
+    
     return self;
 }
 
+- (id)initWithCharacteristic:(CBCharacteristic*)characteristic callback:(SubscriberCallback)callback
+{
+    return [self initWithCharacteristic:characteristic callback:callback capacity:16384 overflowPolicy:HEOverflowDropOldest blockTimeout:0.1 untilDate:nil];
+}
+
 - (void)unsubscribe
 {
     [[[self.characteristic service] peripheral] setNotifyValue:NO forCharacteristic:self.characteristic];
@@ -122,32 +185,143 @@ typedef int (*SubscriberCallback)(CBCharacteristic*, NSData*);
 
 - (void)broadcast
 {
+    [self.condition lock];
     [self.condition broadcast];
+    [self.condition unlock];
 }
 
-- (NSData*)_read
+// Called on the Bluetooth queue for every notification.
+- (void)enqueue:(NSData*)data
 {
-    if(self.callback) {
-        @throw [NSException exceptionWithName:@"HEBluetoothShellDelegateSubscriptionWaitCalledForAsynchronousCallback" reason:[NSString stringWithFormat:@"You have called %s, but have also specified a callback. Either (1) do not specify a callback (synchronous behaviour), and call %s to retrieve the next value, or (2) specify a callback and do not use %s.", __func__, __func__, __func__] userInfo:nil];
+    [self.condition lock];
+    
+    NSUInteger capacity = [self.ring count];
+    self.received++;
+    
+    if(self.count == capacity && self.overflowPolicy == HEOverflowBlock) {
+        self.blocked++;
+        NSDate* deadline = [NSDate dateWithTimeIntervalSinceNow:self.blockTimeout];
+        while(self.count == capacity && [self.condition waitUntilDate:deadline]) {
+        }
     }
     
-    if([self.dataQueue count] > 0) {
-        NSData* data = [self.dataQueue objectAtIndex:0];
-        [self.dataQueue removeObjectAtIndex:0];
-        
-        return data;
+    if(self.count == capacity) {
+        if(self.dropped++ == 0) {
+            NSLog(@"subscription to %@: queue of %lu notifications is full; dropping some", self.characteristic.UUID, (unsigned long)capacity);
+        }
+        if(self.overflowPolicy != HEOverflowDropOldest) {
+            [self.condition unlock];
+            return;
+        }
+        self.ring[self.head] = [NSNull null];
+        self.head = (self.head + 1) % capacity;
+        self.count--;
     }
     
-    while([self.dataQueue count] == 0) {
-        [self.condition wait];
+    self.ring[(self.head + self.count) % capacity] = data ?: [NSData data];
+    self.count++;
+    self.highWaterMark = MAX(self.highWaterMark, self.count);
+    
+    [self.condition broadcast];
+    [self.condition unlock];
+}
+
+// Takes the oldest notification.  The condition must be locked, and the
+// queue not empty.
+- (NSData*)dequeue
+{
+    NSData* data = self.ring[self.head];
+    self.ring[self.head] = [NSNull null];
+    self.head = (self.head + 1) % [self.ring count];
+    self.count--;
+    
+    // there is room now, for a producer that is blocked
+    [self.condition broadcast];
+    
+    return data;
+}
+
+- (void)checkNoCallback:(const char*)function
+{
+    if(self.callback) {
+        @throw [NSException exceptionWithName:@"HEBluetoothShellDelegateSubscriptionWaitCalledForAsynchronousCallback" reason:[NSString stringWithFormat:@"You have called %s, but have also specified a callback. Either (1) do not specify a callback (synchronous behaviour), and call %s to retrieve the next value, or (2) specify a callback and do not use %s.", function, function, function] userInfo:nil];
     }
+}
+
+- (NSData*)_read
+{
+    [self checkNoCallback:__func__];
     
-    NSData* data = [self.dataQueue objectAtIndex:0];
-    [self.dataQueue removeObjectAtIndex:0];
+    [self.condition lock];
+    [self waitForDataUntilDate:nil];
+    NSData* data = [self dequeue];
+    [self.condition unlock];
     
     return data;
 }
 
+// Waits until something is queued, or until deadline if it is not nil.
+// The condition must be locked.
+- (BOOL)waitForDataUntilDate:(NSDate*)deadline
+{
+    return wait_until(self.condition, deadline, ^BOOL{ return self.count > 0; });
+}
+
+// Takes up to count queued notifications at once: the first may be waited
+// for, the rest must already be queued.
+- (NSArray*)_readMany:(NSUInteger)count untilDate:(NSDate*)deadline
+{
+    [self checkNoCallback:__func__];
+    
+    [self.condition lock];
+    
+    NSMutableArray* packets = [NSMutableArray array];
+    if([self waitForDataUntilDate:deadline]) {
+        while([packets count] < count && self.count > 0) {
+            [packets addObject:[self dequeue]];
+        }
+    }
+    
+    [self.condition unlock];
+    
+    return packets;
+}
+
+// Copies queued notifications back to back into buffer, and returns how
+// many bytes it copied.  A notification that does not fit is split, and
+// the rest of it stays at the head of the queue.
+- (NSUInteger)_readInto:(void*)buffer length:(NSUInteger)length untilDate:(NSDate*)deadline
+{
+    [self checkNoCallback:__func__];
+    
+    if(length == 0) {
+        return 0;
+    }
+    
+    [self.condition lock];
+    
+    NSUInteger copied = 0;
+    
+    if([self waitForDataUntilDate:deadline]) {
+        while(copied < length && self.count > 0) {
+            NSData* data = self.ring[self.head];
+            NSUInteger n = MIN([data length], length - copied);
+            memcpy((char*)buffer + copied, [data bytes], n);
+            copied += n;
+            
+            if(n < [data length]) {
+                self.ring[self.head] = [data subdataWithRange:NSMakeRange(n, [data length] - n)];
+                break;
+            }
+            [self dequeue];
+        }
+    }
+    
+    [self.condition unlock];
+    
+    return copied;
+}
+
 @end
 
 //
@@ -159,11 +333,67 @@ typedef int (*SubscriberCallback)(CBCharacteristic*, NSData*);
 @property (nonatomic) NSMutableSet* connectedPeripherals;
 @property (nonatomic) dispatch_queue_t bluetoothQueue;
 @property (nonatomic) NSMapTable* subscriptions; /* CBCharacteristic -> HEBluetoothShellDelegateSubscription */
+@property (nonatomic) NSMutableDictionary* discoveryPlans; /* peripheral identifier -> service UUID -> characteristic UUID -> NSArray of descriptor UUIDs */
+@property (nonatomic) NSMutableDictionary* advertisements; /* peripheral identifier -> the latest scan result for it; see scan_result() */
+@property (nonatomic) NSArray* scanServiceUUIDs; /* CBUUIDs the central scans for, or nil for all */
 
 @end
 
 //
 
+// Discovery plans come from hello.pybt.gattcache: when a peripheral has
+// one, only the services, characteristics and descriptors it lists are
+// discovered on connection, which takes far fewer round trips than
+// discovering everything.
+
+NSString* peripheral_identifier(CBPeripheral* peripheral)
+{
+    if([peripheral respondsToSelector:@selector(identifier)]) {
+        return [[peripheral identifier] UUIDString];
+    }
+    
+    // OS X 10.8
+    CFUUIDRef UUID = peripheral.UUID;
+    return UUID ? CFBridgingRelease(CFUUIDCreateString(NULL, UUID)) : nil;
+}
+
+// The most bytes a write without response can carry at the MTU negotiated
+// with peripheral, which is as many as a notification can; 0 before OS X
+// 10.12, which does not say.
+unsigned long peripheral_maximum_write_length(CBPeripheral* peripheral)
+{
+    if(![peripheral respondsToSelector:@selector(maximumWriteValueLengthForType:)]) {
+        return 0;
+    }
+    return [peripheral maximumWriteValueLengthForType:CBCharacteristicWriteWithoutResponse];
+}
+
+static NSArray* plan_UUIDs(NSDictionary* plan)
+{
+    NSMutableArray* UUIDs = [NSMutableArray array];
+    for(NSString* UUIDString in plan) {
+        [UUIDs addObject:[CBUUID UUIDWithString:UUIDString]];
+    }
+    return UUIDs;
+}
+
+static id plan_entry(NSDictionary* plan, CBUUID* UUID)
+{
+    for(NSString* UUIDString in plan) {
+        if([[CBUUID UUIDWithString:UUIDString] isEqual:UUID]) {
+            return plan[UUIDString];
+        }
+    }
+    return nil;
+}
+
+// What the delegate remembers of a peripheral's latest advertisement, and
+// what scan_next() returns.
+static NSDictionary* scan_result(CBPeripheral* peripheral, NSString* identifier, NSDictionary* advertisementData, NSNumber* RSSI)
+{
+    return @{@"peripheral": peripheral, @"identifier": identifier, @"advertisementData": advertisementData, @"RSSI": RSSI};
+}
+
 @implementation HEBluetoothShellDelegate
 
 static HEBluetoothShellDelegate* delegate = nil;
@@ -189,21 +419,42 @@ static HEBluetoothShellDelegate* delegate = nil;
     self.connectedPeripherals = [NSMutableSet set];
     self.bluetoothQueue = dispatch_queue_create("com.hello.HEBluetoothShellCommands.bluetoothQueue", NULL);
     self.subscriptions = [NSMapTable strongToStrongObjectsMapTable];
+    self.discoveryPlans = [NSMutableDictionary dictionary];
+    self.advertisements = [NSMutableDictionary dictionary];
     
     return self;
 }
 
+- (NSDictionary*)discoveryPlanForPeripheral:(CBPeripheral*)peripheral
+{
+    NSString* identifier = peripheral_identifier(peripheral);
+    if(!identifier) {
+        return nil;
+    }
+    
+    @synchronized(self.discoveryPlans) {
+        return self.discoveryPlans[identifier];
+    }
+}
+
 #pragma mark CBCentralManagerDelegate methods
 
 - (void)centralManagerDidUpdateState:(CBCentralManager *)central
 {
     NSAssert(central.state == CBCentralManagerStatePoweredOn, @"CBCentralManagerState did not switch to On state");
     
-    [central scanForPeripheralsWithServices:nil options:nil];
+    [central scanForPeripheralsWithServices:self.scanServiceUUIDs options:nil];
 }
 
 - (void)centralManager:(CBCentralManager *)central didDiscoverPeripheral:(CBPeripheral *)peripheral advertisementData:(NSDictionary *)advertisementData RSSI:(NSNumber *)RSSI
 {
+    NSString* identifier = peripheral_identifier(peripheral);
+    if(identifier) {
+        @synchronized(self.advertisements) {
+            self.advertisements[identifier] = scan_result(peripheral, identifier, advertisementData, RSSI);
+        }
+    }
+    
     if([self.peripherals containsObject:peripheral]) {
         return;
     }
@@ -220,7 +471,8 @@ static HEBluetoothShellDelegate* delegate = nil;
     
     peripheral.delegate = self;
     
-    [peripheral discoverServices:nil];
+    NSDictionary* plan = [self discoveryPlanForPeripheral:peripheral];
+    [peripheral discoverServices:plan ? plan_UUIDs(plan) : nil];
 }
 
 - (void)centralManager:(CBCentralManager *)central didDisconnectPeripheral:(CBPeripheral *)peripheral error:(NSError *)error
@@ -251,9 +503,12 @@ static HEBluetoothShellDelegate* delegate = nil;
         NSLog(@"%s: %@", __func__, error);
     }
 
+    NSDictionary* plan = [self discoveryPlanForPeripheral:peripheral];
+    
     for(CBService* service in peripheral.services) {
         [[NSNotificationCenter defaultCenter] postNotificationName:@"HEBluetoothShellDelegateDidDiscoverService" object:peripheral userInfo:@{@"service": service, @"error": error ? error : [NSNull null]}];
-        [peripheral discoverCharacteristics:nil forService:service];
+        NSDictionary* characteristicsPlan = plan ? plan_entry(plan, service.UUID) : nil;
+        [peripheral discoverCharacteristics:characteristicsPlan ? plan_UUIDs(characteristicsPlan) : nil forService:service];
     }
 }
 
@@ -263,9 +518,16 @@ static HEBluetoothShellDelegate* delegate = nil;
         NSLog(@"%s: %@", __func__, error);
     }
     
+    NSDictionary* plan = [self discoveryPlanForPeripheral:peripheral];
+    NSDictionary* characteristicsPlan = plan ? plan_entry(plan, service.UUID) : nil;
+    
     for(CBCharacteristic* characteristic in service.characteristics) {
         [[NSNotificationCenter defaultCenter] postNotificationName:@"HEBluetoothShellDelegateDidDiscoverCharacteristic" object:service userInfo:@{@"characteristic": characteristic, @"error": error ? error : [NSNull null]}];
-        [peripheral discoverDescriptorsForCharacteristic:characteristic];
+        
+        // a planned characteristic without descriptors needs no round trip for them
+        if(!characteristicsPlan || [plan_entry(characteristicsPlan, characteristic.UUID) count] > 0) {
+            [peripheral discoverDescriptorsForCharacteristic:characteristic];
+        }
     }
 }
 
@@ -296,6 +558,11 @@ static HEBluetoothShellDelegate* delegate = nil;
     [[NSNotificationCenter defaultCenter] postNotificationName:@"HEBluetoothShellDelegateDidWriteCharacteristic" object:characteristic userInfo:@{@"error": error ? error : [NSNull null]}];
 }
 
+- (void)peripheralIsReadyToSendWriteWithoutResponse:(CBPeripheral *)peripheral
+{
+    [[NSNotificationCenter defaultCenter] postNotificationName:@"HEBluetoothShellDelegateIsReadyToSendWriteWithoutResponse" object:peripheral];
+}
+
 - (void)peripheral:(CBPeripheral *)peripheral didDiscoverDescriptorsForCharacteristic:(CBCharacteristic *)characteristic error:(NSError *)error
 {
     if(error) {
@@ -318,10 +585,11 @@ static HEBluetoothShellDelegate* delegate = nil;
 
 //
 
-void start_scan()
+void start_scan(NSArray* serviceUUIDs)
 {
     [HEBluetoothShellDelegate initialize];
     
+    delegate.scanServiceUUIDs = serviceUUIDs;
     [delegate startScan];
 }
 
@@ -342,12 +610,15 @@ void disconnect_all_peripherals()
     NSCondition* condition = [[NSCondition alloc] init];
 
     id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDisconnectPeripheral" object:delegate.central queue:nil usingBlock:^(NSNotification* note) {
+        [condition lock];
         [condition broadcast];
+        [condition unlock];
     }];
     
     [condition lock];
-    while([delegate.connectedPeripherals count] > 0) {
-        [condition wait];
+    // a peripheral that has gone away may never confirm
+    if(!wait_until(condition, deadline_for_timeout(5.0), ^BOOL{ return [delegate.connectedPeripherals count] == 0; })) {
+        NSLog(@"stop_scan(): %lu peripherals did not disconnect in time", (unsigned long)[delegate.connectedPeripherals count]);
     }
     [condition unlock];
     
@@ -361,7 +632,7 @@ void stop_scan()
     disconnect_all_peripherals();
 }
 
-CBPeripheral* find_peripheral_by_name(const char* const name)
+CBPeripheral* find_peripheral_by_name(const char* const name, double timeout)
 {
     NSString* wantedName = [NSString stringWithUTF8String:name];
     
@@ -373,30 +644,31 @@ CBPeripheral* find_peripheral_by_name(const char* const name)
        
     __block CBPeripheral* peripheral = nil;
     
-    __block id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDiscoverPeripheral" object:delegate.central queue:nil usingBlock:^(NSNotification* note) {
+    id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDiscoverPeripheral" object:delegate.central queue:nil usingBlock:^(NSNotification* note) {
         CBPeripheral* newPeripheral = note.userInfo[@"peripheral"];
         if(!predicate(newPeripheral)) {
             return;
         }
         
+        [condition lock];
         peripheral = newPeripheral;
         [condition broadcast];
-        [[NSNotificationCenter defaultCenter] removeObserver:observer];
+        [condition unlock];
     }];
     
-    for(CBPeripheral* peripheral in delegate.peripherals) {
-        if(predicate(peripheral)) {
-            return peripheral;
-        }
-    }
-    
     [condition lock];
-    while(!peripheral) {
-        [condition wait];
+    for(CBPeripheral* knownPeripheral in delegate.peripherals) {
+        if(predicate(knownPeripheral)) {
+            peripheral = knownPeripheral;
+        }
     }
+    wait_until(condition, deadline_for_timeout(timeout), ^BOOL{ return peripheral != nil; });
+    CBPeripheral* foundPeripheral = peripheral;
     [condition unlock];
+    
+    [[NSNotificationCenter defaultCenter] removeObserver:observer];
 
-    return peripheral;
+    return foundPeripheral;
 }
 
 NSArray* find_all_peripherals(unsigned timeout)
@@ -426,7 +698,124 @@ NSArray* find_all_peripherals(unsigned timeout)
     return peripherals;
 }
 
-CBService* peripheral_get_service_by_uuid(CBPeripheral* peripheral, const char* const UUIDString)
+#pragma mark Filtered scans
+
+// A scan that hands out each peripheral that passes its filter once, in
+// the order they are discovered, starting with those already discovered.
+// Peripherals are filtered and deduplicated here, on the Bluetooth queue,
+// so Python only wakes up for the ones it wants.
+
+@interface HEBluetoothShellDelegateScan : NSObject
+
+@property (nonatomic) NSCondition* condition; /* guards results and seen */
+@property (nonatomic) NSMutableArray* results; /* scan_result()s not yet handed out */
+@property (nonatomic) NSMutableSet* seen; /* identifiers */
+@property (nonatomic) NSArray* serviceUUIDs; /* CBUUIDs, one of which has to be advertised, or nil */
+@property (nonatomic) NSString* namePrefix; /* or nil */
+@property (nonatomic) BOOL filterRSSI;
+@property (nonatomic) NSInteger minRSSI;
+@property (nonatomic) id observer;
+
+@end
+
+@implementation HEBluetoothShellDelegateScan
+
+- (BOOL)matches:(NSDictionary*)result
+{
+    NSDictionary* advertisementData = result[@"advertisementData"];
+    
+    // 127 means CoreBluetooth has no RSSI
+    NSInteger RSSI = [result[@"RSSI"] integerValue];
+    if(self.filterRSSI && (RSSI == 127 || RSSI < self.minRSSI)) {
+        return NO;
+    }
+    
+    if(self.namePrefix) {
+        NSString* name = [result[@"peripheral"] name] ?: advertisementData[CBAdvertisementDataLocalNameKey];
+        if(![name hasPrefix:self.namePrefix]) {
+            return NO;
+        }
+    }
+    
+    if(self.serviceUUIDs) {
+        NSArray* advertised = advertisementData[CBAdvertisementDataServiceUUIDsKey];
+        for(CBUUID* UUID in self.serviceUUIDs) {
+            if([advertised containsObject:UUID]) {
+                return YES;
+            }
+        }
+        return NO;
+    }
+    
+    return YES;
+}
+
+- (void)add:(NSDictionary*)result
+{
+    [self.condition lock];
+    if(![self.seen containsObject:result[@"identifier"]] && [self matches:result]) {
+        [self.seen addObject:result[@"identifier"]];
+        [self.results addObject:result];
+        [self.condition broadcast];
+    }
+    [self.condition unlock];
+}
+
+@end
+
+HEBluetoothShellDelegateScan* scan_start(NSArray* serviceUUIDs, const char* const namePrefix, int filterRSSI, long minRSSI)
+{
+    HEBluetoothShellDelegateScan* scan = [[HEBluetoothShellDelegateScan alloc] init];
+    scan.condition = [[NSCondition alloc] init];
+    scan.results = [NSMutableArray array];
+    scan.seen = [NSMutableSet set];
+    scan.serviceUUIDs = serviceUUIDs;
+    scan.namePrefix = namePrefix ? [NSString stringWithUTF8String:namePrefix] : nil;
+    scan.filterRSSI = filterRSSI ? YES : NO;
+    scan.minRSSI = minRSSI;
+    
+    scan.observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDiscoverPeripheral" object:delegate.central queue:nil usingBlock:^(NSNotification* note) {
+        NSString* identifier = peripheral_identifier(note.userInfo[@"peripheral"]);
+        if(identifier) {
+            [scan add:scan_result(note.userInfo[@"peripheral"], identifier, note.userInfo[@"advertisementData"], note.userInfo[@"RSSI"])];
+        }
+    }];
+    
+    // after the observer, so that nothing discovered in between is missed;
+    // anything seen twice is dropped by add:
+    NSArray* known;
+    @synchronized(delegate.advertisements) {
+        known = [delegate.advertisements allValues];
+    }
+    for(NSDictionary* result in known) {
+        [scan add:result];
+    }
+    
+    return scan;
+}
+
+// Returns the next peripheral's scan result, or nil on timeout.
+NSDictionary* scan_next(HEBluetoothShellDelegateScan* scan, double timeout)
+{
+    [scan.condition lock];
+    NSDictionary* result = nil;
+    if(wait_until(scan.condition, deadline_for_timeout(timeout), ^BOOL{ return [scan.results count] > 0; })) {
+        result = scan.results[0];
+        [scan.results removeObjectAtIndex:0];
+    }
+    [scan.condition unlock];
+    return result;
+}
+
+void scan_stop(HEBluetoothShellDelegateScan* scan)
+{
+    if(scan.observer) {
+        [[NSNotificationCenter defaultCenter] removeObserver:scan.observer];
+        scan.observer = nil;
+    }
+}
+
+CBService* peripheral_get_service_by_uuid(CBPeripheral* peripheral, const char* const UUIDString, double timeout)
 {
     CBUUID* wantedUUID = [CBUUID UUIDWithString:[NSString stringWithUTF8String:UUIDString]];
     
@@ -434,33 +823,34 @@ CBService* peripheral_get_service_by_uuid(CBPeripheral* peripheral, const char*
     
     __block CBService* service = nil;
     
-    __block id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDiscoverService" object:peripheral queue:nil usingBlock:^(NSNotification* note) {
+    id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDiscoverService" object:peripheral queue:nil usingBlock:^(NSNotification* note) {
         CBService* newService = note.userInfo[@"service"];
         if(![newService.UUID isEqual:wantedUUID]) {
             return;
         }
         
+        [condition lock];
         service = newService;
         [condition broadcast];
-        [[NSNotificationCenter defaultCenter] removeObserver:observer];
+        [condition unlock];
     }];
-
-    for(CBService* service in peripheral.services) {
-        if([service.UUID isEqual:wantedUUID]) {
-            return service;
-        }
-    }
     
     [condition lock];
-    while(!service) {
-        [condition wait];
+    for(CBService* knownService in peripheral.services) {
+        if([knownService.UUID isEqual:wantedUUID]) {
+            service = knownService;
+        }
     }
+    wait_until(condition, deadline_for_timeout(timeout), ^BOOL{ return service != nil; });
+    CBService* foundService = service;
     [condition unlock];
     
-    return service;
+    [[NSNotificationCenter defaultCenter] removeObserver:observer];
+    
+    return foundService;
 }
 
-CBCharacteristic* service_get_characteristic_by_uuid(CBService* service, const char* const UUIDString)
+CBCharacteristic* service_get_characteristic_by_uuid(CBService* service, const char* const UUIDString, double timeout)
 {
     CBUUID* wantedUUID = [CBUUID UUIDWithString:[NSString stringWithUTF8String:UUIDString]];
     
@@ -468,34 +858,34 @@ CBCharacteristic* service_get_characteristic_by_uuid(CBService* service, const c
     
     __block CBCharacteristic* characteristic = nil;
     
-    __block id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDiscoverCharacteristic" object:service queue:nil usingBlock:^(NSNotification* note) {
+    id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDiscoverCharacteristic" object:service queue:nil usingBlock:^(NSNotification* note) {
         CBCharacteristic* newCharacteristic = note.userInfo[@"characteristic"];
-        
         if(![newCharacteristic.UUID isEqual:wantedUUID]) {
             return;
         }
         
+        [condition lock];
         characteristic = newCharacteristic;
         [condition broadcast];
-        [[NSNotificationCenter defaultCenter] removeObserver:observer];
+        [condition unlock];
     }];
     
-    for(CBCharacteristic* characteristic in service.characteristics) {
-        if([characteristic.UUID isEqual:wantedUUID]) {
-            return characteristic;
-        }
-    }
-    
     [condition lock];
-    while(!characteristic) {
-        [condition wait];
+    for(CBCharacteristic* knownCharacteristic in service.characteristics) {
+        if([knownCharacteristic.UUID isEqual:wantedUUID]) {
+            characteristic = knownCharacteristic;
+        }
     }
+    wait_until(condition, deadline_for_timeout(timeout), ^BOOL{ return characteristic != nil; });
+    CBCharacteristic* foundCharacteristic = characteristic;
     [condition unlock];
     
-    return characteristic;
+    [[NSNotificationCenter defaultCenter] removeObserver:observer];
+    
+    return foundCharacteristic;
 }
 
-NSData* characteristic_sync_read(CBCharacteristic* characteristic)
+NSData* characteristic_sync_read(CBCharacteristic* characteristic, double timeout)
 {
     if((characteristic.properties & CBCharacteristicPropertyRead) == 0) {
         NSLog(@"characteristic.sync_read(): You attempted to read from a non-readable characteristic %@; an error will follow. (Perhaps you need to subscribe to the characeristic instead?", characteristic);
@@ -505,29 +895,37 @@ NSData* characteristic_sync_read(CBCharacteristic* characteristic)
     
     __block NSData* data = nil;
     
-    __block id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidReadCharacteristic" object:characteristic queue:nil usingBlock:^(NSNotification* note) {
+    id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidReadCharacteristic" object:characteristic queue:nil usingBlock:^(NSNotification* note) {
+        [condition lock];
         data = note.userInfo[@"data"];
-        
         [condition broadcast];
-        
-        [[NSNotificationCenter defaultCenter] removeObserver:observer];
+        [condition unlock];
     }];
     
     [condition lock];
     
     [characteristic.service.peripheral readValueForCharacteristic:characteristic];
     
-    while(!data) {
-        [condition wait];
-    }
+    wait_until(condition, deadline_for_timeout(timeout), ^BOOL{ return data != nil; });
+    NSData* readData = data;
     [condition unlock];
     
-    return data;
+    [[NSNotificationCenter defaultCenter] removeObserver:observer];
+    
+    return readData;
 }
 
-BOOL characteristic_write(CBCharacteristic* characteristic, NSData* data, int wantConfirmation)
+enum {
+    HEWriteFailed = 0,
+    HEWriteSucceeded = 1,
+    HEWriteTimedOut = -1,
+    HEWriteWaited = 2,
+};
+
+// Returns one of the above; only a write with confirmation can time out.
+int characteristic_write(CBCharacteristic* characteristic, NSData* data, int wantConfirmation, double timeout)
 {
-    __block BOOL success = YES;
+    __block int result = HEWriteSucceeded;
     
     if(wantConfirmation) {
         if((characteristic.properties & CBCharacteristicPropertyWrite) == 0) {
@@ -538,25 +936,29 @@ BOOL characteristic_write(CBCharacteristic* characteristic, NSData* data, int wa
         
         __block BOOL finished = NO;
         
-        __block id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidWriteCharacteristic" object:characteristic queue:nil usingBlock:^(NSNotification* note) {
+        id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidWriteCharacteristic" object:characteristic queue:nil usingBlock:^(NSNotification* note) {
+            [condition lock];
             finished = YES;
             if(![note.userInfo[@"error"] isEqual:[NSNull null]]) {
-                success = NO;
+                result = HEWriteFailed;
             }
-            
             [condition broadcast];
-            
-            [[NSNotificationCenter defaultCenter] removeObserver:observer];
+            [condition unlock];
         }];
         
         [condition lock];
         
         [characteristic.service.peripheral writeValue:data forCharacteristic:characteristic type:CBCharacteristicWriteWithResponse];
         
-        while(!finished) {
-            [condition wait];
+        if(!wait_until(condition, deadline_for_timeout(timeout), ^BOOL{ return finished; })) {
+            result = HEWriteTimedOut;
         }
+        int writeResult = result;
         [condition unlock];
+        
+        [[NSNotificationCenter defaultCenter] removeObserver:observer];
+        
+        return writeResult;
     } else {
         if((characteristic.properties & CBCharacteristicPropertyWriteWithoutResponse) == 0) {
             NSLog(@"characteristic.write_no_confirm(): You attempted to write to a characteristic %@ that does not support writing without confirmation; an error will follow.", characteristic);
@@ -565,21 +967,68 @@ BOOL characteristic_write(CBCharacteristic* characteristic, NSData* data, int wa
         [characteristic.service.peripheral writeValue:data forCharacteristic:characteristic type:CBCharacteristicWriteWithoutResponse];
     }
     
-    return success;
+    return result;
 }
 
-HEBluetoothShellDelegateSubscription* characteristic_subscribe(CBCharacteristic* characteristic, SubscriberCallback callback)
+// Writes without response, once the peripheral is ready to send one if
+// waitUntilReady: CoreBluetooth drops writes that find its transmit buffers
+// full, without an error.  Returns HEWriteWaited if it had to wait, and
+// HEWriteTimedOut, without writing, if the peripheral was not ready in time.
+// Before OS X 10.13 there is no telling, and it writes straight away.
+int characteristic_write_without_response(CBCharacteristic* characteristic, NSData* data, int waitUntilReady, double timeout)
+{
+    CBPeripheral* peripheral = characteristic.service.peripheral;
+    int result = HEWriteSucceeded;
+    
+    if((characteristic.properties & CBCharacteristicPropertyWriteWithoutResponse) == 0) {
+        NSLog(@"characteristic.write_no_confirm(): You attempted to write to a characteristic %@ that does not support writing without confirmation; an error will follow.", characteristic);
+    }
+    
+    if(waitUntilReady && [peripheral respondsToSelector:@selector(canSendWriteWithoutResponse)] && !peripheral.canSendWriteWithoutResponse) {
+        NSCondition* condition = [[NSCondition alloc] init];
+        
+        id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateIsReadyToSendWriteWithoutResponse" object:peripheral queue:nil usingBlock:^(NSNotification* note) {
+            [condition lock];
+            [condition broadcast];
+            [condition unlock];
+        }];
+        
+        [condition lock];
+        BOOL ready = wait_until(condition, deadline_for_timeout(timeout), ^BOOL{ return peripheral.canSendWriteWithoutResponse; });
+        [condition unlock];
+        
+        [[NSNotificationCenter defaultCenter] removeObserver:observer];
+        
+        if(!ready) {
+            return HEWriteTimedOut;
+        }
+        result = HEWriteWaited;
+    }
+    
+    [peripheral writeValue:data forCharacteristic:characteristic type:CBCharacteristicWriteWithoutResponse];
+    
+    return result;
+}
+
+HEBluetoothShellDelegateSubscription* characteristic_subscribe_with_queue(CBCharacteristic* characteristic, SubscriberCallback callback, unsigned long capacity, int overflowPolicy, double blockTimeout, double timeout)
 {
     if((characteristic.properties & CBCharacteristicPropertyNotify) == 0) {
         NSLog(@"characteristic.subscribe(): You attempted to subscribe to a characteristic %@ that does not support notifications; an error will follow.", characteristic);
     }
 
-    HEBluetoothShellDelegateSubscription* subscription = [[HEBluetoothShellDelegateSubscription alloc] initWithCharacteristic:characteristic callback:callback];
-    [delegate.subscriptions setObject:subscription forKey:characteristic];
+    HEBluetoothShellDelegateSubscription* subscription = [[HEBluetoothShellDelegateSubscription alloc] initWithCharacteristic:characteristic callback:callback capacity:capacity overflowPolicy:(HEOverflowPolicy)overflowPolicy blockTimeout:blockTimeout untilDate:deadline_for_timeout(timeout)];
+    if(subscription) {
+        [delegate.subscriptions setObject:subscription forKey:characteristic];
+    }
     
     return subscription;
 }
 
+HEBluetoothShellDelegateSubscription* characteristic_subscribe(CBCharacteristic* characteristic, SubscriberCallback callback)
+{
+    return characteristic_subscribe_with_queue(characteristic, callback, 16384, HEOverflowDropOldest, 0.1, -1);
+}
+
 void characteristic_unsubscribe(CBCharacteristic* characteristic, id observer)
 {
     [[[characteristic service] peripheral] setNotifyValue:NO forCharacteristic:characteristic];
@@ -594,9 +1043,33 @@ NSData* subscription_read(CBCharacteristic* characteristic)
     return [[delegate.subscriptions objectForKey:characteristic] _read];
 }
 
+NSArray* subscription_read_many(HEBluetoothShellDelegateSubscription* subscription, unsigned long count, double timeout)
+{
+    return [subscription _readMany:count untilDate:deadline_for_timeout(timeout)];
+}
+
+unsigned long subscription_read_into(HEBluetoothShellDelegateSubscription* subscription, void* buffer, unsigned long length, double timeout)
+{
+    return [subscription _readInto:buffer length:length untilDate:deadline_for_timeout(timeout)];
+}
+
+// Fills stats with capacity, queued, high water mark, received, dropped
+// and blocked, in that order; see STATS in hello/pybt/ringbuffer.py.
+void subscription_get_stats(HEBluetoothShellDelegateSubscription* subscription, unsigned long stats[6])
+{
+    [subscription.condition lock];
+    stats[0] = [subscription.ring count];
+    stats[1] = subscription.count;
+    stats[2] = subscription.highWaterMark;
+    stats[3] = subscription.received;
+    stats[4] = subscription.dropped;
+    stats[5] = subscription.blocked;
+    [subscription.condition unlock];
+}
+
 #pragma mark Descriptors
 
-CBDescriptor* characteristic_get_descriptor_by_uuid(CBCharacteristic* characteristic, const char* const UUIDString)
+CBDescriptor* characteristic_get_descriptor_by_uuid(CBCharacteristic* characteristic, const char* const UUIDString, double timeout)
 {
     CBUUID* wantedUUID = [CBUUID UUIDWithString:[NSString stringWithUTF8String:UUIDString]];
     
@@ -604,30 +1077,223 @@ CBDescriptor* characteristic_get_descriptor_by_uuid(CBCharacteristic* characteri
     
     __block CBDescriptor* descriptor = nil;
     
-    __block id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDiscoverDescriptor" object:characteristic queue:nil usingBlock:^(NSNotification* note) {
+    id observer = [[NSNotificationCenter defaultCenter] addObserverForName:@"HEBluetoothShellDelegateDidDiscoverDescriptor" object:characteristic queue:nil usingBlock:^(NSNotification* note) {
         CBDescriptor* newDescriptor = note.userInfo[@"descriptor"];
-        
         if(![newDescriptor.UUID isEqual:wantedUUID]) {
             return;
         }
         
+        [condition lock];
         descriptor = newDescriptor;
         [condition broadcast];
+        [condition unlock];
+    }];
+    
+    [condition lock];
+    for(CBDescriptor* knownDescriptor in characteristic.descriptors) {
+        if([knownDescriptor.UUID isEqual:wantedUUID]) {
+            descriptor = knownDescriptor;
+        }
+    }
+    wait_until(condition, deadline_for_timeout(timeout), ^BOOL{ return descriptor != nil; });
+    CBDescriptor* foundDescriptor = descriptor;
+    [condition unlock];
+    
+    [[NSNotificationCenter defaultCenter] removeObserver:observer];
+    
+    return foundDescriptor;
+}
+
+#pragma mark Discovery plans
+
+void set_discovery_plan(const char* const identifier, NSDictionary* plan)
+{
+    [HEBluetoothShellDelegate initialize];
+    
+    NSString* key = [NSString stringWithUTF8String:identifier];
+    @synchronized(delegate.discoveryPlans) {
+        if(plan) {
+            delegate.discoveryPlans[key] = [plan copy];
+        } else {
+            [delegate.discoveryPlans removeObjectForKey:key];
+        }
+    }
+}
+
+// For when the plan turns out to be missing something: forget it, and
+// discover everything the peripheral has.
+void peripheral_discover_all(CBPeripheral* peripheral)
+{
+    NSString* identifier = peripheral_identifier(peripheral);
+    if(identifier) {
+        @synchronized(delegate.discoveryPlans) {
+            [delegate.discoveryPlans removeObjectForKey:identifier];
+        }
+    }
+    
+    [peripheral discoverServices:nil];
+}
+
+void characteristic_discover_descriptors(CBCharacteristic* characteristic)
+{
+    [characteristic.service.peripheral discoverDescriptorsForCharacteristic:characteristic];
+}
+
+
+#pragma mark Asynchronous operations
+
+// The *_async functions below return at once instead of waiting on an
+// NSCondition.  Each calls its callback exactly once, on the Bluetooth
+// queue, unless cancel_async() is called with the token it returned
+// first.  The callback gets nil if the operation failed.
+
+typedef void (*CompletionCallback)(id result);
+
+static NSMutableDictionary* pendingObservers = nil; /* NSNumber token -> observer, or NSNull while it is being added */
+static unsigned long nextPendingToken = 1;
+
+// Returns YES for exactly one caller per token: whoever gets to call back.
+static BOOL finish_pending(NSNumber* token)
+{
+    id observer = nil;
+    
+    @synchronized([HEBluetoothShellDelegate class]) {
+        observer = pendingObservers[token];
+        if(!observer) {
+            return NO;
+        }
+        [pendingObservers removeObjectForKey:token];
+    }
+    
+    if(observer != [NSNull null]) {
         [[NSNotificationCenter defaultCenter] removeObserver:observer];
+    }
+    
+    return YES;
+}
+
+static NSNumber* observe_pending(NSString* name, id object, void (^block)(NSNotification* note, NSNumber* token))
+{
+    NSNumber* token = nil;
+    
+    @synchronized([HEBluetoothShellDelegate class]) {
+        if(!pendingObservers) {
+            pendingObservers = [NSMutableDictionary dictionary];
+        }
+        token = @(nextPendingToken++);
+        pendingObservers[token] = [NSNull null];
+    }
+    
+    id observer = [[NSNotificationCenter defaultCenter] addObserverForName:name object:object queue:nil usingBlock:^(NSNotification* note) {
+        block(note, token);
     }];
     
-    for(CBDescriptor* descriptor in characteristic.descriptors) {
-        if([descriptor.UUID isEqual:wantedUUID]) {
-            return descriptor;
+    @synchronized([HEBluetoothShellDelegate class]) {
+        if(pendingObservers[token]) {
+            pendingObservers[token] = observer;
+            observer = nil;
         }
     }
     
-    [condition lock];
-    while(!characteristic) {
-        [condition wait];
+    // finished before we could record the observer
+    if(observer) {
+        [[NSNotificationCenter defaultCenter] removeObserver:observer];
     }
-    [condition unlock];
     
-    return descriptor;
+    return token;
+}
+
+void cancel_async(unsigned long token)
+{
+    finish_pending(@(token));
 }
 
+unsigned long find_peripheral_by_name_async(const char* const name, CompletionCallback callback)
+{
+    NSString* wantedName = [NSString stringWithUTF8String:name];
+    
+    NSNumber* token = observe_pending(@"HEBluetoothShellDelegateDidDiscoverPeripheral", delegate.central, ^(NSNotification* note, NSNumber* token) {
+        CBPeripheral* peripheral = note.userInfo[@"peripheral"];
+        if([peripheral.name isEqualToString:wantedName] && finish_pending(token)) {
+            callback(peripheral);
+        }
+    });
+    
+    for(CBPeripheral* peripheral in [delegate.peripherals copy]) {
+        if([peripheral.name isEqualToString:wantedName] && finish_pending(token)) {
+            callback(peripheral);
+            break;
+        }
+    }
+    
+    return [token unsignedLongValue];
+}
+
+unsigned long peripheral_get_service_by_uuid_async(CBPeripheral* peripheral, const char* const UUIDString, CompletionCallback callback)
+{
+    CBUUID* wantedUUID = [CBUUID UUIDWithString:[NSString stringWithUTF8String:UUIDString]];
+    
+    NSNumber* token = observe_pending(@"HEBluetoothShellDelegateDidDiscoverService", peripheral, ^(NSNotification* note, NSNumber* token) {
+        CBService* service = note.userInfo[@"service"];
+        if([service.UUID isEqual:wantedUUID] && finish_pending(token)) {
+            callback(service);
+        }
+    });
+    
+    for(CBService* service in peripheral.services) {
+        if([service.UUID isEqual:wantedUUID] && finish_pending(token)) {
+            callback(service);
+            break;
+        }
+    }
+    
+    return [token unsignedLongValue];
+}
+
+unsigned long service_get_characteristic_by_uuid_async(CBService* service, const char* const UUIDString, CompletionCallback callback)
+{
+    CBUUID* wantedUUID = [CBUUID UUIDWithString:[NSString stringWithUTF8String:UUIDString]];
+    
+    NSNumber* token = observe_pending(@"HEBluetoothShellDelegateDidDiscoverCharacteristic", service, ^(NSNotification* note, NSNumber* token) {
+        CBCharacteristic* characteristic = note.userInfo[@"characteristic"];
+        if([characteristic.UUID isEqual:wantedUUID] && finish_pending(token)) {
+            callback(characteristic);
+        }
+    });
+    
+    for(CBCharacteristic* characteristic in service.characteristics) {
+        if([characteristic.UUID isEqual:wantedUUID] && finish_pending(token)) {
+            callback(characteristic);
+            break;
+        }
+    }
+    
+    return [token unsignedLongValue];
+}
+
+unsigned long characteristic_read_async(CBCharacteristic* characteristic, CompletionCallback callback)
+{
+    NSNumber* token = observe_pending(@"HEBluetoothShellDelegateDidReadCharacteristic", characteristic, ^(NSNotification* note, NSNumber* token) {
+        if(finish_pending(token)) {
+            NSData* data = note.userInfo[@"data"];
+            callback([data isKindOfClass:[NSData class]] ? data : nil);
+        }
+    });
+    
+    [characteristic.service.peripheral readValueForCharacteristic:characteristic];
+    
+    return [token unsignedLongValue];
+}
+
+unsigned long characteristic_write_async(CBCharacteristic* characteristic, NSData* data, CompletionCallback callback)
+{
+    NSNumber* token = observe_pending(@"HEBluetoothShellDelegateDidWriteCharacteristic", characteristic, ^(NSNotification* note, NSNumber* token) {
+        if(finish_pending(token)) {
+            callback(@([note.userInfo[@"error"] isEqual:[NSNull null]]));
+        }
+    });
+    
+    [characteristic.service.peripheral writeValue:data forCharacteristic:characteristic type:CBCharacteristicWriteWithResponse];
+    
+    return [token unsignedLongValue];
+}
@@ -1,141 +1,183 @@
-import atexit
-import ctypes
+"""Python bindings for Bluetooth LE.
+
+The functions here run on top of a backend:
+
+* corebluetooth, the default, drives OS X's CoreBluetooth framework
+  through PyBT.dylib (hello.pybt.corebluetooth).
+* simulated runs peripherals in-process, over a modelled radio link, so
+  that code can be exercised and benchmarked on machines without one
+  (hello.pybt.simulated).
+* daemon attaches to pybtd, which keeps the scan, connections and
+  discovered attributes warm between scripts (hello.pybt.client).
+* replay serves a trace of an earlier run back, at the recorded speed
+  or as fast as possible (hello.pybt.replay).  Set PYBT_TRACE, or call
+  record_trace(), to record one with any backend (hello.pybt.trace).
+
+Pick one with the PYBT_BACKEND environment variable, or use_backend(),
+before the first Bluetooth operation.  Without either, scripts use the
+daemon backend while pybtd is running, and corebluetooth otherwise.
+Every backend hands out objects with the same methods:
+
+    peripheral.name(), peripheral[service_uuid]
+    service.UUID(), service[characteristic_uuid]
+    characteristic.UUID(), characteristic.sync_read(timeout),
+        characteristic.write_confirm(value, timeout), characteristic.write_no_confirm(value),
+        characteristic.subscribe(callback=None, capacity, overflow, block_timeout, timeout)
+    subscription.read(timeout), subscription.read_many(count, timeout),
+        subscription.read_into(buffer, offset, timeout), subscription.stats(),
+        subscription.unsubscribe()
+
+plus the getitem_async/read_async/write_async variants that
+hello.pybt.aio builds on.  scan() finds peripherals as they advertise;
+see hello.pybt.scanning.
+
+Blocking calls raise TimeoutError when their timeout, or the deadline()
+they run under, passes; see hello.pybt.timeouts.  hello.pybt.metrics
+keeps latency histograms and counters of them, once enabled.
+write_no_confirm() waits until the stack is ready to send, and keeps
+to a rate if one is set; see hello.pybt.pacing.  max_payload(peripheral)
+is the most a write without response or a notification can carry.
+"""
+
+import importlib
 import os
-
-import objc
-import Cocoa
-
-import IOBluetooth.CoreBluetooth as CoreBluetooth
-import Foundation
-
-#
-
-dylib = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(__file__), 'build/Debug/PyBT.dylib'))
-
-HEBluetoothShellDelegate = objc.lookUpClass('HEBluetoothShellDelegate')
-HEBluetoothShellDelegateSubscription = objc.lookUpClass('HEBluetoothShellDelegateSubscription')
-
-#
-
-dylib.find_peripheral_by_name.restype = ctypes.c_void_p
-dylib.find_all_peripherals.restype = ctypes.c_void_p
-dylib.peripheral_get_service_by_uuid.restype = ctypes.c_void_p
-dylib.service_get_characteristic_by_uuid.restype = ctypes.c_void_p
-dylib.characteristic_sync_read.restype = ctypes.c_void_p
-dylib.characteristic_subscribe.restype = ctypes.c_void_p
-dylib.characteristic_get_descriptor_by_uuid.restype = ctypes.c_void_p
-
-#
-
-def peripheral_getitem(self, item):
-    pointer = dylib.peripheral_get_service_by_uuid(self.__c_void_p__(), item)
-    return CoreBluetooth.CBService(c_void_p=pointer)
-CoreBluetooth.CBPeripheral.__getitem__ = peripheral_getitem
-
-#
-
-def service_getitem(self, item):
-    pointer = dylib.service_get_characteristic_by_uuid(self.__c_void_p__(), item)
-    return CoreBluetooth.CBCharacteristic(c_void_p=pointer)
-CoreBluetooth.CBService.__getitem__ = service_getitem
-
-#
-
-def characteristic_sync_read(self):
-    """Returns a bytearray object."""
-    pointer = dylib.characteristic_sync_read(self.__c_void_p__())
-    data = Cocoa.NSData(c_void_p=pointer)
-    return bytearray(data.bytes().tobytes())
-CoreBluetooth.CBCharacteristic.sync_read = characteristic_sync_read
-
-##
-
-def characteristic_write(self, value, confirm):
-    if isinstance(value, bytearray):
-        pass
-    elif isinstance(value, str):
-        value = bytearray(value)
-    else:
-        raise TypeError("characteristic_write_confirm requires a bytearray or str as its first parameter")
-
-    data = Cocoa.NSData.alloc().initWithBytes_length_(value, len(value))
-    result = dylib.characteristic_write(self.__c_void_p__(), data.__c_void_p__(), 1 if confirm else 0)
-    return result != 0
-def characteristic_write_confirm(self, value):
-    return characteristic_write(self, value, True)
-def characteristic_write_no_confirm(self, value):
-    return characteristic_write(self, value, False)
-CoreBluetooth.CBCharacteristic.write_confirm = characteristic_write_confirm
-CoreBluetooth.CBCharacteristic.write_no_confirm = characteristic_write_no_confirm
-
-# Subscribe/Unsubscribe
-
-def characteristic_subscribe(self, callback=None):
-    # <http://docs.python.org/2/library/ctypes.html#callback-functions>
-
-    if callback:
-        CALLBACK_PROXY_FUNCTION = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
-        def callbackProxy(characteristicPointer, dataPointer):
-            characteristic = CoreBluetooth.CBCharacteristic(c_void_p=characteristicPointer)
-            data = Cocoa.NSData(c_void_p=dataPointer)
-            bytes = bytearray(data.bytes().tobytes())
-            return callback(characteristic, bytes)
-        dylibCallback = CALLBACK_PROXY_FUNCTION(callbackProxy)
-    else:
-        dylibCallback = None
-
-    pointer = dylib.characteristic_subscribe(self.__c_void_p__(), dylibCallback)
-    return HEBluetoothShellDelegateSubscription(c_void_p=pointer)
-CoreBluetooth.CBCharacteristic.subscribe = characteristic_subscribe
-
-def characteristic_unsubscribe(self, observer):
-    return dylib.characteristic_unsubscribe(self, observer)
-CoreBluetooth.CBCharacteristic.unsubscribe = characteristic_unsubscribe
-
-# descriptors
-
-def characteristic_getitem(self, item):
-    pointer = dylib.characteristic_get_descriptor_by_uuid(self.__c_void_p__(), item)
-    return Foundation.NSObject(c_void_p=pointer)
-CoreBluetooth.CBCharacteristic.__getitem__ = characteristic_getitem
-    
-# subscriptions
-
-def subscription_read(self):
-    data = self._read()
-    bytes = bytearray(data.bytes().tobytes())
-    return bytes
-HEBluetoothShellDelegateSubscription.read = subscription_read
+import threading
+import time
+
+from hello.pybt import gattcache
+from hello.pybt import ipc
+from hello.pybt import metrics
+from hello.pybt import timeouts
+from hello.pybt.scanning import ScanResult
+from hello.pybt.timeouts import TimeoutError, deadline
+
+BACKENDS = {
+    'corebluetooth': 'hello.pybt.corebluetooth',
+    'simulated': 'hello.pybt.simulated',
+    'daemon': 'hello.pybt.client',
+    'replay': 'hello.pybt.replay',
+}
+
+backend_name = os.environ.get('PYBT_BACKEND')
+trace_path = os.environ.get('PYBT_TRACE') or None
+loaded_backend = None
+backend_lock = threading.Lock()
+discovery_planned = False
+
+def use_backend(name):
+    """Selects the backend by name; see BACKENDS."""
+
+    global backend_name, loaded_backend, discovery_planned
+
+    if name not in BACKENDS:
+        raise ValueError('unknown pybt backend %r; choose one of %s' % (name, ', '.join(sorted(BACKENDS))))
+    with backend_lock:
+        backend_name = name
+        loaded_backend = None
+        discovery_planned = False
+
+def record_trace(path):
+    """Records the Bluetooth traffic to a trace at path; see
+    hello.pybt.trace."""
+
+    global trace_path, loaded_backend
+
+    with backend_lock:
+        trace_path = path
+        loaded_backend = None
+
+def backend():
+    """Returns the backend's module, loading it on first use."""
+
+    global backend_name, loaded_backend
+
+    with backend_lock:
+        if loaded_backend is None:
+            if backend_name is None:
+                backend_name = 'daemon' if ipc.daemon_running() else 'corebluetooth'
+            if backend_name not in BACKENDS:
+                raise ValueError('unknown pybt backend %r in PYBT_BACKEND; choose one of %s' % (backend_name, ', '.join(sorted(BACKENDS))))
+            loaded_backend = importlib.import_module(BACKENDS[backend_name])
+            if trace_path:
+                from hello.pybt import trace
+                loaded_backend = trace.Recorder(loaded_backend, trace_path)
+        return loaded_backend
 
 #
 
 def start_scan(service_uuids_wanted=None):
     """Starts the scan for Bluetooth LE peripherals.  You need to call
     this before you do anything else.
+
+    Peripherals in the GATT cache (see hello.pybt.gattcache) only have
+    the attributes they were used for last time discovered.
     """
 
-    if service_uuids_wanted is not None:
-        cbuuids = [CBUUID.UUIDWithString_(uuid_string) for uuid_string in service_uuids_wanted]
-        cbuuids = NSArray.arrayWithObjects_(*cbuuids).__c_void_p__()
-    else:
-        cbuuids = None
+    global discovery_planned
+
+    cache = gattcache.open_default()
+    if cache is not None and not discovery_planned:
+        for identifier, plan in cache.plans().items():
+            backend().set_discovery_plan(identifier, plan)
+        discovery_planned = True
 
-    atexit.register(stop_scan)
-    dylib.start_scan() # (cbuuids)
+    return backend().start_scan(service_uuids_wanted)
 
 def stop_scan():
-    dylib.stop_scan()
+    gattcache.save()
+    return backend().stop_scan()
 
-def find_peripheral_by_name(name):
+@metrics.timed('find', lambda name, *args: (name, None))
+def find_peripheral_by_name(name, timeout=None):
     """Finds a peripheral by a given name, e.g. "LightBlue" or "Band (DFU
     Mode)."""
-
-    pointer = dylib.find_peripheral_by_name(name)
-    peripheral = CoreBluetooth.CBPeripheral(c_void_p=pointer)
-    return peripheral
+    return backend().find_peripheral_by_name(name, timeout)
 
 def find_all_peripherals(timeout=5):
     """Finds all peripherals given a timeout"""
-    pointer = dylib.find_all_peripherals(timeout)
-    peripherals = Foundation.NSObject(c_void_p=pointer)
-    return peripherals
+    return backend().find_all_peripherals(timeout)
+
+def scan(service_uuids=None, name_prefix=None, min_rssi=None, count=None, timeout=5):
+    """Yields a ScanResult, with the peripheral, its advertisement data
+    and RSSI, for each peripheral as it is discovered, or already has
+    been.  Only peripherals advertising one of service_uuids, named
+    starting with name_prefix, and heard at min_rssi or better are
+    yielded, each once.  The scan ends after count peripherals, or
+    timeout seconds (None for ever), or at the current deadline.
+
+        for result in pybt.scan([SERVICE], min_rssi=-70, count=1, timeout=10):
+            band = result.peripheral
+    """
+
+    scanner = backend().start_filtered_scan(service_uuids, name_prefix, min_rssi)
+    try:
+        until = time.time() + timeout if timeout is not None else None
+        found = 0
+        while count is None or found < count:
+            left = max(0.0, until - time.time()) if until is not None else None
+            result = scanner.next(timeouts.remaining(left))
+            if result is None:
+                return
+            found += 1
+            yield result
+    finally:
+        scanner.stop()
+
+def peripheral_identifier(peripheral):
+    """A string that identifies peripheral across connections and runs."""
+    return backend().peripheral_identifier(peripheral)
+
+# what every link can carry: the smallest ATT MTU, 23 bytes, less the
+# 3-byte ATT header
+MIN_PAYLOAD = 20
+
+def max_payload(peripheral):
+    """The most bytes a write without response to peripheral, or a
+    notification from it, can carry at the MTU negotiated with it, or
+    MIN_PAYLOAD if the backend cannot tell."""
+    return backend().peripheral_max_payload(peripheral) or MIN_PAYLOAD
+
+def find_peripheral_by_name_async(name, callback):
+    """Starts looking for a peripheral, and returns an object whose
+    cancel() abandons the search.  callback gets the peripheral."""
+    return backend().find_peripheral_by_name_async(name, callback)
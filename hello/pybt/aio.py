@@ -0,0 +1,460 @@
+"""Futures and coroutines on top of hello.pybt's asynchronous operations,
+so that one thread can drive many peripherals without blocking on each
+in turn.
+
+Python 2 has no asyncio, so coroutines here are generators that yield
+Futures, in the style of Tornado's gen.coroutine:
+
+    @aio.coroutine
+    def battery_level(name):
+        peripheral = yield aio.find_peripheral_by_name(name)
+        service = yield aio.get_service(peripheral, '180f')
+        characteristic = yield aio.get_characteristic(service, '2a19')
+        value = yield aio.wait_for(aio.read(characteristic), 5)
+        raise aio.Return(value[0])
+
+    pybt.start_scan()
+    loop = aio.get_event_loop()
+    levels = loop.run_until_complete(aio.gather(*[battery_level(name) for name in names]))
+
+Coroutines and Future callbacks run on the thread that runs the loop;
+Bluetooth results arrive on PyBT's queue and are handed over to it.
+"""
+
+import collections
+import functools
+import heapq
+import os
+import select
+import threading
+import time
+import types
+
+import hello.pybt as pybt
+from hello.pybt.timeouts import TimeoutError
+
+class CancelledError(Exception):
+    pass
+
+class OperationFailed(Exception):
+    pass
+
+class Return(Exception):
+    """Raise this to return a value from a coroutine; Python 2 generators
+    cannot return one."""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+#
+
+class Future(object):
+    """The eventual result of an operation.  Safe to complete, cancel and
+    wait on from any thread; only the first outcome counts, so a result
+    that arrives after a timeout or cancellation is ignored."""
+
+    def __init__(self, on_cancel=None):
+        self._condition = threading.Condition()
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._on_cancel = on_cancel
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return self._cancelled
+
+    def _finish(self, result, exception, cancelled=False):
+        with self._condition:
+            if self._done:
+                return False
+            self._done = True
+            self._cancelled = cancelled
+            self._result = result
+            self._exception = exception
+            callbacks, self._callbacks = self._callbacks, []
+            self._condition.notify_all()
+
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def set_result(self, result):
+        """Returns False if the Future was already done."""
+        return self._finish(result, None)
+
+    def set_exception(self, exception):
+        return self._finish(None, exception)
+
+    def cancel(self):
+        if not self._finish(None, CancelledError(), cancelled=True):
+            return False
+        if self._on_cancel:
+            self._on_cancel()
+        return True
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) once the Future is done, on whichever
+        thread completes it (or right away, if it is already done)."""
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        with self._condition:
+            if not self._done:
+                # a bounded wait, so that ^C still works
+                self._condition.wait(timeout if timeout is not None else 2**31)
+            if not self._done:
+                raise TimeoutError()
+            return self._exception
+
+    def result(self, timeout=None):
+        """Blocks the calling thread; from a coroutine, yield the Future
+        instead."""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+def chain(source, target):
+    """Completes target the same way source completed."""
+    if source.cancelled():
+        target.cancel()
+    elif source._exception is not None:
+        target.set_exception(source._exception)
+    else:
+        target.set_result(source._result)
+
+#
+
+class Timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    """Runs callbacks, timers and coroutines on a single thread.
+
+    Other threads hand work over with call_soon_threadsafe(), which wakes
+    the loop through a pipe, as asyncio does.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = collections.deque()
+        self._timers = []
+        self._sequence = 0
+        self._stopping = False
+        self._wakeup_read, self._wakeup_write = os.pipe()
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self._lock:
+            self._ready.append((callback, args))
+        os.write(self._wakeup_write, 'x')
+
+    call_soon = call_soon_threadsafe
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.time() + delay, callback, args)
+        with self._lock:
+            self._sequence += 1
+            heapq.heappush(self._timers, (timer.when, self._sequence, timer))
+        os.write(self._wakeup_write, 'x')
+        return timer
+
+    def stop(self):
+        self._stopping = True
+        os.write(self._wakeup_write, 'x')
+
+    def run_forever(self):
+        """Runs until stop() is called."""
+
+        self._stopping = False
+        while not self._stopping:
+            with self._lock:
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    when, sequence, timer = heapq.heappop(self._timers)
+                    if not timer.cancelled:
+                        self._ready.append((timer.callback, timer.args))
+
+                ready, self._ready = self._ready, collections.deque()
+
+                if ready:
+                    timeout = 0
+                elif self._timers:
+                    timeout = self._timers[0][0] - now
+                else:
+                    timeout = 1.0
+
+            readable, writable, errors = select.select([self._wakeup_read], [], [], timeout)
+            if readable:
+                os.read(self._wakeup_read, 4096)
+
+            for callback, args in ready:
+                callback(*args)
+
+    def run_until_complete(self, future):
+        """Runs the loop until future (a Future or generator) is done,
+        and returns its result."""
+
+        future = self.ensure_future(future)
+        future.add_done_callback(lambda future: self.call_soon_threadsafe(self.stop))
+        self.run_forever()
+        return future.result(0)
+
+    def ensure_future(self, future):
+        if isinstance(future, types.GeneratorType):
+            return Task(future, self)
+        return future
+
+    def close(self):
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+default_loop = None
+
+def get_event_loop():
+    global default_loop
+    if default_loop is None:
+        default_loop = EventLoop()
+    return default_loop
+
+class Task(Future):
+    """Runs a generator on loop, resuming it with the result of each
+    Future it yields."""
+
+    def __init__(self, generator, loop=None):
+        Future.__init__(self)
+        self._generator = generator
+        self._loop = loop or get_event_loop()
+        self._waiting_on = None
+        self._must_cancel = False
+        self._loop.call_soon_threadsafe(self._step, None, None)
+
+    def cancel(self):
+        """Throws CancelledError into the coroutine at the point where it
+        is waiting, after cancelling what it waits on."""
+        if self.done():
+            return False
+        self._must_cancel = True
+        if self._waiting_on is not None:
+            self._waiting_on.cancel()
+        return True
+
+    def _step(self, value, exception):
+        if self.done():
+            return
+        if self._must_cancel and not isinstance(exception, CancelledError):
+            exception = CancelledError()
+        self._must_cancel = False
+        self._waiting_on = None
+
+        try:
+            if exception is not None:
+                yielded = self._generator.throw(exception)
+            else:
+                yielded = self._generator.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return as e:
+            self.set_result(e.value)
+        except CancelledError:
+            Future.cancel(self)
+        except Exception as e:
+            self.set_exception(e)
+        else:
+            if isinstance(yielded, types.GeneratorType):
+                yielded = Task(yielded, self._loop)
+            if not isinstance(yielded, Future):
+                self._loop.call_soon(self._step, None, TypeError('coroutines must yield Futures, not %r' % (yielded,)))
+                return
+            self._waiting_on = yielded
+            yielded.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        self._loop.call_soon_threadsafe(self._resume, future)
+
+    def _resume(self, future):
+        if future.cancelled():
+            self._step(None, CancelledError())
+        else:
+            self._step(future._result, future._exception)
+
+def coroutine(function):
+    """Makes a generator function return a Task on the default loop."""
+
+    @functools.wraps(function)
+    def start(*args, **kwargs):
+        result = function(*args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            return Task(result)
+        future = Future()
+        future.set_result(result)
+        return future
+    return start
+
+def sleep(seconds, loop=None):
+    future = Future()
+    timer = (loop or get_event_loop()).call_later(seconds, future.set_result, None)
+    future._on_cancel = timer.cancel
+    return future
+
+def wait_for(future, timeout, loop=None):
+    """Returns a Future for future's result, which fails with TimeoutError
+    and cancels future if it takes more than timeout seconds."""
+
+    outer = Future(on_cancel=future.cancel)
+
+    def expired():
+        if outer.set_exception(TimeoutError('timed out after %.3fs' % timeout)):
+            future.cancel()
+    timer = (loop or get_event_loop()).call_later(timeout, expired)
+
+    def finished(future):
+        timer.cancel()
+        chain(future, outer)
+    future.add_done_callback(finished)
+
+    return outer
+
+def gather(*futures):
+    """Returns a Future for the list of all the futures' results, which
+    fails as soon as one of them does."""
+
+    futures = [get_event_loop().ensure_future(future) for future in futures]
+    outer = Future(on_cancel=lambda: [future.cancel() for future in futures])
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(future):
+        if future.cancelled() or future._exception is not None:
+            chain(future, outer)
+            return
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        outer.set_result([future._result for future in futures])
+
+    if not futures:
+        outer.set_result([])
+    for future in futures:
+        future.add_done_callback(finished)
+    return outer
+
+# Bluetooth operations
+
+def operation(start, description):
+    """Returns a Future for the result that start(callback) passes to
+    callback.  start must return an object with a cancel() method, like
+    hello.pybt.corebluetooth.PendingOperation."""
+
+    future = Future()
+
+    def completed(result):
+        if result is None:
+            future.set_exception(OperationFailed(description))
+        else:
+            future.set_result(result)
+
+    pending = start(completed)
+    future._on_cancel = pending.cancel
+    return future
+
+def find_peripheral_by_name(name):
+    return operation(
+        lambda callback: pybt.find_peripheral_by_name_async(name, callback),
+        'find peripheral %s' % name)
+
+def get_service(peripheral, uuid):
+    return operation(
+        lambda callback: peripheral.getitem_async(uuid, callback),
+        'discover service %s' % uuid)
+
+def get_characteristic(service, uuid):
+    return operation(
+        lambda callback: service.getitem_async(uuid, callback),
+        'discover characteristic %s' % uuid)
+
+def read(characteristic):
+    return operation(
+        lambda callback: characteristic.read_async(callback),
+        'read %s' % characteristic.UUID())
+
+def write(characteristic, value, confirm=True):
+    """Returns a Future for True or False, like write_confirm().  Writes
+    without confirmation complete at once."""
+
+    if not confirm:
+        future = Future()
+        future.set_result(characteristic.write_no_confirm(value))
+        return future
+    return operation(
+        lambda callback: characteristic.write_async(value, callback),
+        'write %s' % characteristic.UUID())
+
+class Stream(object):
+    """The notifications from a characteristic, as Futures.
+
+        stream = aio.Stream(characteristic)
+        for packet in stream:
+            packet = yield packet
+
+    Notifications that arrive before anyone reads them are queued.
+    """
+
+    def __init__(self, characteristic):
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._waiters = collections.deque()
+        self.closed = False
+        self.subscription = characteristic.subscribe(self._notified)
+
+    def _notified(self, characteristic, data):
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._queue.append(data)
+                    return 0
+                waiter = self._waiters.popleft()
+            # a waiter that timed out or was cancelled refuses the data
+            if waiter.set_result(data):
+                return 0
+
+    def read(self):
+        """Returns a Future for the next notification."""
+        future = Future()
+        with self._lock:
+            if self.closed:
+                future.set_exception(CancelledError('stream is closed'))
+            elif self._queue:
+                future.set_result(self._queue.popleft())
+            else:
+                self._waiters.append(future)
+        return future
+
+    def __iter__(self):
+        while not self.closed:
+            yield self.read()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            waiters, self._waiters = self._waiters, collections.deque()
+        self.subscription.unsubscribe()
+        for waiter in waiters:
+            waiter.cancel()
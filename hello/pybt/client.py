@@ -0,0 +1,308 @@
+"""The daemon backend: runs every Bluetooth operation in pybtd, the
+long-lived process that owns the scan and the connections (see
+hello.pybt.daemon and pybtd.py), over a Unix domain socket.
+
+A script that attaches does not start a scan, wait to discover its
+peripheral, connect or look up attributes: pybtd has already, on behalf
+of whichever script came first.  The objects here are proxies for pybtd's;
+each call is one request over the socket.
+
+hello.pybt picks this backend when PYBT_BACKEND is not set and pybtd is
+running, so existing scripts attach without changes.
+"""
+
+import logging as log
+import threading
+
+import hello.pybt.ipc as ipc
+import hello.pybt.metrics as metrics
+import hello.pybt.scanning as scanning
+import hello.pybt.timeouts as timeouts
+from hello.pybt.ringbuffer import QueuedSubscription, DEFAULT_CAPACITY, DROP_OLDEST, DEFAULT_BLOCK_TIMEOUT
+from hello.pybt.simulated import start_async
+
+class DaemonError(Exception):
+    """A request failed in pybtd, or pybtd went away."""
+
+class Connection(object):
+    """The socket to pybtd.  Requests can be made from any thread; a
+    reader thread hands each reply to the request it answers, and each
+    notification to its subscription."""
+
+    def __init__(self, path=None):
+        self.socket = ipc.connect(path)
+        self.file = self.socket.makefile('rb')
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.next_id = 1
+        self.pending = {}  # request id -> [event, opcode, values]
+        self.subscriptions = {}  # handle -> RemoteSubscription
+        self.early = {}  # handle -> notifications that beat the reply to SUBSCRIBE
+        self.closed = False
+
+        thread = threading.Thread(target=self._read, name='pybt-client')
+        thread.daemon = True
+        thread.start()
+
+    def _send(self, request_id, opcode, values):
+        data = ipc.frame(request_id, opcode, values)
+        with self.send_lock:
+            self.socket.sendall(data)
+
+    def request(self, opcode, *values):
+        """Sends a request and returns the values of its reply."""
+
+        slot = [threading.Event(), None, None]
+        with self.lock:
+            if self.closed:
+                raise DaemonError('pybtd has gone away')
+            request_id = self.next_id
+            self.next_id = self.next_id % 0xFFFF + 1
+            self.pending[request_id] = slot
+        self._send(request_id, opcode, values)
+
+        slot[0].wait()
+        event, opcode, values = slot
+        if opcode == ipc.REPLY:
+            return values
+        if opcode is None:
+            raise DaemonError('pybtd has gone away')
+        kind, message = values
+        if kind == ipc.TIMEOUT:
+            raise timeouts.TimeoutError(message)
+        if kind == ipc.KEY:
+            raise KeyError(message)
+        raise DaemonError(message)
+
+    def send(self, opcode, *values):
+        """Sends a request without waiting, or getting, a reply."""
+        self._send(0, opcode, values)
+
+    def _read(self):
+        while True:
+            message = ipc.receive_frame(self.file)
+            if message is None:
+                break
+            request_id, opcode, values = message
+            if opcode == ipc.NOTIFY:
+                handle, data = values
+                with self.lock:
+                    subscription = self.subscriptions.get(handle)
+                    if subscription is None:
+                        self.early.setdefault(handle, []).append(data)
+                        continue
+                subscription._deliver(data)
+            else:
+                with self.lock:
+                    slot = self.pending.pop(request_id, None)
+                if slot is None:
+                    log.warning('pybt: reply to unknown request %d' % request_id)
+                    continue
+                slot[1:] = [opcode, values]
+                slot[0].set()
+
+        log.warning('pybt: pybtd closed the connection')
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for slot in pending.values():
+            slot[0].set()
+
+    def add_subscription(self, handle, subscription):
+        with self.lock:
+            self.subscriptions[handle] = subscription
+            early = self.early.pop(handle, [])
+        for data in early:
+            subscription._deliver(data)
+
+    def remove_subscription(self, handle):
+        with self.lock:
+            self.subscriptions.pop(handle, None)
+
+connection_lock = threading.Lock()
+current_connection = None
+
+def connection():
+    global current_connection
+    with connection_lock:
+        if current_connection is None or current_connection.closed:
+            current_connection = Connection()
+        return current_connection
+
+def request(opcode, *values):
+    return connection().request(opcode, *values)
+
+# the proxies
+
+# what hello.pybt.metrics records an operation under
+
+def attribute_key(attribute, *args):
+    return attribute.peripheral_name, attribute.uuid
+
+def child_key(attribute, item):
+    return attribute.peripheral_name, item
+
+class RemoteAttribute(object):
+    def __init__(self, handle, uuid, peripheral_name):
+        self.handle = handle
+        self.uuid = uuid
+        self.peripheral_name = peripheral_name
+
+    def UUID(self):
+        return self.uuid
+
+    def _child(self, opcode, child_class, item):
+        handle, = request(opcode, self.handle, item, timeouts.remaining())
+        return child_class(handle, item, self.peripheral_name)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.handle == self.handle
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.handle)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.uuid)
+
+class RemoteDescriptor(RemoteAttribute):
+    pass
+
+class RemoteSubscription(QueuedSubscription):
+    def __init__(self, handle, characteristic, callback, capacity=DEFAULT_CAPACITY, overflow=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT):
+        QueuedSubscription.__init__(self, capacity, overflow, block_timeout)
+        self.handle = handle
+        self.characteristic = characteristic
+        self.callback = callback
+        self.subscribed = True
+
+    def _deliver(self, data):
+        if metrics.enabled:
+            metrics.notified(attribute_key(self.characteristic), len(data), None if self.callback else len(self.data_queue))
+        if self.callback:
+            self.callback(self.characteristic, bytearray(data))
+        else:
+            self.data_queue.put(bytearray(data))
+
+    def unsubscribe(self):
+        if self.subscribed:
+            self.subscribed = False
+            connection().remove_subscription(self.handle)
+            connection().send(ipc.UNSUBSCRIBE, self.handle)
+
+class RemoteCharacteristic(RemoteAttribute):
+    @metrics.timed('sync_read', attribute_key)
+    def sync_read(self, timeout=None):
+        data, = request(ipc.READ, self.handle, timeouts.remaining(timeout))
+        return bytearray(data)
+
+    @metrics.timed('write_confirm', attribute_key, payload=True)
+    def write_confirm(self, value, timeout=None):
+        succeeded, = request(ipc.WRITE, self.handle, bytes(bytearray(value)), timeouts.remaining(timeout))
+        return succeeded
+
+    @metrics.timed('write_no_confirm', attribute_key, payload=True)
+    def write_no_confirm(self, value):
+        connection().send(ipc.WRITE_NO_CONFIRM, self.handle, bytes(bytearray(value)))
+        return True
+
+    @metrics.timed('subscribe', attribute_key)
+    def subscribe(self, callback=None, capacity=DEFAULT_CAPACITY, overflow=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT, timeout=None):
+        handle, = request(ipc.SUBSCRIBE, self.handle, timeouts.remaining(timeout))
+        subscription = RemoteSubscription(handle, self, callback, capacity, overflow, block_timeout)
+        connection().add_subscription(handle, subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.unsubscribe()
+
+    def __getitem__(self, item):
+        return self._child(ipc.GET_DESCRIPTOR, RemoteDescriptor, item)
+
+    def read_async(self, callback):
+        return start_async(self.sync_read, callback)
+
+    def write_async(self, value, callback):
+        return start_async(lambda: self.write_confirm(value), callback)
+
+class RemoteService(RemoteAttribute):
+    @metrics.timed('discover', child_key)
+    def __getitem__(self, item):
+        return self._child(ipc.GET_CHARACTERISTIC, RemoteCharacteristic, item)
+
+    def getitem_async(self, item, callback):
+        return start_async(lambda: self[item], callback)
+
+class RemotePeripheral(RemoteAttribute):
+    def __init__(self, handle, name, identifier):
+        RemoteAttribute.__init__(self, handle, None, name)
+        self._name = name
+        self.identifier = identifier
+
+    def name(self):
+        return self._name
+
+    @metrics.timed('discover', child_key)
+    def __getitem__(self, item):
+        return self._child(ipc.GET_SERVICE, RemoteService, item)
+
+    def getitem_async(self, item, callback):
+        return start_async(lambda: self[item], callback)
+
+    def __repr__(self):
+        return '<RemotePeripheral %s>' % self._name
+
+# the backend
+
+def set_discovery_plan(identifier, plan):
+    # pybtd discovers with the plans of its own GATT cache
+    pass
+
+def peripheral_identifier(peripheral):
+    return peripheral.identifier
+
+def peripheral_max_payload(peripheral):
+    length, = request(ipc.MAX_PAYLOAD, peripheral.handle)
+    return length
+
+def start_scan(service_uuids_wanted=None):
+    # pybtd is always scanning; this only attaches to it
+    connection()
+
+def stop_scan():
+    pass
+
+def find_peripheral_by_name(name, timeout=None):
+    return RemotePeripheral(*request(ipc.FIND_PERIPHERAL, name, timeouts.remaining(timeout)))
+
+def find_all_peripherals(timeout=5):
+    values = request(ipc.FIND_ALL_PERIPHERALS, timeouts.remaining(timeout))
+    return [RemotePeripheral(*values[i:i+3]) for i in range(0, len(values), 3)]
+
+class RemoteScan(object):
+    def __init__(self, service_uuids, name_prefix, min_rssi):
+        uuids = list(service_uuids) if service_uuids is not None else []
+        count = len(uuids) if service_uuids is not None else -1
+        self.handle, = request(ipc.SCAN_START, count, *(uuids + [name_prefix, min_rssi]))
+
+    def next(self, timeout=None):
+        values = request(ipc.SCAN_NEXT, self.handle, timeout)
+        if values == [None]:
+            return None
+        handle, name, identifier, rssi = values[:4]
+        return scanning.ScanResult(RemotePeripheral(handle, name, identifier), identifier, name, rssi, {
+            scanning.LOCAL_NAME_KEY: name,
+            scanning.SERVICE_UUIDS_KEY: values[4:]})
+
+    def stop(self):
+        connection().send(ipc.SCAN_STOP, self.handle)
+
+def start_filtered_scan(service_uuids=None, name_prefix=None, min_rssi=None):
+    """See hello.pybt.scanning; only the local name and service UUIDs of
+    the advertisement data come across."""
+    return RemoteScan(service_uuids, name_prefix, min_rssi)
+
+def find_peripheral_by_name_async(name, callback):
+    return start_async(lambda: find_peripheral_by_name(name), callback)
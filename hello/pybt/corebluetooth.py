@@ -0,0 +1,473 @@
+"""The CoreBluetooth backend: drives OS X's CoreBluetooth framework
+through PyBT.dylib, and patches the PyObjC CoreBluetooth classes with the
+methods hello.pybt documents.
+"""
+
+import atexit
+import ctypes
+import os
+import time
+
+import hello.pybt.gattcache as gattcache
+import hello.pybt.metrics as metrics
+import hello.pybt.pacing as pacing
+import hello.pybt.ringbuffer as ringbuffer
+import hello.pybt.scanning as scanning
+import hello.pybt.timeouts as timeouts
+
+import objc
+import Cocoa
+
+import IOBluetooth.CoreBluetooth as CoreBluetooth
+import Foundation
+
+#
+
+dylib = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(__file__), 'build/Debug/PyBT.dylib'))
+
+HEBluetoothShellDelegate = objc.lookUpClass('HEBluetoothShellDelegate')
+HEBluetoothShellDelegateSubscription = objc.lookUpClass('HEBluetoothShellDelegateSubscription')
+HEBluetoothShellDelegateScan = objc.lookUpClass('HEBluetoothShellDelegateScan')
+
+#
+
+# blocking functions take a timeout in seconds last; see timeouts.native()
+dylib.find_peripheral_by_name.restype = ctypes.c_void_p
+dylib.find_peripheral_by_name.argtypes = [ctypes.c_char_p, ctypes.c_double]
+dylib.find_all_peripherals.restype = ctypes.c_void_p
+dylib.peripheral_get_service_by_uuid.restype = ctypes.c_void_p
+dylib.peripheral_get_service_by_uuid.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_double]
+dylib.service_get_characteristic_by_uuid.restype = ctypes.c_void_p
+dylib.service_get_characteristic_by_uuid.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_double]
+dylib.characteristic_sync_read.restype = ctypes.c_void_p
+dylib.characteristic_sync_read.argtypes = [ctypes.c_void_p, ctypes.c_double]
+dylib.characteristic_write.restype = ctypes.c_int
+dylib.characteristic_write.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_double]
+dylib.characteristic_write_without_response.restype = ctypes.c_int
+dylib.characteristic_write_without_response.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_double]
+dylib.characteristic_subscribe.restype = ctypes.c_void_p
+dylib.characteristic_get_descriptor_by_uuid.restype = ctypes.c_void_p
+dylib.characteristic_get_descriptor_by_uuid.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_double]
+dylib.peripheral_identifier.restype = ctypes.c_void_p
+dylib.peripheral_maximum_write_length.restype = ctypes.c_ulong
+dylib.peripheral_maximum_write_length.argtypes = [ctypes.c_void_p]
+dylib.subscription_read_many.restype = ctypes.c_void_p
+dylib.subscription_read_many.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_double]
+dylib.subscription_read_into.restype = ctypes.c_ulong
+dylib.subscription_read_into.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ulong, ctypes.c_double]
+dylib.characteristic_subscribe_with_queue.restype = ctypes.c_void_p
+dylib.characteristic_subscribe_with_queue.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int, ctypes.c_double, ctypes.c_double]
+dylib.subscription_get_stats.argtypes = [ctypes.c_void_p, ctypes.c_ulong * len(ringbuffer.STATS)]
+dylib.start_scan.argtypes = [ctypes.c_void_p]
+dylib.scan_start.restype = ctypes.c_void_p
+dylib.scan_start.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_long]
+dylib.scan_next.restype = ctypes.c_void_p
+dylib.scan_next.argtypes = [ctypes.c_void_p, ctypes.c_double]
+dylib.scan_stop.argtypes = [ctypes.c_void_p]
+
+for function in (dylib.find_peripheral_by_name_async,
+                 dylib.peripheral_get_service_by_uuid_async,
+                 dylib.service_get_characteristic_by_uuid_async,
+                 dylib.characteristic_read_async,
+                 dylib.characteristic_write_async):
+    function.restype = ctypes.c_ulong
+dylib.cancel_async.argtypes = [ctypes.c_ulong]
+
+#
+
+def peripheral_identifier(peripheral):
+    pointer = dylib.peripheral_identifier(peripheral.__c_void_p__())
+    return str(Foundation.NSObject(c_void_p=pointer)) if pointer else None
+
+def peripheral_max_payload(peripheral):
+    """None before OS X 10.12, which does not say."""
+    return dylib.peripheral_maximum_write_length(peripheral.__c_void_p__()) or None
+
+def uuid_string(uuid):
+    # UUIDString is OS X 10.10 and later; before, the description is the UUID
+    return str(uuid.UUIDString() if uuid.respondsToSelector_('UUIDString') else uuid)
+
+def attribute_path(attribute):
+    """The identifier of attribute's peripheral, and the UUIDs of the
+    service and characteristic attribute is or belongs to, as
+    hello.pybt.gattcache keys them; (None, None) with the cache off."""
+
+    if gattcache.cache is None:
+        return None, None
+    if isinstance(attribute, CoreBluetooth.CBCharacteristic):
+        service = attribute.service()
+        path = (uuid_string(service.UUID()), uuid_string(attribute.UUID()))
+    else:
+        service = attribute
+        path = (uuid_string(service.UUID()),)
+    peripheral = service.peripheral()
+    return (peripheral_identifier(peripheral), path) if peripheral is not None else (None, None)
+
+def read_firmware_revision(peripheral, timeout):
+    service_uuid, characteristic_uuid = gattcache.FIRMWARE_REVISION_PATH
+    service = dylib.peripheral_get_service_by_uuid(peripheral.__c_void_p__(), service_uuid, timeouts.native(timeout))
+    if not service:
+        return None
+    characteristic = dylib.service_get_characteristic_by_uuid(service, characteristic_uuid, timeouts.native(timeout))
+    if not characteristic:
+        return None
+    return str(CoreBluetooth.CBCharacteristic(c_void_p=characteristic).sync_read(timeout))
+
+def set_discovery_plan(identifier, plan):
+    """See hello.pybt.gattcache."""
+    plan = Foundation.NSDictionary.dictionaryWithDictionary_(plan) if plan is not None else None
+    dylib.set_discovery_plan(identifier, plan.__c_void_p__() if plan is not None else None)
+
+# what hello.pybt.metrics records an operation under
+
+def characteristic_key(characteristic, *args):
+    return characteristic.service().peripheral().name(), str(characteristic.UUID())
+
+def service_key(service, item):
+    return service.peripheral().name(), item
+
+def peripheral_key(peripheral, item):
+    return peripheral.name(), item
+
+#
+
+@metrics.timed('discover', peripheral_key)
+def peripheral_getitem(self, item):
+    if gattcache.cache is not None:
+        identifier = peripheral_identifier(self)
+        discover_all = lambda: dylib.peripheral_discover_all(self.__c_void_p__())
+        gattcache.check_firmware_revision(identifier, lambda timeout: read_firmware_revision(self, timeout), discover_all)
+        gattcache.before_lookup(identifier, (item,), discover_all)
+
+    pointer = dylib.peripheral_get_service_by_uuid(self.__c_void_p__(), item, timeouts.native())
+    if not pointer:
+        raise timeouts.timed_out('service %s' % item)
+    return CoreBluetooth.CBService(c_void_p=pointer)
+CoreBluetooth.CBPeripheral.__getitem__ = peripheral_getitem
+
+#
+
+@metrics.timed('discover', service_key)
+def service_getitem(self, item):
+    identifier, path = attribute_path(self)
+    if identifier:
+        gattcache.before_lookup(identifier, path + (item,), lambda: dylib.peripheral_discover_all(self.peripheral().__c_void_p__()))
+
+    pointer = dylib.service_get_characteristic_by_uuid(self.__c_void_p__(), item, timeouts.native())
+    if not pointer:
+        raise timeouts.timed_out('characteristic %s' % item)
+    return CoreBluetooth.CBCharacteristic(c_void_p=pointer)
+CoreBluetooth.CBService.__getitem__ = service_getitem
+
+#
+
+@metrics.timed('sync_read', characteristic_key)
+def characteristic_sync_read(self, timeout=None):
+    """Returns a bytearray object."""
+    pointer = dylib.characteristic_sync_read(self.__c_void_p__(), timeouts.native(timeout))
+    if not pointer:
+        raise timeouts.timed_out('sync_read()', timeout)
+    data = Cocoa.NSData(c_void_p=pointer)
+    return bytearray(data.bytes().tobytes())
+CoreBluetooth.CBCharacteristic.sync_read = characteristic_sync_read
+
+##
+
+WRITE_TIMED_OUT = -1
+WRITE_WAITED = 2  # written once the peripheral was ready to send; see hello.pybt.pacing
+
+def write_data(value):
+    if isinstance(value, (bytearray, buffer, memoryview)):
+        return value
+    elif isinstance(value, str):
+        return bytearray(value)
+    else:
+        raise TypeError("characteristic_write_confirm requires a bytearray, str, buffer or memoryview as its first parameter")
+
+def characteristic_write(self, value, confirm, timeout=None):
+    value = write_data(value)
+    data = Cocoa.NSData.alloc().initWithBytes_length_(value, len(value))
+    result = dylib.characteristic_write(self.__c_void_p__(), data.__c_void_p__(), 1 if confirm else 0, timeouts.native(timeout))
+    if result == WRITE_TIMED_OUT:
+        raise timeouts.timed_out('write_confirm()', timeout)
+    return result != 0
+@metrics.timed('write_confirm', characteristic_key, payload=True)
+def characteristic_write_confirm(self, value, timeout=None):
+    return characteristic_write(self, value, True, timeout)
+@metrics.timed('write_no_confirm', characteristic_key, payload=True)
+def characteristic_write_no_confirm(self, value):
+    """Paced by the peripheral's hello.pybt.pacing.WriteQueue: the rate
+    is kept here, and PyBT.m waits for the peripheral to be ready."""
+
+    value = write_data(value)
+    write_queue = pacing.queue(self.service().peripheral().name())
+    if pacing.enabled:
+        write_queue.wait(timeout=None)
+
+    data = Cocoa.NSData.alloc().initWithBytes_length_(value, len(value))
+    started = time.time()
+    result = dylib.characteristic_write_without_response(
+        self.__c_void_p__(), data.__c_void_p__(), 1 if pacing.enabled else 0, timeouts.native(pacing.READY_TIMEOUT))
+    if result == WRITE_WAITED:
+        write_queue.waited(time.time() - started)
+    elif result == WRITE_TIMED_OUT:
+        write_queue.sent(value, False)
+        if timeouts.expired():
+            raise timeouts.timed_out('write_no_confirm()')
+        return False
+    write_queue.sent(value, True)
+    return True
+CoreBluetooth.CBCharacteristic.write_confirm = characteristic_write_confirm
+CoreBluetooth.CBCharacteristic.write_no_confirm = characteristic_write_no_confirm
+
+# Subscribe/Unsubscribe
+
+subscription_callbacks = {}  # subscription pointer -> ctypes callback
+
+@metrics.timed('subscribe', characteristic_key)
+def characteristic_subscribe(self, callback=None, capacity=ringbuffer.DEFAULT_CAPACITY, overflow=ringbuffer.DROP_OLDEST, block_timeout=ringbuffer.DEFAULT_BLOCK_TIMEOUT, timeout=None):
+    """Without a callback, notifications queue up for read() and friends,
+    in a queue of capacity notifications that overflows as described in
+    hello.pybt.ringbuffer."""
+
+    if overflow not in ringbuffer.POLICIES:
+        raise ValueError('overflow must be one of %s' % ', '.join(ringbuffer.POLICIES))
+
+    # <http://docs.python.org/2/library/ctypes.html#callback-functions>
+
+    if callback:
+        CALLBACK_PROXY_FUNCTION = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+        def callbackProxy(characteristicPointer, dataPointer):
+            characteristic = CoreBluetooth.CBCharacteristic(c_void_p=characteristicPointer)
+            data = Cocoa.NSData(c_void_p=dataPointer)
+            bytes = bytearray(data.bytes().tobytes())
+            if metrics.enabled:
+                metrics.notified(characteristic_key(characteristic), len(bytes))
+            return callback(characteristic, bytes)
+        dylibCallback = CALLBACK_PROXY_FUNCTION(callbackProxy)
+    else:
+        dylibCallback = None
+
+    pointer = dylib.characteristic_subscribe_with_queue(
+        self.__c_void_p__().value, dylibCallback, max(capacity, 1), ringbuffer.POLICIES.index(overflow), block_timeout,
+        timeouts.native(timeout))
+    if not pointer:
+        raise timeouts.timed_out('subscribe()', timeout)
+
+    # ctypes frees the trampoline along with dylibCallback, so keep it
+    # alive for as long as PyBT.m may call it; one per subscription, as
+    # a characteristic can be subscribed to more than once
+    subscription_callbacks[pointer] = dylibCallback
+    return HEBluetoothShellDelegateSubscription(c_void_p=pointer)
+CoreBluetooth.CBCharacteristic.subscribe = characteristic_subscribe
+
+def characteristic_unsubscribe(self, observer):
+    result = dylib.characteristic_unsubscribe(self, observer)
+    if hasattr(observer, '__c_void_p__'):
+        subscription_callbacks.pop(observer.__c_void_p__().value, None)
+    return result
+CoreBluetooth.CBCharacteristic.unsubscribe = characteristic_unsubscribe
+
+# descriptors
+
+def characteristic_getitem(self, item):
+    identifier, path = attribute_path(self)
+    if identifier:
+        gattcache.before_lookup(identifier, path + (item,), lambda: dylib.characteristic_discover_descriptors(self.__c_void_p__()))
+
+    pointer = dylib.characteristic_get_descriptor_by_uuid(self.__c_void_p__(), item, timeouts.native())
+    if not pointer:
+        raise timeouts.timed_out('descriptor %s' % item)
+    return Foundation.NSObject(c_void_p=pointer)
+CoreBluetooth.CBCharacteristic.__getitem__ = characteristic_getitem
+    
+# subscriptions
+
+def subscription_read(self, timeout=None):
+    """Returns the next notification, waiting up to timeout seconds."""
+    packets = subscription_read_many(self, 1, timeout)
+    if not packets:
+        raise timeouts.timed_out('read()', timeout)
+    return packets[0]
+HEBluetoothShellDelegateSubscription.read = subscription_read
+
+def subscription_read_many(self, count, timeout=None):
+    """Returns up to count notifications, as bytearrays, from one call
+    into PyBT: the first is waited for, for up to timeout seconds, and
+    the rest are whatever is already queued.  Returns [] on timeout, but
+    raises TimeoutError if the current deadline passes."""
+
+    pointer = dylib.subscription_read_many(self.__c_void_p__().value, count, timeouts.native(timeout))
+    packets = [bytearray(data.bytes()) for data in Foundation.NSArray(c_void_p=pointer)]
+    if not packets and timeouts.expired():
+        raise timeouts.timed_out('read_many()')
+    return packets
+HEBluetoothShellDelegateSubscription.read_many = subscription_read_many
+
+def subscription_read_into(self, buffer, offset=0, timeout=None):
+    """Copies queued notifications, back to back, straight into
+    buffer[offset:], and returns how many bytes were copied; 0 on
+    timeout, or TimeoutError if the current deadline passes.  Waits for
+    the first notification as read_many() does.  A notification that
+    does not fit is split, and the rest of it is read next time.
+
+    buffer is usually a bytearray.  Python 2's ctypes cannot write
+    through a memoryview, so one costs an extra copy."""
+
+    length = len(buffer) - offset
+    if length <= 0:
+        return 0
+
+    if isinstance(buffer, memoryview):
+        data = bytearray(length)
+        copied = subscription_read_into(self, data, 0, timeout)
+        buffer[offset:offset+copied] = bytes(data[:copied])
+        return copied
+
+    target = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+    copied = dylib.subscription_read_into(self.__c_void_p__().value, ctypes.addressof(target) + offset, length, timeouts.native(timeout))
+    if not copied and timeouts.expired():
+        raise timeouts.timed_out('read_into()')
+    return copied
+HEBluetoothShellDelegateSubscription.read_into = subscription_read_into
+
+def subscription_stats(self):
+    """Returns the queue's capacity, how many notifications are queued,
+    the most that ever were, and how many were received, dropped because
+    the queue was full, and made the Bluetooth queue wait for room."""
+
+    stats = (ctypes.c_ulong * len(ringbuffer.STATS))()
+    dylib.subscription_get_stats(self.__c_void_p__().value, stats)
+    return dict(zip(ringbuffer.STATS, stats))
+HEBluetoothShellDelegateSubscription.stats = subscription_stats
+
+#
+
+def start_scan(service_uuids_wanted=None):
+    """Starts the scan for Bluetooth LE peripherals.  You need to call
+    this before you do anything else.
+    """
+
+    atexit.register(stop_scan)
+    services = cbuuid_array(service_uuids_wanted)
+    dylib.start_scan(services.__c_void_p__().value if services is not None else None)
+
+def cbuuid_array(uuid_strings):
+    """An NSArray of CBUUIDs, or None for None.  Keep it referenced
+    while PyBT.m is handed its pointer."""
+    if uuid_strings is None:
+        return None
+    return Foundation.NSArray.arrayWithArray_([CoreBluetooth.CBUUID.UUIDWithString_(uuid_string) for uuid_string in uuid_strings])
+
+def stop_scan():
+    dylib.stop_scan()
+
+def find_peripheral_by_name(name, timeout=None):
+    """Finds a peripheral by a given name, e.g. "LightBlue" or "Band (DFU
+    Mode)."""
+
+    pointer = dylib.find_peripheral_by_name(name, timeouts.native(timeout))
+    if not pointer:
+        raise timeouts.timed_out('find_peripheral_by_name(%r)' % name, timeout)
+    peripheral = CoreBluetooth.CBPeripheral(c_void_p=pointer)
+    return peripheral
+
+def find_all_peripherals(timeout=5):
+    """Finds all peripherals given a timeout"""
+    pointer = dylib.find_all_peripherals(timeout)
+    peripherals = Foundation.NSObject(c_void_p=pointer)
+    return peripherals
+
+def start_filtered_scan(service_uuids=None, name_prefix=None, min_rssi=None):
+    """See hello.pybt.scanning; the filter runs in PyBT.m."""
+    services = cbuuid_array(service_uuids)
+    pointer = dylib.scan_start(
+        services.__c_void_p__().value if services is not None else None,
+        name_prefix.encode('utf-8') if name_prefix is not None else None,
+        min_rssi is not None,
+        min_rssi or 0)
+    return HEBluetoothShellDelegateScan(c_void_p=pointer)
+
+def scan_next(self, timeout=None):
+    pointer = dylib.scan_next(self.__c_void_p__().value, timeouts.native(timeout))
+    if not pointer:
+        return None
+    result = Foundation.NSDictionary(c_void_p=pointer)
+    advertisement_data = dict(result['advertisementData'])
+    if scanning.SERVICE_UUIDS_KEY in advertisement_data:
+        advertisement_data[scanning.SERVICE_UUIDS_KEY] = [
+            str(uuid.UUIDString()) for uuid in advertisement_data[scanning.SERVICE_UUIDS_KEY]]
+    peripheral = result['peripheral']
+    name = peripheral.name() or advertisement_data.get(scanning.LOCAL_NAME_KEY)
+    return scanning.ScanResult(
+        peripheral, str(result['identifier']), unicode(name) if name is not None else None,
+        int(result['RSSI']), advertisement_data)
+HEBluetoothShellDelegateScan.next = scan_next
+
+def scan_stop(self):
+    dylib.scan_stop(self.__c_void_p__().value)
+HEBluetoothShellDelegateScan.stop = scan_stop
+
+# Asynchronous operations
+#
+# These start an operation and return a PendingOperation at once, rather
+# than blocking the calling thread.  callback is later called exactly
+# once with the result, or None if the operation failed, on PyBT's
+# Bluetooth queue; it must return quickly.  See hello.pybt.aio for
+# futures and coroutines built on top of them.
+
+COMPLETION_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+
+pending_callbacks = {}  # token -> ctypes callback
+
+class PendingOperation(object):
+    def __init__(self, token):
+        self.token = token
+
+    def cancel(self):
+        """Abandons the operation; its callback will not be called."""
+        dylib.cancel_async(self.token)
+        pending_callbacks.pop(self.token, None)
+
+def start_async(start, args, wrap, callback):
+    state = {'token': None, 'finished': False}
+
+    def completed(pointer):
+        state['finished'] = True
+        pending_callbacks.pop(state['token'], None)
+        callback(wrap(pointer) if pointer else None)
+
+    dylibCallback = COMPLETION_CALLBACK(completed)
+    token = start(*(args + (dylibCallback,)))
+    state['token'] = token
+    if not state['finished']:
+        # as in characteristic_subscribe, keep the trampoline alive
+        pending_callbacks[token] = dylibCallback
+    return PendingOperation(token)
+
+def find_peripheral_by_name_async(name, callback):
+    return start_async(dylib.find_peripheral_by_name_async, (name,),
+        lambda pointer: CoreBluetooth.CBPeripheral(c_void_p=pointer), callback)
+
+def peripheral_getitem_async(self, item, callback):
+    return start_async(dylib.peripheral_get_service_by_uuid_async, (self.__c_void_p__(), item),
+        lambda pointer: CoreBluetooth.CBService(c_void_p=pointer), callback)
+CoreBluetooth.CBPeripheral.getitem_async = peripheral_getitem_async
+
+def service_getitem_async(self, item, callback):
+    return start_async(dylib.service_get_characteristic_by_uuid_async, (self.__c_void_p__(), item),
+        lambda pointer: CoreBluetooth.CBCharacteristic(c_void_p=pointer), callback)
+CoreBluetooth.CBService.getitem_async = service_getitem_async
+
+def characteristic_read_async(self, callback):
+    return start_async(dylib.characteristic_read_async, (self.__c_void_p__(),),
+        lambda pointer: bytearray(Cocoa.NSData(c_void_p=pointer).bytes().tobytes()), callback)
+CoreBluetooth.CBCharacteristic.read_async = characteristic_read_async
+
+def characteristic_write_async(self, value, callback):
+    """Writes with confirmation; callback gets True or False."""
+    value = write_data(value)
+    data = Cocoa.NSData.alloc().initWithBytes_length_(value, len(value))
+    return start_async(dylib.characteristic_write_async, (self.__c_void_p__(), data.__c_void_p__()),
+        lambda pointer: bool(Foundation.NSNumber(c_void_p=pointer).boolValue()), callback)
+CoreBluetooth.CBCharacteristic.write_async = characteristic_write_async
@@ -0,0 +1,240 @@
+"""pybtd's side of the daemon backend: serves this process's backend to
+other processes over a Unix domain socket (see hello.pybt.ipc).
+
+The daemon owns the scan and every connection for as long as it runs,
+so each script that attaches finds its peripheral already discovered
+and connected.  Services, characteristics and descriptors are looked up
+once, and then handed to every client from the daemon's tables.
+
+    pybt.start_scan()
+    Daemon().serve_forever()
+"""
+
+import logging as log
+import os
+import socket
+import threading
+
+import hello.pybt as pybt
+import hello.pybt.ipc as ipc
+import hello.pybt.timeouts as timeouts
+
+class Daemon(object):
+    def __init__(self, path=None):
+        self.path = path or ipc.socket_path()
+        self.lock = threading.Lock()
+        self.objects = {}  # handle -> peripheral, attribute, subscription or scan
+        self.handles = {}  # peripheral or attribute -> handle
+        self.children = {}  # (handle, UUID) -> the handle of what it looked up
+        self.next_handle = 1
+        self.listener = None
+
+    def _handle(self, thing, remember=True):
+        with self.lock:
+            if remember and thing in self.handles:
+                return self.handles[thing]
+            handle = self.next_handle
+            self.next_handle += 1
+            self.objects[handle] = thing
+            if remember:
+                self.handles[thing] = handle
+            return handle
+
+    def _object(self, handle):
+        try:
+            return self.objects[handle]
+        except KeyError:
+            raise ipc.ProtocolError('no object with handle %d' % handle)
+
+    def _forget(self, handle):
+        with self.lock:
+            return self.objects.pop(handle, None)
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            if ipc.daemon_running(self.path):
+                raise RuntimeError('pybtd is already listening on %s' % self.path)
+            os.remove(self.path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        os.chmod(self.path, 0600)
+        self.listener.listen(16)
+        log.info('pybtd listening on %s' % self.path)
+
+        try:
+            while True:
+                try:
+                    connection, address = self.listener.accept()
+                except socket.error:
+                    if self.listener is None:
+                        break
+                    raise
+                client = _Client(self, connection)
+                thread = threading.Thread(target=client.run, name='pybtd-client')
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.close()
+
+    def close(self):
+        listener, self.listener = self.listener, None
+        if listener:
+            listener.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    # requests
+
+    def _peripheral(self, peripheral):
+        name = peripheral.name()
+        return [self._handle(peripheral), unicode(name) if name is not None else None,
+                pybt.peripheral_identifier(peripheral)]
+
+    def find_peripheral(self, client, name, timeout):
+        return self._peripheral(pybt.find_peripheral_by_name(name, timeout))
+
+    def find_all_peripherals(self, client, timeout):
+        values = []
+        for peripheral in pybt.find_all_peripherals(timeout):
+            values += self._peripheral(peripheral)
+        return values
+
+    def get_child(self, client, handle, uuid, timeout):
+        key = (handle, uuid.upper())
+        if key not in self.children:
+            parent = self._object(handle)
+            with timeouts.deadline(timeout):
+                child = parent[uuid]
+            self.children[key] = self._handle(child)
+        return [self.children[key]]
+
+    def max_payload(self, client, handle):
+        return [pybt.max_payload(self._object(handle))]
+
+    def read(self, client, handle, timeout):
+        return [str(self._object(handle).sync_read(timeout))]
+
+    def write(self, client, handle, data, timeout):
+        return [bool(self._object(handle).write_confirm(bytearray(data), timeout))]
+
+    def write_no_confirm(self, client, handle, data):
+        self._object(handle).write_no_confirm(bytearray(data))
+
+    def subscribe(self, client, handle, timeout):
+        # the handle is reserved first, so no notification goes out without one
+        subscription_handle = self._handle(None, remember=False)
+
+        def notified(characteristic, data):
+            client.send(0, ipc.NOTIFY, [subscription_handle, str(data)])
+
+        subscription = self._object(handle).subscribe(notified, timeout=timeout)
+        with self.lock:
+            self.objects[subscription_handle] = subscription
+        client.subscriptions.add(subscription_handle)
+        return [subscription_handle]
+
+    def unsubscribe(self, client, handle):
+        client.subscriptions.discard(handle)
+        subscription = self._forget(handle)
+        if subscription is not None:
+            subscription.unsubscribe()
+
+    def scan_start(self, client, count, *values):
+        service_uuids = list(values[:count]) if count >= 0 else None
+        name_prefix, min_rssi = values[count:] if count >= 0 else values
+        handle = self._handle(pybt.backend().start_filtered_scan(service_uuids, name_prefix, min_rssi), remember=False)
+        client.scans.add(handle)
+        return [handle]
+
+    def scan_next(self, client, handle, timeout):
+        result = self._object(handle).next(timeout)
+        if result is None:
+            return [None]
+        return self._peripheral(result.peripheral) + [result.rssi] + list(result.service_uuids)
+
+    def scan_stop(self, client, handle):
+        client.scans.discard(handle)
+        scan = self._forget(handle)
+        if scan is not None:
+            scan.stop()
+
+    REQUESTS = {
+        ipc.FIND_PERIPHERAL: find_peripheral,
+        ipc.FIND_ALL_PERIPHERALS: find_all_peripherals,
+        ipc.GET_SERVICE: get_child,
+        ipc.GET_CHARACTERISTIC: get_child,
+        ipc.GET_DESCRIPTOR: get_child,
+        ipc.MAX_PAYLOAD: max_payload,
+        ipc.READ: read,
+        ipc.WRITE: write,
+        ipc.WRITE_NO_CONFIRM: write_no_confirm,
+        ipc.SUBSCRIBE: subscribe,
+        ipc.UNSUBSCRIBE: unsubscribe,
+        ipc.SCAN_START: scan_start,
+        ipc.SCAN_NEXT: scan_next,
+        ipc.SCAN_STOP: scan_stop,
+    }
+
+    def dispatch(self, client, opcode, values):
+        if opcode not in self.REQUESTS:
+            raise ipc.ProtocolError('unknown opcode %d' % opcode)
+        return self.REQUESTS[opcode](self, client, *values)
+
+class _Client(object):
+    """One attached process.  Requests that expect a reply each run on a
+    thread of their own, so that one waiting on the radio does not hold
+    up the others; requests without one, like write_no_confirm, run in
+    order as they arrive."""
+
+    def __init__(self, daemon, connection):
+        self.daemon = daemon
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.subscriptions = set()  # handles
+        self.scans = set()
+
+    def send(self, request_id, opcode, values):
+        data = ipc.frame(request_id, opcode, values)
+        try:
+            with self.send_lock:
+                self.connection.sendall(data)
+        except socket.error as e:
+            log.debug('pybtd: client went away: %s' % e)
+
+    def _answer(self, request_id, opcode, values):
+        try:
+            reply = self.daemon.dispatch(self, opcode, values)
+        except timeouts.TimeoutError as e:
+            self.send(request_id, ipc.ERROR, [ipc.TIMEOUT, str(e)])
+        except KeyError as e:
+            self.send(request_id, ipc.ERROR, [ipc.KEY, str(e.args[0]) if e.args else ''])
+        except Exception as e:
+            log.exception('pybtd: request %d failed' % opcode)
+            self.send(request_id, ipc.ERROR, [ipc.OTHER, '%s: %s' % (type(e).__name__, e)])
+        else:
+            self.send(request_id, ipc.REPLY, reply or [])
+
+    def run(self):
+        file = self.connection.makefile('rb')
+        try:
+            while True:
+                message = ipc.receive_frame(file)
+                if message is None:
+                    break
+                request_id, opcode, values = message
+                if request_id == 0:
+                    try:
+                        self.daemon.dispatch(self, opcode, values)
+                    except Exception:
+                        log.exception('pybtd: request %d failed' % opcode)
+                else:
+                    thread = threading.Thread(target=self._answer, args=(request_id, opcode, values))
+                    thread.daemon = True
+                    thread.start()
+        finally:
+            for handle in list(self.subscriptions):
+                self.daemon.unsubscribe(self, handle)
+            for handle in list(self.scans):
+                self.daemon.scan_stop(self, handle)
+            self.connection.close()
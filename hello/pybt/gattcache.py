@@ -0,0 +1,211 @@
+"""Remembers which services, characteristics and descriptors each
+peripheral is used for, so that the next run discovers only those.
+
+Discovering a peripheral's whole GATT tree takes a round trip per
+service, characteristic and descriptor, and a short-lived script spends
+most of its time waiting on that before its first write.  Lookups
+through hello.pybt note what they ask for, by peripheral identifier, and
+stop_scan() (or the end of the program) saves it to a JSON file.
+start_scan() hands each saved layout to the backend as a discovery plan,
+so that connecting discovers only what is needed.
+
+A lookup the plan does not cover means the program wants something new,
+or the peripheral has changed, e.g. with new firmware: its entry is
+dropped and the backend falls back to discovering everything.  Entries
+are also keyed by firmware: the first lookup on a peripheral in each run
+reads its Firmware Revision String (2A26), which every plan includes,
+and a different revision than the entry's drops it the same way.  Only
+entries that know their revision, or know the peripheral has none, are
+handed out as plans.
+
+The file is PYBT_GATT_CACHE, or ~/.pybt_gatt_cache.json by default;
+set PYBT_GATT_CACHE to an empty string to turn the cache off.
+"""
+
+import atexit
+import json
+import logging as log
+import os
+import threading
+
+from hello.pybt import timeouts
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.pybt_gatt_cache.json')
+
+# the Device Information service's Firmware Revision String
+FIRMWARE_REVISION_PATH = ('180A', '2A26')
+# how long to look for it on a peripheral that may not have it
+FIRMWARE_REVISION_TIMEOUT = 2.0
+
+class GATTCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # identifier -> {'firmware_revision': ..., 'services': {service: {characteristic: [descriptors]}}}
+        self.planned = set()  # identifiers whose entry was handed to the backend
+        self.checked = set()  # identifiers whose firmware revision was read in this run
+        self.used = {}  # identifier -> paths looked up in this run
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """Returns the cache saved at path, or an empty one if there is
+        none or it cannot be read."""
+
+        cache = cls(path)
+        try:
+            with open(path) as file:
+                cache.entries = json.load(file)
+        except (IOError, ValueError) as e:
+            if os.path.exists(path):
+                log.warning('ignoring unreadable GATT cache %s: %s' % (path, e))
+        return cache
+
+    def save(self):
+        with self.lock:
+            entries = json.dumps(self.entries, indent=1, sort_keys=True)
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write(entries)
+        os.rename(temporary_path, self.path)
+
+    def plans(self):
+        """Returns a discovery plan for every peripheral in the cache
+        whose firmware revision is known ('' for none):
+        {identifier: {service: {characteristic: [descriptors]}}}."""
+
+        with self.lock:
+            self.planned = set(identifier for identifier, entry in self.entries.items()
+                               if entry.get('firmware_revision') is not None)
+            return dict((identifier, self.entries[identifier]['services']) for identifier in self.planned)
+
+    def covers(self, identifier, path):
+        """Whether the entry for identifier lists path, a tuple of a
+        service UUID and optionally characteristic and descriptor UUIDs,
+        or there is no plan for it to miss."""
+
+        with self.lock:
+            if identifier not in self.planned or identifier not in self.entries:
+                return True
+            node = self.entries[identifier]['services']
+            for uuid in path:
+                if uuid.upper() not in node:
+                    return False
+                node = node[uuid.upper()]
+            return True
+
+    def note(self, identifier, path):
+        with self.lock:
+            self.used.setdefault(identifier, set()).add(path)
+            entry = self.entries.setdefault(identifier, {'firmware_revision': None, 'services': {}})
+            self._add(entry, path)
+
+    def _add(self, entry, path):
+        service = entry['services'].setdefault(path[0].upper(), {})
+        if len(path) > 1:
+            descriptors = service.setdefault(path[1].upper(), [])
+            if len(path) > 2 and path[2].upper() not in descriptors:
+                descriptors.append(path[2].upper())
+
+    def wants_firmware_revision(self, identifier):
+        """Whether the firmware revision of the peripheral identifier
+        still has to be read in this run.  A planned peripheral with none
+        cannot be asked without discovering everything, so is not."""
+
+        with self.lock:
+            if identifier in self.checked:
+                return False
+            self.checked.add(identifier)
+            entry = self.entries.get(identifier)
+            return identifier not in self.planned or bool(entry and entry.get('firmware_revision'))
+
+    def note_firmware_revision(self, identifier, revision):
+        """Records revision, '' for none, for the peripheral identifier.
+        Returns True if it differs from the revision its plan was for,
+        which is then forgotten."""
+
+        with self.lock:
+            entry = self.entries.setdefault(identifier, {'firmware_revision': None, 'services': {}})
+            changed = entry.get('firmware_revision') not in (None, revision)
+            if changed:
+                log.info('%s changed firmware from %s to %s; forgetting its GATT layout' % (
+                    identifier, entry['firmware_revision'], revision))
+                self.planned.discard(identifier)
+                entry = self.entries[identifier] = {'firmware_revision': None, 'services': {}}
+                for path in self.used.get(identifier, ()):
+                    self._add(entry, path)
+            entry['firmware_revision'] = revision
+            if revision:
+                # so that the next run can read it again
+                self._add(entry, FIRMWARE_REVISION_PATH)
+            return changed
+
+    def forget(self, identifier):
+        """Drops the entry for identifier, except for what this run has
+        looked up."""
+
+        with self.lock:
+            self.planned.discard(identifier)
+            entry = self.entries.pop(identifier, None)
+            if identifier in self.used:
+                self.entries[identifier] = {
+                    'firmware_revision': entry['firmware_revision'] if entry else None,
+                    'services': {},
+                }
+                for path in self.used[identifier]:
+                    self._add(self.entries[identifier], path)
+
+# used by the backends
+
+cache = None
+
+def open_default():
+    """Loads the cache named by PYBT_GATT_CACHE, once; returns None if it
+    is turned off."""
+
+    global cache
+
+    path = os.environ.get('PYBT_GATT_CACHE', DEFAULT_PATH)
+    if not path:
+        return None
+    if cache is None or cache.path != path:
+        if cache is None:
+            atexit.register(save)
+        cache = GATTCache.load(path)
+    return cache
+
+def save():
+    if cache is None:
+        return
+    try:
+        cache.save()
+    except (IOError, OSError) as e:
+        log.warning('could not save GATT cache %s: %s' % (cache.path, e))
+
+def check_firmware_revision(identifier, read_revision, discover_all):
+    """Called by a backend before it looks a service up on the
+    peripheral.  Once a run, reads its firmware revision with
+    read_revision(timeout), which returns None if there is none, and if
+    it changed since its plan was saved, calls discover_all()."""
+
+    if cache is None or identifier is None or not cache.wants_firmware_revision(identifier):
+        return
+    try:
+        revision = read_revision(FIRMWARE_REVISION_TIMEOUT)
+    except (KeyError, timeouts.TimeoutError) as e:
+        log.debug('could not read the firmware revision of %s: %s' % (identifier, e))
+        revision = None
+    if cache.note_firmware_revision(identifier, revision or ''):
+        discover_all()
+
+def before_lookup(identifier, path, discover_all):
+    """Called by a backend before it looks path up on the peripheral.  If
+    the peripheral's plan does not cover path, forgets the plan and calls
+    discover_all() so that the lookup can succeed."""
+
+    if cache is None or identifier is None:
+        return
+    if not cache.covers(identifier, path):
+        log.info('GATT cache for %s does not list %s; discovering everything' % (identifier, '/'.join(path)))
+        cache.forget(identifier)
+        discover_all()
+    cache.note(identifier, path)
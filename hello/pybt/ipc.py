@@ -0,0 +1,143 @@
+"""The protocol between pybtd and the daemon backend, over a Unix domain
+socket.
+
+Every message is a frame:
+
+    FRAME_HEADER    payload length, request id, opcode, as '<IHB'
+    payload         the message's values, encoded as below
+
+A request's reply has its request id, and opcode REPLY or ERROR; a
+request with id 0 gets no reply.  NOTIFY frames, with id 0, carry a
+subscription's notifications as they arrive.
+
+Values are tagged with a byte:
+
+    'N'     None
+    'T' 'F' True, False
+    'i'     int, as '<q'
+    'd'     float, as '<d'
+    's'     bytes, as a '<I' length and the bytes
+    'u'     unicode, as 's' of its UTF-8 encoding
+
+Peripherals, services, characteristics, descriptors, subscriptions and
+scans are ints: handles into the daemon's tables.
+"""
+
+import os
+import socket
+import struct
+
+FRAME_HEADER = struct.Struct('<IHB')
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+LENGTH = struct.Struct('<I')
+
+# opcodes
+REPLY = 0
+ERROR = 1
+NOTIFY = 2
+
+FIND_PERIPHERAL = 10      # name, timeout -> peripheral, name, identifier
+FIND_ALL_PERIPHERALS = 11  # timeout -> (peripheral, name, identifier)...
+GET_SERVICE = 12          # peripheral, uuid, timeout -> service
+GET_CHARACTERISTIC = 13   # service, uuid, timeout -> characteristic
+GET_DESCRIPTOR = 14       # characteristic, uuid, timeout -> descriptor
+MAX_PAYLOAD = 15          # peripheral -> bytes
+READ = 20                 # characteristic, timeout -> data
+WRITE = 21                # characteristic, data, timeout -> succeeded
+WRITE_NO_CONFIRM = 22     # characteristic, data; no reply
+SUBSCRIBE = 23            # characteristic, timeout -> subscription
+UNSUBSCRIBE = 24          # subscription; no reply
+SCAN_START = 30           # service uuids (count, then each), name prefix, min RSSI -> scan
+SCAN_NEXT = 31            # scan, timeout -> peripheral, name, identifier, RSSI, service uuids... or None
+SCAN_STOP = 32            # scan; no reply
+
+# what an ERROR carries, besides the message
+TIMEOUT = 'timeout'
+KEY = 'key'
+OTHER = 'other'
+
+def socket_path():
+    """Where pybtd listens: $PYBT_SOCKET, or one per user in /tmp."""
+    return os.environ.get('PYBT_SOCKET') or '/tmp/pybtd-%d.sock' % os.getuid()
+
+class ProtocolError(Exception):
+    pass
+
+def encode(values):
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append('N')
+        elif value is True:
+            parts.append('T')
+        elif value is False:
+            parts.append('F')
+        elif isinstance(value, (int, long)):
+            parts += ['i', INT.pack(value)]
+        elif isinstance(value, float):
+            parts += ['d', FLOAT.pack(value)]
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+            parts += ['u', LENGTH.pack(len(value)), value]
+        else:
+            value = str(value)
+            parts += ['s', LENGTH.pack(len(value)), value]
+    return ''.join(parts)
+
+def decode(payload):
+    values = []
+    offset = 0
+    while offset < len(payload):
+        tag = payload[offset]
+        offset += 1
+        if tag == 'N':
+            values.append(None)
+        elif tag in 'TF':
+            values.append(tag == 'T')
+        elif tag == 'i':
+            values.append(INT.unpack_from(payload, offset)[0])
+            offset += INT.size
+        elif tag == 'd':
+            values.append(FLOAT.unpack_from(payload, offset)[0])
+            offset += FLOAT.size
+        elif tag in 'su':
+            length, = LENGTH.unpack_from(payload, offset)
+            offset += LENGTH.size
+            value = payload[offset:offset+length]
+            values.append(value.decode('utf-8') if tag == 'u' else value)
+            offset += length
+        else:
+            raise ProtocolError('unknown value tag %r' % tag)
+    return values
+
+def frame(request_id, opcode, values):
+    payload = encode(values)
+    return FRAME_HEADER.pack(len(payload), request_id, opcode) + payload
+
+def receive_frame(file):
+    """Returns the next frame's request id, opcode and values from file,
+    a socket's makefile('rb'), or None once the other end has closed
+    the connection."""
+
+    header = file.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    length, request_id, opcode = FRAME_HEADER.unpack(header)
+    payload = file.read(length) if length else ''
+    if len(payload) < length:
+        return None
+    return request_id, opcode, decode(payload)
+
+def connect(path=None):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(path or socket_path())
+    return connection
+
+def daemon_running(path=None):
+    """Whether pybtd is listening, and not just its socket left behind."""
+    try:
+        connect(path).close()
+        return True
+    except socket.error:
+        return False
@@ -0,0 +1,208 @@
+"""Latency histograms and counters for Bluetooth operations, per
+peripheral and per attribute UUID.
+
+Every backend times finding peripherals, looking up services and
+characteristics ('discover'), sync_read(), write_confirm() and
+subscribe(), counts timeouts and the bytes each way, and for each
+subscription records the time between notifications and how many were
+queued when one arrived.  (With CoreBluetooth, notifications only pass
+through Python, and so are only recorded, for subscriptions with a
+callback.)
+
+It is off unless enable()d, or PYBT_METRICS is set; off, an operation
+pays for one test of a global.
+
+    metrics.enable()
+    band.connect()
+    band.vibrate()
+    metrics.snapshot()['Band']['attributes']['beef']['latency']['write_confirm']['p99']
+    metrics.dump(open('metrics.json', 'w'))
+"""
+
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+from hello.pybt import timeouts
+
+enabled = bool(os.environ.get('PYBT_METRICS'))
+
+PERCENTILES = (50, 90, 99)
+
+class Histogram(object):
+    """Counts values in buckets as HdrHistogram does: each power of two is
+    split into 2**SUB_BUCKET_BITS equal buckets, so any percentile is
+    within about 3% of a value recorded, over any range, with a few
+    hundred buckets at most.  Values are counted in units of resolution."""
+
+    SUB_BUCKET_BITS = 5
+
+    def __init__(self, resolution=1e-6):
+        self.resolution = resolution
+        self.buckets = collections.defaultdict(int)  # lowest value in the bucket, in units -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _shift(self, units):
+        return max(0, units.bit_length() - self.SUB_BUCKET_BITS - 1)
+
+    def record(self, value):
+        units = max(0, int(value / self.resolution))
+        shift = self._shift(units)
+        self.buckets[units >> shift << shift] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percentile):
+        """The value percentile percent of those recorded are at most, to
+        within a bucket; None if there are none."""
+
+        if not self.count:
+            return None
+        rank = percentile / 100.0 * self.count
+        seen = 0
+        for lowest in sorted(self.buckets):
+            seen += self.buckets[lowest]
+            if seen >= rank:
+                break
+        middle = (lowest + ((1 << self._shift(lowest)) - 1) / 2.0) * self.resolution
+        return min(max(middle, self.min), self.max)
+
+    def summary(self):
+        summary = dict(
+            count=self.count,
+            min=self.min,
+            max=self.max,
+            mean=self.total / self.count if self.count else None)
+        for percentile in PERCENTILES:
+            summary['p%d' % percentile] = self.percentile(percentile)
+        return summary
+
+class Stats(object):
+    """What was recorded for one peripheral, or one of its attributes."""
+
+    def __init__(self):
+        self.latency = {}  # operation -> Histogram of seconds
+        self.histograms = {}  # name -> Histogram of other things
+        self.counters = collections.defaultdict(int)
+        self.last_notification = None
+
+    def timing(self, operation):
+        if operation not in self.latency:
+            self.latency[operation] = Histogram()
+        return self.latency[operation]
+
+    def histogram(self, name, resolution):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(resolution)
+        return self.histograms[name]
+
+    def summary(self):
+        summary = dict(
+            latency=dict((name, histogram.summary()) for name, histogram in self.latency.items()),
+            counters=dict(self.counters))
+        summary.update((name, histogram.summary()) for name, histogram in self.histograms.items())
+        return summary
+
+lock = threading.Lock()
+peripherals = {}  # peripheral name -> (Stats, {attribute UUID -> Stats})
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with lock:
+        peripherals.clear()
+
+def _stats(peripheral, uuid):
+    if peripheral not in peripherals:
+        peripherals[peripheral] = (Stats(), {})
+    stats, attributes = peripherals[peripheral]
+    if uuid is None:
+        return stats
+    uuid = uuid.lower()
+    if uuid not in attributes:
+        attributes[uuid] = Stats()
+    return attributes[uuid]
+
+def record(key, operation, seconds):
+    """Records that operation took seconds; key is a (peripheral name,
+    attribute UUID or None) pair."""
+    with lock:
+        _stats(*key).timing(operation).record(seconds)
+
+def count(key, counter, n=1):
+    with lock:
+        _stats(*key).counters[counter] += n
+
+def notified(key, length, queued=None):
+    """Records a notification of length bytes, which found queued others
+    waiting to be read, if known."""
+
+    now = time.time()
+    with lock:
+        stats = _stats(*key)
+        stats.counters['notifications'] += 1
+        stats.counters['bytes_notified'] += length
+        if stats.last_notification is not None:
+            stats.histogram('notification_interval', 1e-6).record(now - stats.last_notification)
+        stats.last_notification = now
+        if queued is not None:
+            stats.histogram('queue_depth', 1).record(queued)
+
+def timed(operation, key, payload=False):
+    """Decorates a method to record how long it takes, as operation,
+    under key(self, *args), and to count its timeouts; with payload, its
+    first argument is data sent, counted as bytes_written."""
+
+    def decorate(method):
+        @functools.wraps(method)
+        def timed_method(self, *args, **kwargs):
+            if not enabled:
+                return method(self, *args, **kwargs)
+            started = time.time()
+            try:
+                result = method(self, *args, **kwargs)
+            except timeouts.TimeoutError:
+                count(key(self, *args), '%s_timeouts' % operation)
+                raise
+            elapsed = time.time() - started
+            with lock:
+                stats = _stats(*key(self, *args))
+                stats.timing(operation).record(elapsed)
+                if payload:
+                    stats.counters['bytes_written'] += len(args[0] if args else kwargs['value'])
+            return result
+        return timed_method
+    return decorate
+
+def snapshot():
+    """Everything recorded, as a dict: for each peripheral name, its own
+    latency, counters and histograms, and the same for each of its
+    attributes under 'attributes', by UUID.  Each histogram is summarized
+    as its count, min, mean, max and percentiles, in seconds for
+    latencies."""
+
+    with lock:
+        result = {}
+        for peripheral, (stats, attributes) in peripherals.items():
+            summary = stats.summary()
+            summary['attributes'] = dict((uuid, attribute.summary()) for uuid, attribute in attributes.items())
+            result[peripheral] = summary
+        return result
+
+def dump(file):
+    """Writes snapshot() to file as JSON."""
+    json.dump(snapshot(), file, indent=2, sort_keys=True)
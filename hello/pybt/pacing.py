@@ -0,0 +1,211 @@
+"""Pacing for writes without response, with a WriteQueue per peripheral.
+
+Writes without response are not acknowledged, so nothing stops a sender
+from outrunning the Bluetooth stack: once its transmit buffers are full,
+further writes are silently dropped, and a DFU transfer finds out only
+when the bootloader's byte count comes up short.  While pacing is
+enabled, the default, every write_no_confirm() first waits for its
+peripheral's WriteQueue to let it go:
+
+* until the stack is ready to send another one.  With CoreBluetooth,
+  that is until the peripheral canSendWriteWithoutResponse (OS X 10.13
+  and later); the simulated backend models a Link's tx_buffers.
+* and, if a rate is set, at most rate writes a second, with bursts of up
+  to burst; PYBT_WRITE_RATE sets it for every peripheral.
+
+    pacing.set_rate(200, burst=4)  # e.g. a bootloader that keeps up with 200 packets a second
+    pacing.stats()['Band (DFU Mode)']['bytes_per_second']
+
+Each WriteQueue counts the writes and bytes sent, how many had to wait
+and for how long, how many were dropped, and how many repeated the one
+before them that was, i.e. were retried.  Disable pacing, e.g. with
+PYBT_WRITE_PACING=0, to send as fast as possible regardless.
+"""
+
+import os
+import threading
+import time
+
+from hello.pybt import metrics
+from hello.pybt import timeouts
+
+enabled = os.environ.get('PYBT_WRITE_PACING', '1') != '0'
+
+# how long a write waits for the stack to be ready to send, unless a
+# deadline is sooner, before it gives up and counts as dropped
+READY_TIMEOUT = 1.0
+
+default_rate = float(os.environ.get('PYBT_WRITE_RATE') or 0) or None
+default_burst = 1
+
+class WriteQueue(object):
+    def __init__(self, name, rate=None, burst=1):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.condition = threading.Condition(threading.Lock())
+        self.waiting = 0
+        self.tokens = float(burst)
+        self.refilled = time.time()
+        self.last_dropped = None  # the data of the last write, if it was dropped
+
+        self.writes = 0
+        self.bytes = 0
+        self.waits = 0
+        self.seconds_waiting = 0.0
+        self.dropped = 0
+        self.retried = 0
+        self.first = None
+        self.last = None
+
+    def wait(self, take=None, timeout=READY_TIMEOUT):
+        """Waits until the rate allows another write, and take(), if
+        given, claims a transmit buffer for it; take() returns whether it
+        could, and signal() says when to try again.  Returns the seconds
+        waited, or raises TimeoutError after timeout, or at the current
+        deadline."""
+
+        started = None
+        with self.condition:
+            try:
+                while True:
+                    delay = 0.0
+                    if self.rate:
+                        now = time.time()
+                        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                        self.refilled = now
+                        if self.tokens < 1:
+                            delay = (1 - self.tokens) / self.rate
+                    if not delay and (take is None or take()):
+                        break
+
+                    now = time.time()
+                    if started is None:
+                        # signal() only wakes writes it knows are waiting, so
+                        # say so, and check once more before waiting
+                        started = now
+                        limit = timeouts.remaining(timeout)
+                        self.waiting += 1
+                        continue
+                    left = None if limit is None else limit - (now - started)
+                    if left is not None and left <= 0:
+                        raise timeouts.timed_out('write_no_confirm() waiting to send', timeout)
+                    # Condition.wait() without a timeout cannot be interrupted with ^C
+                    self.condition.wait(min(delay or 2**31, left if left is not None else 2**31))
+            finally:
+                if started is not None:
+                    self.waiting -= 1
+
+            if self.rate:
+                self.tokens -= 1
+            waited = time.time() - started if started is not None else 0.0
+            if waited:
+                self.waits += 1
+                self.seconds_waiting += waited
+        if waited and metrics.enabled:
+            metrics.record((self.name, None), 'write_no_confirm_wait', waited)
+        return waited
+
+    def signal(self):
+        """The stack is ready to send again."""
+        if self.waiting:
+            with self.condition:
+                self.condition.notify_all()
+
+    def waited(self, seconds):
+        """Counts a wait that happened elsewhere, e.g. in PyBT.m."""
+        with self.condition:
+            self.waits += 1
+            self.seconds_waiting += seconds
+
+    def sent(self, data, delivered=True):
+        """Counts a write of data, which the stack either took, or
+        dropped."""
+
+        now = time.time()
+        with self.condition:
+            self.writes += 1
+            if self.first is None:
+                self.first = now
+            self.last = now
+            if self.last_dropped is not None and self.last_dropped == data:
+                self.retried += 1
+            if delivered:
+                self.bytes += len(data)
+                self.last_dropped = None
+            else:
+                self.dropped += 1
+                self.last_dropped = bytearray(data)
+        if not delivered and metrics.enabled:
+            metrics.count((self.name, None), 'write_no_confirm_dropped')
+
+    def stats(self):
+        with self.condition:
+            elapsed = self.last - self.first if self.writes > 1 else 0.0
+            return dict(
+                writes=self.writes,
+                bytes=self.bytes,
+                waits=self.waits,
+                seconds_waiting=self.seconds_waiting,
+                dropped=self.dropped,
+                retried=self.retried,
+                bytes_per_second=self.bytes / elapsed if elapsed else None,
+                writes_per_second=(self.writes - 1) / elapsed if elapsed else None,
+                rate=self.rate)
+
+    def __str__(self):
+        stats = self.stats()
+        return '%s: wrote %d bytes without response in %d writes, %s; %d waited %.2fs to send, %d dropped, %d retried' % (
+            self.name, stats['bytes'], stats['writes'],
+            '%.0f bytes/sec' % stats['bytes_per_second'] if stats['bytes_per_second'] else 'too few to time',
+            stats['waits'], stats['seconds_waiting'], stats['dropped'], stats['retried'])
+
+lock = threading.Lock()
+queues = {}  # peripheral name -> WriteQueue
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def queue(name):
+    """The WriteQueue for the peripheral called name."""
+
+    try:
+        return queues[name]
+    except KeyError:
+        with lock:
+            if name not in queues:
+                queues[name] = WriteQueue(name, default_rate, default_burst)
+            return queues[name]
+
+def set_rate(rate, burst=1, name=None):
+    """Limits writes without response to the peripheral called name, or
+    by default to every peripheral, to rate a second, in bursts of up to
+    burst; None for no limit."""
+
+    global default_rate, default_burst
+
+    with lock:
+        if name is None:
+            default_rate, default_burst = rate, burst
+            targets = queues.values()
+        else:
+            targets = [queues.setdefault(name, WriteQueue(name))]
+    for target in targets:
+        with target.condition:
+            target.rate, target.burst = rate, burst
+            target.tokens = min(target.tokens, float(burst))
+            target.condition.notify_all()
+
+def stats():
+    """WriteQueue.stats() for each peripheral written to, by name."""
+    with lock:
+        return dict((name, write_queue.stats()) for name, write_queue in queues.items())
+
+def reset():
+    with lock:
+        queues.clear()
@@ -0,0 +1,328 @@
+"""The replay backend: serves a trace that hello.pybt.trace recorded back
+to the program, in place of the peripherals it was recorded from.
+
+    PYBT_BACKEND=replay PYBT_REPLAY=dfu.trace python band_dfu.py ...
+
+Each request the program makes is answered by the next recorded request
+of the same kind on the same attribute, with the recorded data, result,
+timeout or missing attribute.  Writes whose data differs from what was
+recorded are answered all the same, but logged and counted as
+mismatches; a request the trace does not have raises ReplayError.  Each
+notification is delivered once the program has made the request
+recorded before it, so that notifications keep their place between the
+requests that caused them.
+
+With PYBT_REPLAY_SPEED=recorded, the default, requests take as long as
+they did and notifications keep their recorded spacing; with fast, all
+of it happens as fast as possible, which leaves the program's own time,
+e.g. for benchmarking its hot paths against real traces.
+"""
+
+import logging as log
+import os
+import threading
+import time
+
+import hello.pybt.metrics as metrics
+import hello.pybt.scanning as scanning
+import hello.pybt.timeouts as timeouts
+from hello.pybt.ringbuffer import QueuedSubscription, DEFAULT_CAPACITY, DROP_OLDEST, DEFAULT_BLOCK_TIMEOUT
+from hello.pybt.simulated import start_async
+from hello.pybt.trace import read_trace, REQUESTS, FIND, DISCOVER, READ, WRITE, WRITE_NO_CONFIRM, SUBSCRIBE, \
+    MAX_PAYLOAD, NOTIFY, PERIPHERAL, TIMED_OUT, MISSING
+
+class ReplayError(Exception):
+    """The program made a request the trace does not have."""
+
+class Replay(object):
+    def __init__(self, records, realtime=True):
+        self.records = records
+        self.realtime = realtime
+        self.requests = [index for index, record in enumerate(records) if record.kind in REQUESTS]
+        self.cursor = 0  # into requests: everything before it has been made
+        self.made = {}  # record index -> time.time() the program made that request
+        self.subscriptions = {}  # (peripheral, path) -> [ReplaySubscription]
+        self.condition = threading.Condition()
+        self.started = time.time()
+        self.mismatches = 0
+        self.delivered = 0
+        self.undelivered = 0  # notifications with no subscription to go to
+
+        thread = threading.Thread(target=self._notify, name='pybt-replay')
+        thread.daemon = True
+        thread.start()
+
+    def take(self, kind, peripheral, path, data=None):
+        """Answers the program's request with the first recorded one that
+        matches and has not been made, and returns its record."""
+
+        with self.condition:
+            for position in range(self.cursor, len(self.requests)):
+                index = self.requests[position]
+                record = self.records[index]
+                if index not in self.made and record.kind == kind and record.peripheral == peripheral and record.path == path:
+                    break
+            else:
+                raise ReplayError('the trace has no more requests of kind %d for %s %s' % (kind, peripheral, path))
+            self.made[index] = time.time()
+            while self.cursor < len(self.requests) and self.requests[self.cursor] in self.made:
+                self.cursor += 1
+            self.condition.notify_all()
+
+        if data is not None and record.args[0] != data:
+            self.mismatches += 1
+            log.warning('replay: %s %s written %r, but %r was recorded' % (peripheral, path, data, record.args[0]))
+        if self.realtime:
+            time.sleep(record.duration)
+        if record.outcome == TIMED_OUT:
+            raise timeouts.timed_out('%s %s' % (peripheral, path))
+        if record.outcome == MISSING:
+            raise KeyError(path)
+        return record
+
+    def _notify(self):
+        previous = None  # the request recorded before the notification
+        for index, record in enumerate(self.records):
+            if record.kind in REQUESTS:
+                previous = index
+                continue
+            if record.kind != NOTIFY:
+                continue
+
+            with self.condition:
+                while previous is not None and previous not in self.made:
+                    self.condition.wait()
+                if previous is None:
+                    due = self.started + record.time
+                else:
+                    due = self.made[previous] + record.time - self.records[previous].time
+            if self.realtime and due > time.time():
+                time.sleep(due - time.time())
+
+            subscriptions = list(self.subscriptions.get((record.peripheral, record.path), []))
+            if not subscriptions:
+                self.undelivered += 1
+            for subscription in subscriptions:
+                subscription._deliver(record.args[0])
+                self.delivered += 1
+
+    def add_subscription(self, subscription):
+        key = (subscription.characteristic.peripheral, subscription.characteristic.path)
+        with self.condition:
+            self.subscriptions.setdefault(key, []).append(subscription)
+
+    def remove_subscription(self, subscription):
+        key = (subscription.characteristic.peripheral, subscription.characteristic.path)
+        with self.condition:
+            if subscription in self.subscriptions.get(key, []):
+                self.subscriptions[key].remove(subscription)
+
+    def peripherals(self):
+        """The records of the peripherals scans found, once each."""
+        seen = {}
+        for record in self.records:
+            if record.kind == PERIPHERAL and record.args[0] not in seen:
+                seen[record.args[0]] = record
+        return seen.values()
+
+    def __str__(self):
+        return '%d of %d requests made, %d notifications delivered (%d with no subscription), %d mismatched writes' % (
+            len(self.made), len(self.requests), self.delivered, self.undelivered, self.mismatches)
+
+current_lock = threading.Lock()
+current_replay = None
+
+def load(path, realtime=True):
+    """Replays the trace at path from now on, instead of PYBT_REPLAY's,
+    and returns its Replay."""
+
+    global current_replay
+    with current_lock:
+        current_replay = Replay(read_trace(path), realtime)
+        return current_replay
+
+def replay():
+    global current_replay
+    with current_lock:
+        if current_replay is None:
+            if not os.environ.get('PYBT_REPLAY'):
+                raise ReplayError('set PYBT_REPLAY to the trace to replay')
+            current_replay = Replay(read_trace(os.environ['PYBT_REPLAY']),
+                                    os.environ.get('PYBT_REPLAY_SPEED', 'recorded') != 'fast')
+        return current_replay
+
+# the stand-ins for what was recorded
+
+# what hello.pybt.metrics records an operation under
+
+def attribute_key(attribute, *args):
+    return attribute.peripheral, attribute.UUID()
+
+def child_key(attribute, item):
+    return attribute.peripheral, item
+
+class ReplayAttribute(object):
+    def __init__(self, peripheral, path):
+        self.peripheral = peripheral  # its name
+        self.path = path
+
+    def UUID(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    def _child_path(self, item):
+        return '%s/%s' % (self.path, item.upper()) if self.path else item.upper()
+
+    def _child(self, child_class, item):
+        path = self._child_path(item)
+        replay().take(DISCOVER, self.peripheral, path)
+        return child_class(self.peripheral, path)
+
+    def getitem_async(self, item, callback):
+        return start_async(lambda: self[item], callback)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and (other.peripheral, other.path) == (self.peripheral, self.path)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.peripheral, self.path))
+
+    def __repr__(self):
+        return '<%s %s %s>' % (type(self).__name__, self.peripheral, self.path)
+
+class ReplayDescriptor(ReplayAttribute):
+    pass
+
+class ReplaySubscription(QueuedSubscription):
+    def __init__(self, characteristic, callback, capacity=DEFAULT_CAPACITY, overflow=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT):
+        QueuedSubscription.__init__(self, capacity, overflow, block_timeout)
+        self.characteristic = characteristic
+        self.callback = callback
+
+    def _deliver(self, data):
+        if metrics.enabled:
+            metrics.notified(attribute_key(self.characteristic), len(data), None if self.callback else len(self.data_queue))
+        if self.callback:
+            self.callback(self.characteristic, bytearray(data))
+        else:
+            self.data_queue.put(bytearray(data))
+
+    def unsubscribe(self):
+        replay().remove_subscription(self)
+
+class ReplayCharacteristic(ReplayAttribute):
+    @metrics.timed('sync_read', attribute_key)
+    def sync_read(self, timeout=None):
+        return bytearray(replay().take(READ, self.peripheral, self.path).args[0])
+
+    @metrics.timed('write_confirm', attribute_key, payload=True)
+    def write_confirm(self, value, timeout=None):
+        return replay().take(WRITE, self.peripheral, self.path, str(bytearray(value))).args[1]
+
+    @metrics.timed('write_no_confirm', attribute_key, payload=True)
+    def write_no_confirm(self, value):
+        return replay().take(WRITE_NO_CONFIRM, self.peripheral, self.path, str(bytearray(value))).args[1]
+
+    @metrics.timed('subscribe', attribute_key)
+    def subscribe(self, callback=None, capacity=DEFAULT_CAPACITY, overflow=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT, timeout=None):
+        # subscribed before the request is made, which releases the
+        # notifications recorded after it
+        subscription = ReplaySubscription(self, callback, capacity, overflow, block_timeout)
+        replay().add_subscription(subscription)
+        try:
+            replay().take(SUBSCRIBE, self.peripheral, self.path)
+        except Exception:
+            replay().remove_subscription(subscription)
+            raise
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.unsubscribe()
+
+    def __getitem__(self, item):
+        return self._child(ReplayDescriptor, item)
+
+    def read_async(self, callback):
+        return start_async(self.sync_read, callback)
+
+    def write_async(self, value, callback):
+        return start_async(lambda: self.write_confirm(value), callback)
+
+class ReplayService(ReplayAttribute):
+    @metrics.timed('discover', child_key)
+    def __getitem__(self, item):
+        return self._child(ReplayCharacteristic, item)
+
+class ReplayPeripheral(ReplayAttribute):
+    def __init__(self, name, identifier):
+        ReplayAttribute.__init__(self, name, '')
+        self.identifier = identifier
+
+    def name(self):
+        return self.peripheral
+
+    @metrics.timed('discover', child_key)
+    def __getitem__(self, item):
+        return self._child(ReplayService, item)
+
+# the backend
+
+def set_discovery_plan(identifier, plan):
+    pass
+
+def peripheral_identifier(peripheral):
+    return peripheral.identifier
+
+def peripheral_max_payload(peripheral):
+    try:
+        return replay().take(MAX_PAYLOAD, peripheral.peripheral, '').args[0]
+    except ReplayError:
+        # not asked for when the trace was recorded
+        return None
+
+def start_scan(service_uuids_wanted=None):
+    replay()
+
+def stop_scan():
+    pass
+
+def find_peripheral_by_name(name, timeout=None):
+    try:
+        record = replay().take(FIND, name, '')
+        return ReplayPeripheral(name, record.args[0])
+    except ReplayError:
+        # found by a scan instead
+        for record in replay().peripherals():
+            if record.peripheral == name:
+                return ReplayPeripheral(name, record.args[0])
+        raise
+
+def find_all_peripherals(timeout=5):
+    return [ReplayPeripheral(record.peripheral, record.args[0]) for record in replay().peripherals()]
+
+class ReplayScan(object):
+    def __init__(self, service_uuids, name_prefix, min_rssi):
+        self.results = []
+        for record in replay().peripherals():
+            identifier, rssi = record.args[:2]
+            result = scanning.ScanResult(
+                ReplayPeripheral(record.peripheral, identifier), identifier, record.peripheral,
+                rssi if rssi is not None else scanning.RSSI_UNAVAILABLE,
+                {scanning.LOCAL_NAME_KEY: record.peripheral, scanning.SERVICE_UUIDS_KEY: list(record.args[2:])})
+            if scanning.matches(result, service_uuids, name_prefix, min_rssi):
+                self.results.append(result)
+
+    def next(self, timeout=None):
+        return self.results.pop(0) if self.results else None
+
+    def stop(self):
+        self.results = []
+
+def start_filtered_scan(service_uuids=None, name_prefix=None, min_rssi=None):
+    """See hello.pybt.scanning; the peripherals the trace's scans found."""
+    return ReplayScan(service_uuids, name_prefix, min_rssi)
+
+def find_peripheral_by_name_async(name, callback):
+    return start_async(lambda: find_peripheral_by_name(name), callback)
@@ -0,0 +1,183 @@
+"""The fixed-capacity queue behind each subscription.
+
+When notifications arrive faster than they are read, the queue fills up
+to its capacity, and then its overflow policy decides what gives:
+
+* DROP_OLDEST discards the oldest queued notification, so a slow reader
+  sees the most recent data.  This is the default.
+* DROP_NEWEST discards the notification that just arrived.
+* BLOCK makes the producer wait for room, for up to block_timeout
+  seconds, and then drops the new notification.  With CoreBluetooth the
+  producer is the Bluetooth queue, so this stalls every other callback
+  too; keep block_timeout short.
+
+PyBT.m implements the same queue natively; RingBuffer is the version the
+simulated and daemon backends use, through QueuedSubscription.
+"""
+
+import threading
+import time
+
+import hello.pybt.timeouts as timeouts
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)  # in the order of HEOverflowPolicy in PyBT.m
+
+DEFAULT_CAPACITY = 16384
+DEFAULT_BLOCK_TIMEOUT = 0.1
+
+STATS = ('capacity', 'queued', 'high_water_mark', 'received', 'dropped', 'blocked')
+
+class RingBuffer(object):
+    def __init__(self, capacity=DEFAULT_CAPACITY, overflow=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        if overflow not in POLICIES:
+            raise ValueError('overflow must be one of %s' % ', '.join(POLICIES))
+
+        self.slots = [None] * capacity
+        self.head = 0
+        self.count = 0
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.condition = threading.Condition()
+
+        self.high_water_mark = 0
+        self.received = 0
+        self.dropped = 0
+        self.blocked = 0
+
+    def put(self, item):
+        """Queues item, and returns False if it was dropped."""
+
+        capacity = len(self.slots)
+        with self.condition:
+            self.received += 1
+
+            if self.count == capacity and self.overflow == BLOCK:
+                self.blocked += 1
+                # woken by every put and get, so wait out the rest of
+                # block_timeout while there is still no room
+                until = time.time() + self.block_timeout
+                while self.count == capacity:
+                    left = until - time.time()
+                    if left <= 0:
+                        break
+                    self.condition.wait(left)
+
+            if self.count == capacity:
+                self.dropped += 1
+                if self.overflow != DROP_OLDEST:
+                    return False
+                self.slots[self.head] = None
+                self.head = (self.head + 1) % capacity
+                self.count -= 1
+
+            self.slots[(self.head + self.count) % capacity] = item
+            self.count += 1
+            self.high_water_mark = max(self.high_water_mark, self.count)
+            self.condition.notify_all()
+            return True
+
+    def _take(self):
+        item = self.slots[self.head]
+        self.slots[self.head] = None
+        self.head = (self.head + 1) % len(self.slots)
+        self.count -= 1
+        return item
+
+    def _wait(self, timeout):
+        if timeout is None:
+            while not self.count:
+                self.condition.wait()
+            return True
+        until = time.time() + timeout
+        while not self.count:
+            left = until - time.time()
+            if left <= 0:
+                break
+            self.condition.wait(left)
+        return self.count > 0
+
+    def get_many(self, count, timeout=None):
+        """Returns up to count items: waits up to timeout seconds (None
+        for ever) for the first, and takes whatever else is queued."""
+
+        with self.condition:
+            if not self._wait(timeout):
+                return []
+            items = [self._take() for i in range(min(count, self.count))]
+            # room for a blocked producer
+            self.condition.notify_all()
+            return items
+
+    def get(self, timeout=None):
+        """Returns the oldest item, or None on timeout."""
+        items = self.get_many(1, timeout)
+        return items[0] if items else None
+
+    def __len__(self):
+        return self.count
+
+    def stats(self):
+        with self.condition:
+            return dict(zip(STATS, (
+                len(self.slots), self.count, self.high_water_mark, self.received, self.dropped, self.blocked)))
+
+class QueuedSubscription(object):
+    """The reading side of a subscription whose notifications are put
+    in data_queue: what hello.pybt documents for subscriptions, less
+    unsubscribe()."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, overflow=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT):
+        self.data_queue = RingBuffer(capacity, overflow, block_timeout)
+        self.partial = None  # what read_into() left of a notification
+
+    def _next(self, timeout):
+        if self.partial is not None:
+            data, self.partial = self.partial, None
+            return data
+        data = self.data_queue.get(timeouts.remaining(timeout))
+        if data is None and timeouts.expired():
+            raise timeouts.timed_out('read')
+        return data
+
+    def stats(self):
+        """See hello.pybt.corebluetooth.subscription_stats."""
+        return self.data_queue.stats()
+
+    def read(self, timeout=None):
+        data = self._next(timeout)
+        if data is None:
+            raise timeouts.timed_out('read()', timeout)
+        return data
+
+    def read_many(self, count, timeout=None):
+        """See hello.pybt.corebluetooth.subscription_read_many."""
+        packets = []
+        data = self._next(timeout)
+        while data is not None:
+            packets.append(data)
+            if len(packets) == count:
+                break
+            data = self._next(0)
+        return packets
+
+    def read_into(self, buffer, offset=0, timeout=None):
+        """See hello.pybt.corebluetooth.subscription_read_into."""
+        length = len(buffer) - offset
+        copied = 0
+        data = self._next(timeout) if length > 0 else None
+        while data is not None:
+            n = min(len(data), length - copied)
+            buffer[offset+copied:offset+copied+n] = bytes(data[:n])
+            copied += n
+            if n < len(data):
+                self.partial = data[n:]
+                break
+            if copied == length:
+                break
+            data = self._next(0)
+        return copied
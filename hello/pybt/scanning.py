@@ -0,0 +1,48 @@
+"""What hello.pybt.scan() yields, and the filter every backend applies.
+
+A backend's start_filtered_scan(service_uuids, name_prefix, min_rssi)
+returns a scanner whose next(timeout) returns the next ScanResult that
+passes the filter, or None after timeout seconds, and whose stop() ends
+it.  Each peripheral is returned once per scanner, by identifier, and the
+peripherals already discovered come first, so a scan for devices in
+range returns as soon as the scanner is started.  With CoreBluetooth the
+filtering and deduplication happen in PyBT.m, on the Bluetooth queue.
+"""
+
+# the CoreBluetooth advertisement data keys
+LOCAL_NAME_KEY = 'kCBAdvDataLocalName'
+SERVICE_UUIDS_KEY = 'kCBAdvDataServiceUUIDs'
+
+# CoreBluetooth's RSSI when it has none
+RSSI_UNAVAILABLE = 127
+
+class ScanResult(object):
+    def __init__(self, peripheral, identifier, name, rssi, advertisement_data):
+        self.peripheral = peripheral
+        self.identifier = identifier
+        self.name = name
+        self.rssi = rssi
+        self.advertisement_data = advertisement_data
+
+    @property
+    def service_uuids(self):
+        """The service UUIDs the peripheral advertised."""
+        return self.advertisement_data.get(SERVICE_UUIDS_KEY, [])
+
+    def __repr__(self):
+        return '<ScanResult %s %s, RSSI %d>' % (self.name, self.identifier, self.rssi)
+
+def matches(result, service_uuids=None, name_prefix=None, min_rssi=None):
+    """Whether result passes a scan's filter: it advertises one of
+    service_uuids, its name starts with name_prefix, and its RSSI is at
+    least min_rssi, where each is given."""
+
+    if min_rssi is not None and (result.rssi == RSSI_UNAVAILABLE or result.rssi < min_rssi):
+        return False
+    if name_prefix is not None and not (result.name or '').startswith(name_prefix):
+        return False
+    if service_uuids is not None:
+        advertised = set(uuid.upper() for uuid in result.service_uuids)
+        if not any(uuid.upper() in advertised for uuid in service_uuids):
+            return False
+    return True
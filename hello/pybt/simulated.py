@@ -0,0 +1,542 @@
+"""The simulated backend: peripherals are Python objects in this process,
+and a Link between each one and the central models the radio.
+
+    import hello.pybt as pybt
+    import hello.pybt.simulated as simulated
+    from hello.band.simulator import SimulatedBand
+
+    pybt.use_backend('simulated')
+    band = SimulatedBand('Band', link=simulated.Link(mtu=23, latency=0.01, jitter=0.005))
+    simulated.add_peripheral(band.peripheral)
+
+After that, hello.band.Band('Band') and the scripts work as they would
+against hardware.  Peripherals are found as soon as they are added; there
+is no advertising delay.
+"""
+
+import logging as log
+import Queue
+import random
+import threading
+import time
+import uuid
+
+import hello.pybt.gattcache as gattcache
+import hello.pybt.metrics as metrics
+import hello.pybt.pacing as pacing
+import hello.pybt.scanning as scanning
+import hello.pybt.timeouts as timeouts
+from hello.pybt.ringbuffer import QueuedSubscription, DEFAULT_CAPACITY, DROP_OLDEST, DEFAULT_BLOCK_TIMEOUT
+
+class Channel(object):
+    """One direction of a Link.  Deliveries happen in order, each after
+    the link's delay, and at most one every interval seconds."""
+
+    def __init__(self, link, interval=0.0):
+        self.link = link
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_due = 0.0
+        self.deliveries = None
+
+    def send(self, function, *args):
+        """Calls function(*args) on the far side."""
+
+        if not (self.link.latency or self.link.jitter or self.interval):
+            function(*args)
+            return
+
+        with self.lock:
+            due = max(time.time() + self.link.delay(), self.last_due + self.interval)
+            self.last_due = due
+            if self.deliveries is None:
+                self.deliveries = Queue.Queue()
+                thread = threading.Thread(target=self._deliver)
+                thread.daemon = True
+                thread.start()
+            self.deliveries.put((due, function, args))
+
+    def _deliver(self):
+        while True:
+            due, function, args = self.deliveries.get()
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            function(*args)
+
+class Link(object):
+    """The radio between the central and one peripheral.
+
+    mtu is the ATT MTU, so writes without response and notifications carry
+    at most mtu - 3 bytes.  Everything that crosses the link takes latency
+    seconds, plus up to jitter more, but arrives in order.  The peripheral
+    sends at most one notification every notification_interval seconds.
+    Writes without response and notifications are lost with probability
+    loss; reads, writes with response and discovery are acknowledged, so
+    they only pay the round trip.
+
+    The central sends at most one write without response every
+    write_interval seconds.  With tx_buffers, it has that many transmit
+    buffers for them, each held until its write has crossed the link;
+    hello.pybt.pacing waits for one to be free, and without pacing, a
+    write that finds them all full is dropped, and counted in overruns.
+    """
+
+    def __init__(self, mtu=23, latency=0.0, jitter=0.0, notification_interval=0.0, loss=0.0, seed=None,
+            write_interval=0.0, tx_buffers=None):
+        self.mtu = mtu
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.tx_buffers = tx_buffers
+        self.in_flight = 0  # writes without response holding one of tx_buffers
+        self.lock = threading.Lock()
+
+        self.to_peripheral = Channel(self, write_interval)
+        self.to_central = Channel(self, notification_interval)
+
+        self.writes = 0
+        self.notifications = 0
+        self.lost = 0
+        self.overruns = 0
+
+    @property
+    def max_payload(self):
+        return self.mtu - 3
+
+    def delay(self):
+        if self.jitter:
+            return self.latency + self.random.uniform(0, self.jitter)
+        return self.latency
+
+    def round_trip(self, description='round trip', timeout=None):
+        """Sleeps for a request and its response, but no longer than
+        timeout or the current deadline allow."""
+
+        delay = self.delay() + self.delay()
+        limit = timeouts.remaining(timeout)
+        if limit is not None and delay > limit:
+            time.sleep(limit)
+            raise timeouts.timed_out(description, timeout)
+        if delay:
+            time.sleep(delay)
+
+    def take_buffer(self):
+        """Claims a transmit buffer, and returns whether one was free."""
+        if self.tx_buffers is None:
+            return True
+        with self.lock:
+            if self.in_flight >= self.tx_buffers:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release_buffer(self):
+        if self.tx_buffers is not None:
+            with self.lock:
+                self.in_flight -= 1
+
+    def lose(self):
+        if self.loss and self.random.random() < self.loss:
+            self.lost += 1
+            return True
+        return False
+
+#
+
+# what a characteristic's written() returns when the peripheral never
+# acknowledges a write, e.g. because it resets
+NO_RESPONSE = 'no response'
+
+# what hello.pybt.metrics records an operation under
+
+def characteristic_key(characteristic, *args):
+    return characteristic.service.peripheral.name(), characteristic.uuid
+
+def service_key(service, item):
+    return service.peripheral.name(), item
+
+def peripheral_key(peripheral, item):
+    return peripheral.name(), item
+
+class SimulatedSubscription(QueuedSubscription):
+    def __init__(self, characteristic, callback, capacity=DEFAULT_CAPACITY, overflow=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT):
+        QueuedSubscription.__init__(self, capacity, overflow, block_timeout)
+        self.characteristic = characteristic
+        self.callback = callback
+
+    def _deliver(self, data):
+        if metrics.enabled:
+            metrics.notified(characteristic_key(self.characteristic), len(data), None if self.callback else len(self.data_queue))
+        if self.callback:
+            self.callback(self.characteristic, bytearray(data))
+        else:
+            self.data_queue.put(bytearray(data))
+
+    def unsubscribe(self):
+        if self in self.characteristic.subscriptions:
+            self.characteristic.subscriptions.remove(self)
+
+class SimulatedCharacteristic(object):
+    """written(data, confirm) is called on the peripheral's side of the
+    link for every write, and returns whether it succeeded, or NO_RESPONSE;
+    by default the data becomes the characteristic's value.  read(), if
+    given, returns the value for sync_read().  The peripheral sends
+    notifications with notify().
+    """
+
+    def __init__(self, uuid, written=None, read=None, descriptors=()):
+        self.uuid = uuid
+        self.written = written or self._store
+        self.read = read
+        self.value = bytearray()
+        self.descriptors = dict((descriptor.UUID().upper(), descriptor) for descriptor in descriptors)
+        self.subscriptions = []
+        self.service = None
+
+    def UUID(self):
+        return self.uuid
+
+    @property
+    def link(self):
+        return self.service.peripheral.link
+
+    def _store(self, data, confirm):
+        self.value = data
+        return True
+
+    @metrics.timed('sync_read', characteristic_key)
+    def sync_read(self, timeout=None):
+        self.link.round_trip('sync_read()', timeout)
+        return bytearray(self.read() if self.read else self.value)
+
+    @metrics.timed('write_confirm', characteristic_key, payload=True)
+    def write_confirm(self, value, timeout=None):
+        data = bytearray(value)
+        self.link.writes += 1
+        self.link.round_trip('write_confirm()', timeout)
+        result = self.written(data, True)
+        if result is NO_RESPONSE:
+            limit = timeouts.remaining(timeout)
+            time.sleep(limit if limit is not None else 2**31)
+            raise timeouts.timed_out('write_confirm()', timeout)
+        return result
+
+    @metrics.timed('write_no_confirm', characteristic_key, payload=True)
+    def write_no_confirm(self, value):
+        data = bytearray(value)
+        link = self.link
+        if len(data) > link.max_payload:
+            log.warning('write_no_confirm: %d bytes do not fit in an MTU of %d' % (len(data), link.mtu))
+            return False
+
+        write_queue = pacing.queue(self.service.peripheral.name())
+        if pacing.enabled:
+            try:
+                write_queue.wait(link.take_buffer)
+            except timeouts.TimeoutError:
+                if timeouts.expired():
+                    raise
+                write_queue.sent(data, False)
+                return False
+        elif not link.take_buffer():
+            # the stack drops it, and says nothing
+            link.writes += 1
+            link.overruns += 1
+            link.lost += 1
+            write_queue.sent(data, True)
+            return True
+
+        link.writes += 1
+        write_queue.sent(data, True)
+        if link.lose():
+            self._transmitted(write_queue)
+            return True
+        if link.tx_buffers is None and not (link.latency or link.jitter or link.to_peripheral.interval):
+            self._transmitted(write_queue)
+            return self.written(data, False)
+        link.to_peripheral.send(self._written_without_response, data, write_queue)
+        return True
+
+    def _transmitted(self, write_queue):
+        self.link.release_buffer()
+        write_queue.signal()
+
+    def _written_without_response(self, data, write_queue):
+        self._transmitted(write_queue)
+        self.written(data, False)
+
+    @metrics.timed('subscribe', characteristic_key)
+    def subscribe(self, callback=None, capacity=DEFAULT_CAPACITY, overflow=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT, timeout=None):
+        self.link.round_trip('subscribe()', timeout)
+        subscription = SimulatedSubscription(self, callback, capacity, overflow, block_timeout)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.unsubscribe()
+
+    def notify(self, data):
+        """Sends data to every subscriber, as the peripheral."""
+        link = self.link
+        data = bytearray(data)[:link.max_payload]
+        for subscription in list(self.subscriptions):
+            link.notifications += 1
+            if not link.lose():
+                link.to_central.send(subscription._deliver, data)
+
+    def __getitem__(self, item):
+        peripheral = self.service.peripheral
+        gattcache.before_lookup(peripheral.identifier, (self.service.uuid, self.uuid, item), peripheral.discover_all)
+        return self.descriptors[item.upper()]
+
+    def read_async(self, callback):
+        return start_async(self.sync_read, callback)
+
+    def write_async(self, value, callback):
+        return start_async(lambda: self.write_confirm(value), callback)
+
+class SimulatedDescriptor(object):
+    def __init__(self, uuid, value=None):
+        self.uuid = uuid
+        self.value = value
+
+    def UUID(self):
+        return self.uuid
+
+class SimulatedService(object):
+    def __init__(self, uuid, characteristics):
+        self.uuid = uuid
+        self.characteristics = dict((c.UUID().upper(), c) for c in characteristics)
+        self.peripheral = None
+        for characteristic in characteristics:
+            characteristic.service = self
+
+    def UUID(self):
+        return self.uuid
+
+    @metrics.timed('discover', service_key)
+    def __getitem__(self, item):
+        gattcache.before_lookup(self.peripheral.identifier, (self.uuid, item), self.peripheral.discover_all)
+        characteristic = self.characteristics[item.upper()]
+        if characteristic not in self.peripheral.discovered:
+            self.peripheral.discover_all()
+        return characteristic
+
+    def getitem_async(self, item, callback):
+        return start_async(lambda: self[item], callback)
+
+class SimulatedPeripheral(object):
+    """identifier defaults to one derived from name, so that it is the
+    same in every run, as CoreBluetooth's is.  The peripheral advertises
+    its name and advertised_services, by default all its services, and
+    is heard at rssi."""
+
+    def __init__(self, name, services, link=None, identifier=None, rssi=-60, advertised_services=None):
+        self._name = name
+        self.link = link or Link()
+        self.identifier = identifier or str(uuid.uuid5(uuid.NAMESPACE_DNS, name)).upper()
+        self.services = dict((s.UUID().upper(), s) for s in services)
+        self.rssi = rssi
+        self.advertised_services = advertised_services if advertised_services is not None else [s.UUID() for s in services]
+        for service in services:
+            service.peripheral = self
+
+        self.lock = threading.Lock()
+        self.connected = False
+        self.discovered = set()  # services, characteristics and descriptors
+        self.discovery_round_trips = 0
+
+    def name(self):
+        return self._name
+
+    def scan_result(self):
+        return scanning.ScanResult(self, self.identifier, self._name, self.rssi, {
+            scanning.LOCAL_NAME_KEY: self._name,
+            scanning.SERVICE_UUIDS_KEY: list(self.advertised_services)})
+
+    def connect(self):
+        """Discovers attributes the way the CoreBluetooth backend does on
+        connecting: everything, or only what the discovery plan lists.
+        Each request is a round trip over the link."""
+
+        with self.lock:
+            if self.connected:
+                return
+            self.connected = True
+            self._discover(discovery_plans.get(self.identifier))
+
+    def discover_all(self):
+        with self.lock:
+            self._discover(None)
+
+    def _discover(self, plan):
+        def planned(attributes, plan):
+            if plan is None:
+                return attributes.items()
+            plan = dict((uuid.upper(), entry) for uuid, entry in plan.items())
+            return [(uuid, attribute) for uuid, attribute in attributes.items() if uuid in plan]
+
+        def plan_entry(plan, uuid):
+            return dict((uuid.upper(), entry) for uuid, entry in plan.items()).get(uuid) if plan is not None else None
+
+        self._round_trip()
+        for service_uuid, service in planned(self.services, plan):
+            self.discovered.add(service)
+            characteristics_plan = plan_entry(plan, service_uuid)
+            self._round_trip()
+            for characteristic_uuid, characteristic in planned(service.characteristics, characteristics_plan):
+                self.discovered.add(characteristic)
+                descriptors_plan = plan_entry(characteristics_plan, characteristic_uuid)
+                if plan is None or descriptors_plan:
+                    self._round_trip()
+                    self.discovered.update(characteristic.descriptors.values())
+
+    def _round_trip(self):
+        self.discovery_round_trips += 1
+        self.link.round_trip()
+
+    @metrics.timed('discover', peripheral_key)
+    def __getitem__(self, item):
+        self.connect()
+        gattcache.check_firmware_revision(self.identifier, self._read_firmware_revision, self.discover_all)
+        gattcache.before_lookup(self.identifier, (item,), self.discover_all)
+        service = self.services[item.upper()]
+        if service not in self.discovered:
+            self.discover_all()
+        return service
+
+    def _read_firmware_revision(self, timeout):
+        service_uuid, characteristic_uuid = gattcache.FIRMWARE_REVISION_PATH
+        service = self.services.get(service_uuid)
+        characteristic = service.characteristics.get(characteristic_uuid) if service else None
+        if characteristic not in self.discovered:
+            return None
+        return str(characteristic.sync_read(timeout))
+
+    def getitem_async(self, item, callback):
+        return start_async(lambda: self[item], callback)
+
+    def __repr__(self):
+        return '<SimulatedPeripheral %s>' % self._name
+
+# asynchronous operations
+
+class SimulatedOperation(object):
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+def start_async(function, callback):
+    """Runs function on a thread of its own, and passes its result, or
+    None if it raised, to callback unless cancelled."""
+
+    operation = SimulatedOperation()
+
+    def run():
+        try:
+            result = function()
+        except Exception as e:
+            log.debug('simulated operation failed: %s' % e)
+            result = None
+        if not operation.cancelled:
+            callback(result)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return operation
+
+# the backend
+
+peripherals = []
+peripherals_condition = threading.Condition()
+discovery_plans = {}  # identifier -> plan, as in hello.pybt.gattcache
+
+def add_peripheral(peripheral):
+    """Makes peripheral discoverable."""
+    with peripherals_condition:
+        peripherals.append(peripheral)
+        peripherals_condition.notify_all()
+
+def remove_peripheral(peripheral):
+    with peripherals_condition:
+        if peripheral in peripherals:
+            peripherals.remove(peripheral)
+
+def set_discovery_plan(identifier, plan):
+    if plan is None:
+        discovery_plans.pop(identifier, None)
+    else:
+        discovery_plans[identifier] = plan
+
+def peripheral_identifier(peripheral):
+    return peripheral.identifier
+
+def peripheral_max_payload(peripheral):
+    return peripheral.link.max_payload
+
+def start_scan(service_uuids_wanted=None):
+    pass
+
+def stop_scan():
+    pass
+
+def find_peripheral_by_name(name, timeout=None):
+    timeout = timeouts.remaining(timeout)
+    until = time.time() + timeout if timeout is not None else None
+    with peripherals_condition:
+        while True:
+            for peripheral in peripherals:
+                if peripheral.name() == name:
+                    return peripheral
+            if until is None:
+                peripherals_condition.wait(2**31)
+            elif time.time() < until:
+                peripherals_condition.wait(until - time.time())
+            else:
+                raise timeouts.timed_out('find_peripheral_by_name(%r)' % name, timeout)
+
+def find_all_peripherals(timeout=5):
+    with peripherals_condition:
+        return list(peripherals)
+
+class SimulatedScan(object):
+    def __init__(self, service_uuids, name_prefix, min_rssi):
+        self.filter = dict(service_uuids=service_uuids, name_prefix=name_prefix, min_rssi=min_rssi)
+        self.seen = set()  # identifiers
+        self.stopped = False
+
+    def next(self, timeout=None):
+        until = time.time() + timeout if timeout is not None else None
+        with peripherals_condition:
+            while not self.stopped:
+                for peripheral in peripherals:
+                    if peripheral.identifier in self.seen:
+                        continue
+                    result = peripheral.scan_result()
+                    if scanning.matches(result, **self.filter):
+                        self.seen.add(peripheral.identifier)
+                        return result
+                if until is None:
+                    peripherals_condition.wait()
+                elif time.time() < until:
+                    peripherals_condition.wait(until - time.time())
+                else:
+                    break
+            return None
+
+    def stop(self):
+        with peripherals_condition:
+            self.stopped = True
+            peripherals_condition.notify_all()
+
+def start_filtered_scan(service_uuids=None, name_prefix=None, min_rssi=None):
+    """See hello.pybt.scanning."""
+    return SimulatedScan(service_uuids, name_prefix, min_rssi)
+
+def find_peripheral_by_name_async(name, callback):
+    return start_async(lambda: find_peripheral_by_name(name), callback)
@@ -0,0 +1,69 @@
+"""Timeouts and deadlines for blocking Bluetooth operations.
+
+Blocking operations take a timeout in seconds; None waits for ever,
+unless a deadline is in force on the calling thread:
+
+    with pybt.deadline(30):
+        band.connect()
+        data = band.hrs_read(samples)
+
+Everything inside the block, including lookups like peripheral[uuid] that
+cannot take a timeout, then raises TimeoutError once the 30 seconds are
+up.  Deadlines nest; the earliest one wins.  deadline(None) changes
+nothing, for functions that take an optional timeout.
+"""
+
+import contextlib
+import threading
+import time
+
+class TimeoutError(Exception):
+    """A Bluetooth operation did not finish in time."""
+    pass
+
+local = threading.local()
+
+def current_deadline():
+    """The time.time() by which operations on this thread have to finish,
+    or None."""
+    return getattr(local, 'deadline', None)
+
+@contextlib.contextmanager
+def deadline(seconds):
+    if seconds is None:
+        yield
+        return
+
+    outer = current_deadline()
+    inner = time.time() + seconds
+    local.deadline = inner if outer is None else min(inner, outer)
+    try:
+        yield
+    finally:
+        local.deadline = outer
+
+def remaining(timeout=None):
+    """How long an operation given timeout may wait, in seconds, taking
+    the current deadline into account; None for ever."""
+
+    until = current_deadline()
+    if until is None:
+        return timeout
+    left = max(0.0, until - time.time())
+    return left if timeout is None else min(timeout, left)
+
+def native(timeout=None):
+    """remaining(timeout) as PyBT.m takes it: negative waits for ever."""
+    timeout = remaining(timeout)
+    return -1.0 if timeout is None else timeout
+
+def expired():
+    until = current_deadline()
+    return until is not None and time.time() >= until
+
+def timed_out(description, timeout=None):
+    """The TimeoutError for description, which waited up to timeout, or
+    until the current deadline."""
+    if timeout is not None and not expired():
+        return TimeoutError('%s timed out after %.3gs' % (description, timeout))
+    return TimeoutError('%s missed its deadline' % description)
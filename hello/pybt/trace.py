@@ -0,0 +1,342 @@
+"""Records a program's Bluetooth traffic to a trace file, for the replay
+backend (hello.pybt.replay) to serve back to it later, without the
+hardware.
+
+Set PYBT_TRACE to a path, or call hello.pybt.record_trace(), before the
+first Bluetooth operation, and whichever backend runs is wrapped in a
+Recorder, which writes each lookup, read, write, subscription and
+notification to the file as it happens:
+
+    PYBT_TRACE=dfu.trace python band_dfu.py ...
+
+A trace is MAGIC, then one record after another:
+
+    RECORD      seconds since the trace began, values length, as '<dI'
+    values      the record's kind and values, encoded as hello.pybt.ipc
+                encodes them
+
+Every kind of request has its duration, outcome, peripheral name and the
+path of the attribute, its UUIDs joined by '/', first:
+
+    FIND                ... identifier
+    DISCOVER            ...
+    READ                ... data
+    WRITE               ... data, succeeded
+    WRITE_NO_CONFIRM    ... data, succeeded
+    SUBSCRIBE           ...
+    MAX_PAYLOAD         ... length
+
+and the rest are things that happened:
+
+    NOTIFY              peripheral name, path, data
+    UNSUBSCRIBE         peripheral name, path
+    PERIPHERAL          name, identifier, RSSI, advertised service UUIDs...
+
+Subscriptions deliver notifications through Python while recording, so
+CoreBluetooth's native queue is not used; recording is for diagnosis,
+not speed.
+"""
+
+import atexit
+import collections
+import struct
+import threading
+import time
+
+import hello.pybt.ipc as ipc
+import hello.pybt.scanning as scanning
+import hello.pybt.timeouts as timeouts
+from hello.pybt.ringbuffer import QueuedSubscription, DEFAULT_CAPACITY, DROP_OLDEST, DEFAULT_BLOCK_TIMEOUT
+
+MAGIC = 'PYBTTRC1'
+RECORD = struct.Struct('<dI')
+
+# kinds of record
+FIND = 1
+DISCOVER = 2
+READ = 3
+WRITE = 4
+WRITE_NO_CONFIRM = 5
+SUBSCRIBE = 6
+MAX_PAYLOAD = 7
+NOTIFY = 10
+UNSUBSCRIBE = 11
+PERIPHERAL = 12
+
+REQUESTS = (FIND, DISCOVER, READ, WRITE, WRITE_NO_CONFIRM, SUBSCRIBE, MAX_PAYLOAD)
+
+# a request's outcome
+OK = 0
+TIMED_OUT = 1
+MISSING = 2  # KeyError: the peripheral has no such attribute
+
+# duration and outcome are None for records that are not requests; args
+# are whatever else the record has
+Record = collections.namedtuple('Record', 'time kind duration outcome peripheral path args')
+
+class TraceWriter(object):
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        atexit.register(self.close)
+
+    def write(self, at, kind, *values):
+        data = ipc.encode((kind,) + values)
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(RECORD.pack(at - self.started, len(data)) + data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_trace(path):
+    """Returns the Records in the trace at path."""
+
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('%s is not a pybt trace' % path)
+
+    records = []
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        at, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break  # cut short, e.g. by a crash
+        values = ipc.decode(data[offset:offset+length])
+        offset += length
+        kind = values[0]
+        if kind in REQUESTS:
+            records.append(Record(at, kind, values[1], values[2], values[3], values[4], values[5:]))
+        elif kind == PERIPHERAL:
+            records.append(Record(at, kind, None, None, values[1], '', values[2:]))
+        else:
+            records.append(Record(at, kind, None, None, values[1], values[2], values[3:]))
+    return records
+
+# recording
+
+class Recorder(object):
+    """A backend that hands everything on to backend, a backend module,
+    and writes it to the trace at path."""
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.trace = TraceWriter(path)
+
+    def __getattr__(self, name):
+        # start_scan(), stop_scan(), set_discovery_plan()
+        return getattr(self.backend, name)
+
+    def request(self, kind, peripheral, path, function, extra=lambda result: ()):
+        """Returns function(), and records it as a kind of request with
+        the values extra(its result) adds."""
+
+        started = time.time()
+        try:
+            result = function()
+        except timeouts.TimeoutError:
+            self.trace.write(started, kind, time.time() - started, TIMED_OUT, peripheral, path)
+            raise
+        except KeyError:
+            self.trace.write(started, kind, time.time() - started, MISSING, peripheral, path)
+            raise
+        self.trace.write(started, kind, time.time() - started, OK, peripheral, path, *extra(result))
+        return result
+
+    def request_async(self, kind, peripheral, path, start, wrap, callback, extra=lambda result: ()):
+        """The asynchronous request(): start(completed) starts it, and
+        callback gets wrap(its result), or None."""
+
+        started = time.time()
+
+        def completed(result):
+            if result is None:
+                self.trace.write(started, kind, time.time() - started, TIMED_OUT, peripheral, path)
+                callback(None)
+            else:
+                self.trace.write(started, kind, time.time() - started, OK, peripheral, path, *extra(result))
+                callback(wrap(result))
+
+        return start(completed)
+
+    def _peripheral(self, peripheral, rssi=None, service_uuids=()):
+        recording = RecordingPeripheral(self, peripheral)
+        self.trace.write(time.time(), PERIPHERAL, recording.name(), recording.identifier, rssi, *service_uuids)
+        return recording
+
+    def peripheral_identifier(self, peripheral):
+        return peripheral.identifier
+
+    def peripheral_max_payload(self, peripheral):
+        return self.request(
+            MAX_PAYLOAD, peripheral.peripheral, '',
+            lambda: self.backend.peripheral_max_payload(peripheral.attribute),
+            lambda length: [length])
+
+    def find_peripheral_by_name(self, name, timeout=None):
+        return RecordingPeripheral(self, self.request(
+            FIND, name, '',
+            lambda: self.backend.find_peripheral_by_name(name, timeout),
+            lambda peripheral: [self.backend.peripheral_identifier(peripheral)]))
+
+    def find_peripheral_by_name_async(self, name, callback):
+        return self.request_async(
+            FIND, name, '',
+            lambda completed: self.backend.find_peripheral_by_name_async(name, completed),
+            lambda peripheral: RecordingPeripheral(self, peripheral),
+            callback,
+            lambda peripheral: [self.backend.peripheral_identifier(peripheral)])
+
+    def find_all_peripherals(self, timeout=5):
+        return [self._peripheral(peripheral) for peripheral in self.backend.find_all_peripherals(timeout)]
+
+    def start_filtered_scan(self, service_uuids=None, name_prefix=None, min_rssi=None):
+        return RecordingScan(self, self.backend.start_filtered_scan(service_uuids, name_prefix, min_rssi))
+
+class RecordingScan(object):
+    def __init__(self, recorder, scan):
+        self.recorder = recorder
+        self.scan = scan
+
+    def next(self, timeout=None):
+        result = self.scan.next(timeout)
+        if result is None:
+            return None
+        peripheral = self.recorder._peripheral(result.peripheral, result.rssi, result.service_uuids)
+        return scanning.ScanResult(peripheral, result.identifier, result.name, result.rssi, result.advertisement_data)
+
+    def stop(self):
+        self.scan.stop()
+
+class RecordingAttribute(object):
+    def __init__(self, recorder, attribute, peripheral, path):
+        self.recorder = recorder
+        self.attribute = attribute
+        self.peripheral = peripheral  # its name
+        self.path = path
+
+    def __getattr__(self, name):
+        return getattr(self.attribute, name)
+
+    def __eq__(self, other):
+        return isinstance(other, RecordingAttribute) and other.attribute == self.attribute
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.attribute)
+
+    def _child_path(self, item):
+        return '%s/%s' % (self.path, item.upper()) if self.path else item.upper()
+
+    def _child(self, child_class, item):
+        path = self._child_path(item)
+        child = self.recorder.request(DISCOVER, self.peripheral, path, lambda: self.attribute[item])
+        return child_class(self.recorder, child, self.peripheral, path)
+
+    def _child_async(self, child_class, item, callback):
+        path = self._child_path(item)
+        return self.recorder.request_async(
+            DISCOVER, self.peripheral, path,
+            lambda completed: self.attribute.getitem_async(item, completed),
+            lambda child: child_class(self.recorder, child, self.peripheral, path),
+            callback)
+
+class RecordingSubscription(QueuedSubscription):
+    def __init__(self, characteristic, callback, capacity, overflow, block_timeout):
+        QueuedSubscription.__init__(self, capacity, overflow, block_timeout)
+        self.characteristic = characteristic
+        self.callback = callback
+        self.subscription = None
+
+    def _deliver(self, characteristic, data):
+        characteristic = self.characteristic
+        characteristic.recorder.trace.write(time.time(), NOTIFY, characteristic.peripheral, characteristic.path, str(data))
+        if self.callback:
+            return self.callback(characteristic, data)
+        self.data_queue.put(bytearray(data))
+        return 0
+
+    def unsubscribe(self):
+        characteristic = self.characteristic
+        self.subscription.unsubscribe()
+        characteristic.recorder.trace.write(time.time(), UNSUBSCRIBE, characteristic.peripheral, characteristic.path)
+
+class RecordingCharacteristic(RecordingAttribute):
+    def sync_read(self, timeout=None):
+        return self.recorder.request(
+            READ, self.peripheral, self.path,
+            lambda: self.attribute.sync_read(timeout),
+            lambda data: [str(data)])
+
+    def write_confirm(self, value, timeout=None):
+        return self.recorder.request(
+            WRITE, self.peripheral, self.path,
+            lambda: self.attribute.write_confirm(value, timeout),
+            lambda succeeded: [str(bytearray(value)), bool(succeeded)])
+
+    def write_no_confirm(self, value):
+        return self.recorder.request(
+            WRITE_NO_CONFIRM, self.peripheral, self.path,
+            lambda: self.attribute.write_no_confirm(value),
+            lambda succeeded: [str(bytearray(value)), bool(succeeded)])
+
+    def subscribe(self, callback=None, capacity=DEFAULT_CAPACITY, overflow=DROP_OLDEST, block_timeout=DEFAULT_BLOCK_TIMEOUT, timeout=None):
+        subscription = RecordingSubscription(self, callback, capacity, overflow, block_timeout)
+        subscription.subscription = self.recorder.request(
+            SUBSCRIBE, self.peripheral, self.path,
+            lambda: self.attribute.subscribe(subscription._deliver, timeout=timeout))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.unsubscribe()
+
+    def __getitem__(self, item):
+        path = self._child_path(item)
+        return self.recorder.request(DISCOVER, self.peripheral, path, lambda: self.attribute[item])
+
+    def read_async(self, callback):
+        return self.recorder.request_async(
+            READ, self.peripheral, self.path,
+            lambda completed: self.attribute.read_async(completed),
+            lambda data: data,
+            callback,
+            lambda data: [str(data)])
+
+    def write_async(self, value, callback):
+        return self.recorder.request_async(
+            WRITE, self.peripheral, self.path,
+            lambda completed: self.attribute.write_async(value, completed),
+            lambda succeeded: succeeded,
+            callback,
+            lambda succeeded: [str(bytearray(value)), bool(succeeded)])
+
+class RecordingService(RecordingAttribute):
+    def __getitem__(self, item):
+        return self._child(RecordingCharacteristic, item)
+
+    def getitem_async(self, item, callback):
+        return self._child_async(RecordingCharacteristic, item, callback)
+
+class RecordingPeripheral(RecordingAttribute):
+    def __init__(self, recorder, peripheral):
+        RecordingAttribute.__init__(self, recorder, peripheral, peripheral.name(), '')
+        self.identifier = recorder.backend.peripheral_identifier(peripheral)
+
+    def name(self):
+        return self.peripheral
+
+    def __getitem__(self, item):
+        return self._child(RecordingService, item)
+
+    def getitem_async(self, item, callback):
+        return self._child_async(RecordingService, item, callback)
+
+    def __repr__(self):
+        return '<RecordingPeripheral %s>' % self.peripheral
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Check hello.band.peaks against simulated HRS runs of known heart rate,
+then time it against running peak detection in a subprocess, the way
+bandsh's pd used to.
+"""
+
+import argparse
+import cStringIO
+import os
+import subprocess
+import sys
+import timeit
+
+import numpy
+
+import hello.band.capture as capture
+import hello.band.peaks as peaks
+from hello.band.simulator import SimulatedBand
+
+# What bandsh's pd pays without research/peak_detect.py: a new interpreter,
+# and the run written out and parsed back as CSV.
+SUBPROCESS_BASELINE = '''
+import sys
+import numpy
+import hello.band.peaks
+samples = numpy.loadtxt(sys.stdin, dtype=numpy.uint8, ndmin=1)
+print hello.band.peaks.detect(samples, threshold=%r).bpm
+'''
+
+def waveform(heart_rate, samples):
+    return numpy.frombuffer(bytes(SimulatedBand(heart_rate=heart_rate, seed=1).hrs_waveform(samples)), numpy.uint8)
+
+def check(heart_rate, samples):
+    run = waveform(heart_rate, samples)
+    whole = peaks.detect(run)
+    assert abs(whole.bpm - heart_rate) <= 0.05 * heart_rate, (heart_rate, whole.bpm)
+
+    # the live stream's blocks must not matter
+    for block_size in [1, 20, 37, 1000]:
+        detector = peaks.PeakDetector()
+        for i in range(0, len(run), block_size):
+            detector.feed(run[i:i+block_size])
+        assert detector.peaks == whole.peaks, block_size
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description='Check and time hello.band.peaks.')
+    arg_parser.add_argument(
+        '-s', '--samples',
+        help='length of the simulated run to time, in samples. Defaults to 6000 (a minute).',
+        type=int,
+        default=6000)
+    arg_parser.add_argument(
+        '-t', '--threshold',
+        help='peak detection threshold, defaults to None',
+        type=float,
+        default=None)
+    arg_parser.add_argument(
+        '--peak-detect',
+        help='path to research/peak_detect.py, to time instead of the subprocess baseline')
+    args = arg_parser.parse_args(argv[1:])
+
+    for heart_rate in [45, 60, 72, 100, 150, 180]:
+        check(heart_rate, 3000)
+    print "hello.band.peaks finds 45-180 BPM within 5%"
+
+    run = waveform(72, args.samples)
+
+    if args.peak_detect:
+        command = ['python', os.path.basename(args.peak_detect)]
+        if args.threshold:
+            command += ['-t', '%u' % args.threshold]
+        command.append('100')
+        cwd = os.path.dirname(os.path.abspath(args.peak_detect))
+        label = 'peak_detect.py subprocess'
+    else:
+        command = [sys.executable, '-c', SUBPROCESS_BASELINE % args.threshold]
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        label = 'subprocess baseline'
+
+    def in_subprocess():
+        csv = cStringIO.StringIO()
+        capture.write_csv(run, csv)
+        process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process.communicate(csv.getvalue())
+
+    def in_blocks():
+        detector = peaks.PeakDetector(threshold=args.threshold)
+        for i in range(0, len(run), 20):
+            detector.feed(run[i:i+20])
+
+    def time_it(label, function):
+        seconds = min(timeit.repeat(function, number=1, repeat=3))
+        print "%-32s %10.2fms" % (label, seconds * 1000)
+        return seconds
+
+    subprocess_time = time_it(label, in_subprocess)
+    whole = time_it('peaks.detect', lambda: peaks.detect(run, threshold=args.threshold))
+    blocks = time_it('PeakDetector.feed, 20 samples', in_blocks)
+
+    print "%s BPM; speedup over subprocess: %.0fx whole run, %.0fx 20-sample blocks" % (
+        peaks.detect(run, threshold=args.threshold).bpm, subprocess_time / whole, subprocess_time / blocks)
+
+if __name__ == '__main__':
+    main(sys.argv)
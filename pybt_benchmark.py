@@ -0,0 +1,606 @@
+#!/usr/bin/env python
+
+"""
+Time hello.band.Band and hello.dfu against simulated peripherals, over a
+radio link with the given MTU, latency, jitter, notification rate and
+packet loss.  Needs no Bluetooth hardware.
+"""
+
+import argparse
+import logging as log
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import hello.pybt as pybt
+pybt.use_backend('simulated')
+os.environ.setdefault('PYBT_GATT_CACHE', '')
+
+import hello.band
+import hello.band.upload as upload
+import hello.dfu
+import hello.pybt.gattcache as gattcache
+import hello.pybt.metrics as metrics
+import hello.pybt.pacing as pacing
+import hello.pybt.ringbuffer as ringbuffer
+import hello.pybt.simulated as simulated
+from hello.band.collector import Collector
+from hello.band.simulator import SimulatedBand, SimulatedIngestServer
+from hello.dfu.checkpoint import Checkpoint
+from hello.dfu.fleet import Fleet
+from hello.dfu.image import FirmwareImage
+from hello.dfu.simulator import SimulatedBootloader
+
+def report(label, seconds, size, link):
+    print "%-28s %8.3fs %10.0f bytes/sec  (%d writes, %d notifications, %d lost)" % (
+        label, seconds, size / seconds if seconds else 0.0, link.writes, link.notifications, link.lost)
+
+def benchmark_hrs(args, link):
+    device = SimulatedBand('Band HRS', link=link, seed=args.seed)
+    simulated.add_peripheral(device.peripheral)
+
+    started = time.time()
+    band = hello.band.Band('Band HRS')
+    band.connect()
+    band.hrs_start(50, 0, args.samples)
+    data = band.hrs_read(args.samples)
+    report('Band.hrs_read %d samples' % args.samples, time.time() - started, len(data), link)
+
+def benchmark_imu(args, link):
+    device = SimulatedBand('Band IMU', link=link, seed=args.seed)
+    simulated.add_peripheral(device.peripheral)
+
+    started = time.time()
+    band = hello.band.Band('Band IMU')
+    band.connect()
+    data = band.test_imu()
+    report('Band.test_imu', time.time() - started, len(data), link)
+
+def benchmark_dfu(args, link):
+    bootloader = SimulatedBootloader('Band DFU', link=link)
+    simulated.add_peripheral(bootloader.peripheral)
+
+    with tempfile.NamedTemporaryFile(suffix='.bin') as file:
+        file.write(os.urandom(args.image_size))
+        file.flush()
+        image = FirmwareImage(file.name)
+
+        started = time.time()
+        peripheral = pybt.find_peripheral_by_name('Band DFU')
+        stats = hello.dfu.flash(peripheral, image, args.packet_notification_count, packet_size=args.packet_size)
+        report('hello.dfu.flash %d bytes' % len(image), time.time() - started, len(image), link)
+        print '    %s' % stats
+
+    bootloader.close()
+
+def benchmark_resume(args, link):
+    """Flashes bootloaders whose link drops at random, reconnecting and
+    calling hello.dfu.flash() with the same checkpoint until the image is
+    activated, once with a bootloader that keeps the partial image and
+    once with one that starts over, and checks the image that arrived."""
+
+    directory = tempfile.mkdtemp()
+    data = os.urandom(args.image_size)
+    path = os.path.join(directory, 'image.bin')
+    with open(path, 'wb') as file:
+        file.write(data)
+    image = FirmwareImage(path)
+
+    for resumable in (False, True):
+        name = 'Band resume %s' % ('on' if resumable else 'off')
+        bootloader = SimulatedBootloader(name, link=link, resumable=resumable,
+            disconnect_probability=args.disconnect_probability, seed=args.seed)
+        simulated.add_peripheral(bootloader.peripheral)
+        checkpoint = Checkpoint(os.path.join(directory, '%s.checkpoint' % name))
+
+        attempts = 0
+        started = time.time()
+        while not bootloader.activated.is_set():
+            attempts += 1
+            try:
+                peripheral = pybt.find_peripheral_by_name(name)
+                stats = hello.dfu.flash(peripheral, image, args.packet_notification_count,
+                    checkpoint=checkpoint, timeout=1.0, packet_size=args.packet_size)
+            except hello.dfu.DFUError as e:
+                log.info('%s: attempt %d failed: %s' % (name, attempts, e))
+                if not bootloader.connected:
+                    bootloader.reconnect()
+        seconds = time.time() - started
+
+        matches = bootloader.image_is_valid() and str(bootloader.image) == data
+        print "%-28s %8.3fs %10.0f bytes/sec  (%d attempts, %d disconnections, last resumed at %d)%s" % (
+            name, seconds, len(image) / seconds, attempts, bootloader.disconnections, stats.resumed_at,
+            '' if matches else '  MISMATCH')
+
+        bootloader.close()
+        simulated.remove_peripheral(bootloader.peripheral)
+
+    image.close()
+    shutil.rmtree(directory)
+
+def benchmark_fleet(args, link):
+    """Flashes a fleet of bootloaders at once, each over its own link,
+    where one fails every transfer halfway and another is never found,
+    and checks that only those two fail and every other device received
+    the image."""
+
+    directory = tempfile.mkdtemp()
+    data = os.urandom(args.image_size)
+    path = os.path.join(directory, 'image.bin')
+    with open(path, 'wb') as file:
+        file.write(data)
+    image = FirmwareImage(path)
+
+    bootloaders = []
+    for i in range(args.devices):
+        bootloader = SimulatedBootloader('Band fleet %d' % i, link=new_link(args),
+            fail_at=len(image) / 2 if i == 0 else None)
+        simulated.add_peripheral(bootloader.peripheral)
+        bootloaders.append(bootloader)
+    failing = bootloaders[0].peripheral.name()
+    missing = 'Band fleet missing'
+
+    fleet = Fleet(pybt.find_peripheral_by_name, image, jobs=args.devices, retries=1, find_timeout=1.0,
+        packet_notification_count=args.packet_notification_count, timeout=1.0, packet_size=args.packet_size)
+    started = time.time()
+    results = fleet.run([bootloader.peripheral.name() for bootloader in bootloaders] + [missing])
+    seconds = time.time() - started
+
+    for bootloader, result in zip(bootloaders, results):
+        if result.name == failing:
+            isolated = not result.succeeded and result.attempts == 2 and not bootloader.activated.is_set()
+        else:
+            isolated = result.succeeded and bootloader.activated.is_set() and str(bootloader.image) == data
+        print '    %s%s' % (result, '' if isolated else '  MISMATCH')
+    print '    %s%s' % (results[-1], '' if not results[-1].succeeded and results[-1].attempts == 2 else '  MISMATCH')
+
+    succeeded = sum(result.succeeded for result in results)
+    print "%-28s %8.3fs %10.0f bytes/sec  (%d of %d devices flashed)" % (
+        'fleet of %d' % len(results), seconds, succeeded * len(image) / seconds, succeeded, len(results))
+
+    for bootloader in bootloaders:
+        bootloader.close()
+        simulated.remove_peripheral(bootloader.peripheral)
+    image.close()
+    shutil.rmtree(directory)
+
+# the collector benchmark's Bands cycle through these
+COLLECTOR_MTUS = (23, 64, 185, 247)
+
+def benchmark_collector(args, link):
+    """Syncs Bands at different MTUs at once, alongside a peripheral
+    that is not a Band, into a spool that uploads to a simulated ingest
+    server, and checks that every Band's transfer was verified and
+    arrived intact, and nothing else did."""
+
+    bands = []
+    for i in range(args.devices):
+        mtu = COLLECTOR_MTUS[i % len(COLLECTOR_MTUS)]
+        device = SimulatedBand('Band collector %d (MTU %d)' % (i, mtu), link=new_link(args, mtu=mtu), seed=args.seed,
+            sensor_data_size=args.sync_size)
+        simulated.add_peripheral(device.peripheral)
+        bands.append(device)
+    other = simulated.SimulatedPeripheral('Battery collector', [
+        simulated.SimulatedService('180F', [simulated.SimulatedCharacteristic('2A19', read=lambda: bytearray([100]))])],
+        new_link(args))
+    simulated.add_peripheral(other)
+
+    directory = tempfile.mkdtemp()
+    server = SimulatedIngestServer(latency=args.latency)
+    spool = upload.Spool(directory)
+    uploader = upload.Uploader(server.url, spool)
+
+    names = [device.peripheral.name() for device in bands] + [other.name()]
+    peripherals = [pybt.find_peripheral_by_name(name) for name in names]
+    collector = Collector(spool, jobs=len(peripherals), probe_timeout=1.0, size=args.sync_size)
+    started = time.time()
+    results = collector.run(peripherals)
+    uploaded = uploader.close(30.0)
+    seconds = time.time() - started
+
+    records = dict((metadata['band'], data) for metadata, data in server.records)
+    for device, result in zip(bands, results):
+        intact = result.succeeded and records.get(result.name) == str(device.sensor_data)
+        print '    %s%s' % (result, '' if intact else '  MISMATCH')
+    print '    %s: %s%s' % (results[-1].name, 'not a Band' if results[-1].is_band is False else 'synced',
+        '' if results[-1].is_band is False and results[-1].name not in records else '  MISMATCH')
+
+    received = sum(result.bytes_received for result in results)
+    print "%-28s %8.3fs %10.0f bytes/sec  (%d of %d Bands uploaded%s)" % (
+        'collector of %d' % len(bands), seconds, received / seconds, len(records), len(bands),
+        '' if uploaded else ', upload timed out')
+    print '    %s' % uploader
+
+    server.close()
+    for device in bands:
+        simulated.remove_peripheral(device.peripheral)
+    simulated.remove_peripheral(other)
+    shutil.rmtree(directory)
+
+def benchmark_notifications(args, link):
+    """Counts how many of a burst of notifications make it across."""
+
+    device = SimulatedBand('Band notifications', link=link, seed=args.seed)
+    simulated.add_peripheral(device.peripheral)
+
+    peripheral = pybt.find_peripheral_by_name('Band notifications')
+    data = peripheral[hello.band.UUID.SERVICE.DEBUG][hello.band.UUID.CHARACTERISTIC.DATA]
+
+    received = [0]
+    lock = threading.Lock()
+    def notified(characteristic, packet):
+        with lock:
+            received[0] += len(packet)
+        return 0
+    subscription = data.subscribe(notified)
+
+    packet = bytearray(link.max_payload)
+    started = time.time()
+    for i in range(args.notifications):
+        device.data.notify(packet)
+    # let the last delivery land
+    time.sleep(link.latency + link.jitter + link.to_central.interval * args.notifications + 0.1)
+    subscription.unsubscribe()
+
+    report('%d notifications' % args.notifications, time.time() - started, received[0], link)
+
+def benchmark_overflow(args, link):
+    """Floods a subscription's queue from a peripheral thread while a
+    slower reader drains it, once per overflow policy, and checks that
+    what was read arrived in order, with every notification either read
+    or counted as dropped."""
+
+    for overflow in ringbuffer.POLICIES:
+        device = SimulatedBand('Band overflow %s' % overflow, link=link, seed=args.seed)
+        simulated.add_peripheral(device.peripheral)
+
+        peripheral = pybt.find_peripheral_by_name(device.peripheral.name())
+        data = peripheral[hello.band.UUID.SERVICE.DEBUG][hello.band.UUID.CHARACTERISTIC.DATA]
+        subscription = data.subscribe(capacity=args.queue_capacity, overflow=overflow)
+
+        def flood():
+            for sequence in range(args.notifications):
+                device.data.notify(struct.pack('<L', sequence).ljust(link.max_payload, '\0'))
+            device.data.notify('')  # the end
+        producer = threading.Thread(target=flood)
+
+        lost = link.lost
+        started = time.time()
+        producer.start()
+        sequences = []
+        ended = False
+        while not ended:
+            packets = subscription.read_many(args.queue_capacity, 1.0)
+            if not packets:
+                break  # the end was dropped
+            for packet in packets:
+                if packet:
+                    sequences.append(struct.unpack('<L', str(packet[:4]))[0])
+                else:
+                    ended = True
+            time.sleep(args.reader_delay * len(packets))
+        producer.join()
+        seconds = time.time() - started
+        subscription.unsubscribe()
+        simulated.remove_peripheral(device.peripheral)
+
+        stats = subscription.stats()
+        in_order = all(a < b for a, b in zip(sequences, sequences[1:]))
+        accounted = len(sequences) + ended + stats['dropped'] + link.lost - lost == args.notifications + 1
+        print "%-28s %8.3fs %10.0f notifications/sec  (%d read, %d dropped, high water %d of %d, %d blocked)%s" % (
+            'overflow %s' % overflow, seconds, stats['received'] / seconds if seconds else 0.0,
+            len(sequences), stats['dropped'], stats['high_water_mark'], stats['capacity'], stats['blocked'],
+            '' if in_order and accounted else '  MISMATCH')
+
+def benchmark_connect(args, link):
+    """Times connecting to a Band and writing to it, as a short-lived
+    script does, first with an empty GATT cache and then with the one
+    the first run saved."""
+
+    directory = tempfile.mkdtemp()
+    os.environ['PYBT_GATT_CACHE'] = os.path.join(directory, 'gatt_cache.json')
+
+    for run in ('cold', 'cached'):
+        gattcache.cache = None
+        simulated.discovery_plans.clear()
+        pybt.use_backend('simulated')
+
+        device = SimulatedBand('Band connect', link=link, seed=args.seed)
+        simulated.add_peripheral(device.peripheral)
+
+        started = time.time()
+        band = hello.band.Band(device.peripheral.name())
+        band.connect()
+        band.vibrate()
+        print "%-28s %8.3fs  (%d discovery round trips)" % (
+            'connect and write, %s' % run, time.time() - started, device.peripheral.discovery_round_trips)
+
+        pybt.stop_scan()
+        simulated.remove_peripheral(device.peripheral)
+
+    os.environ['PYBT_GATT_CACHE'] = ''
+    gattcache.cache = None
+    shutil.rmtree(directory)
+
+# connects to a Band and writes to it, as a short-lived script does; with
+# the simulated backend, it simulates the Band itself
+CLI_SCRIPT = '''
+import os, sys, time
+import hello.pybt as pybt
+import hello.band
+if os.environ['PYBT_BACKEND'] == 'simulated':
+    import hello.pybt.simulated as simulated
+    from hello.band.collector import Collector
+from hello.band.simulator import SimulatedBand, SimulatedIngestServer
+    mtu, latency, jitter = int(sys.argv[2]), float(sys.argv[3]), float(sys.argv[4])
+    simulated.add_peripheral(SimulatedBand(sys.argv[1], link=simulated.Link(mtu, latency, jitter)).peripheral)
+started = time.time()
+band = hello.band.Band(sys.argv[1])
+band.connect()
+band.vibrate()
+print time.time() - started
+'''
+
+def benchmark_daemon(args, link):
+    """Times a script that connects to a Band and writes to it, run on
+    its own and then attached to a daemon serving the Band."""
+
+    from hello.pybt.daemon import Daemon
+
+    device = SimulatedBand('Band daemon', link=link, seed=args.seed)
+    simulated.add_peripheral(device.peripheral)
+
+    directory = tempfile.mkdtemp()
+    daemon = Daemon(os.path.join(directory, 'pybtd.sock'))
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.daemon = True
+    thread.start()
+    while not os.path.exists(daemon.path):
+        time.sleep(0.01)
+
+    command = [sys.executable, '-c', CLI_SCRIPT, 'Band daemon', str(link.mtu), str(link.latency), str(link.jitter)]
+    devnull = open(os.devnull, 'w')
+    for backend in ('simulated', 'daemon'):
+        environment = dict(os.environ, PYBT_BACKEND=backend, PYBT_SOCKET=daemon.path, PYBT_GATT_CACHE='')
+        if backend == 'daemon':
+            # the daemon connects for the first script, and stays connected
+            subprocess.check_output(command, env=environment, stderr=devnull)
+        runs = []
+        for i in range(args.runs):
+            started = time.time()
+            output = subprocess.check_output(command, env=environment, stderr=devnull)
+            runs.append((time.time() - started, float(output)))
+        print "%-28s %8.3fs per run  (%.3fs connecting and writing)" % (
+            'script, %s' % ('on its own' if backend == 'simulated' else 'attached to pybtd'),
+            sum(run[0] for run in runs) / len(runs), sum(run[1] for run in runs) / len(runs))
+
+    devnull.close()
+    daemon.close()
+    simulated.remove_peripheral(device.peripheral)
+    shutil.rmtree(directory)
+
+def benchmark_metrics(args, link):
+    """Times write_no_confirm() with hello.pybt.metrics off and on, to
+    show what recording costs per operation."""
+
+    device = SimulatedBand('Band metrics', link=link, seed=args.seed)
+    simulated.add_peripheral(device.peripheral)
+
+    peripheral = pybt.find_peripheral_by_name('Band metrics')
+    control = peripheral[hello.band.UUID.SERVICE.DEBUG][hello.band.UUID.CHARACTERISTIC.CONFIG]
+    packet = bytearray(link.max_payload)
+    calls = 100000
+
+    for on in (False, True):
+        if on:
+            metrics.enable()
+        else:
+            metrics.disable()
+        started = time.time()
+        for i in xrange(calls):
+            control.write_no_confirm(packet)
+        seconds = time.time() - started
+        print "%-28s %8.3fs %10.2fus per write_no_confirm()" % (
+            'metrics %s' % ('on' if on else 'off'), seconds, seconds / calls * 1e6)
+
+    write = metrics.snapshot()['Band metrics']['attributes'][hello.band.UUID.CHARACTERISTIC.CONFIG]['latency']['write_no_confirm']
+    print "    write_no_confirm p50 %.2fus, p99 %.2fus, max %.2fus" % (write['p50'] * 1e6, write['p99'] * 1e6, write['max'] * 1e6)
+    metrics.disable()
+    metrics.reset()
+
+def benchmark_pacing(args, link):
+    """Bursts writes without response at a link with few transmit
+    buffers, with hello.pybt.pacing off and on: unpaced, the writes that
+    find the buffers full are lost; paced, they wait for room."""
+
+    for paced in (False, True):
+        link = simulated.Link(
+            mtu=args.mtu,
+            latency=args.latency,
+            jitter=args.jitter,
+            loss=args.loss,
+            seed=args.seed,
+            write_interval=args.write_interval or 0.0005,
+            tx_buffers=args.tx_buffers or 6)
+        received = [0]
+        def written(data, confirm):
+            received[0] += len(data)
+            return True
+        name = 'Pacing %s' % ('on' if paced else 'off')
+        characteristic = simulated.SimulatedCharacteristic('FFF1', written)
+        peripheral = simulated.SimulatedPeripheral(name, [simulated.SimulatedService('FFF0', [characteristic])], link)
+        simulated.add_peripheral(peripheral)
+
+        if paced:
+            pacing.enable()
+        else:
+            pacing.disable()
+        target = pybt.find_peripheral_by_name(name)['FFF0']['FFF1']
+        packet = bytearray(link.max_payload)
+        started = time.time()
+        for i in xrange(args.writes):
+            target.write_no_confirm(packet)
+        while link.in_flight:
+            time.sleep(0.001)
+        seconds = time.time() - started
+
+        print "%-28s %8.3fs %10.0f bytes/sec  (%d of %d bytes arrived, %d overruns)" % (
+            name, seconds, received[0] / seconds, received[0], args.writes * len(packet), link.overruns)
+        print '    %s' % pacing.queue(name)
+        simulated.remove_peripheral(peripheral)
+    pacing.enable()
+
+def new_link(args, mtu=None):
+    return simulated.Link(
+        mtu=mtu or args.mtu,
+        latency=args.latency,
+        jitter=args.jitter,
+        notification_interval=args.notification_interval,
+        loss=args.loss,
+        seed=args.seed,
+        write_interval=args.write_interval,
+        tx_buffers=args.tx_buffers)
+
+BENCHMARKS = {
+    'collector': benchmark_collector,
+    'connect': benchmark_connect,
+    'daemon': benchmark_daemon,
+    'fleet': benchmark_fleet,
+    'hrs': benchmark_hrs,
+    'imu': benchmark_imu,
+    'metrics': benchmark_metrics,
+    'dfu': benchmark_dfu,
+    'notifications': benchmark_notifications,
+    'overflow': benchmark_overflow,
+    'pacing': benchmark_pacing,
+    'resume': benchmark_resume,
+}
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description='Benchmark Band code against simulated peripherals.')
+    arg_parser.add_argument(
+        'benchmarks',
+        nargs='*',
+        help='which benchmarks to run, from %s. Defaults to all of them, except that packet loss skips the ones that cannot recover from it' % ', '.join(sorted(BENCHMARKS)))
+    arg_parser.add_argument(
+        '--mtu',
+        type=int,
+        default=23,
+        help='ATT MTU of the link. Defaults to 23, i.e. 20-byte payloads')
+    arg_parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help='one-way latency of the link, in seconds')
+    arg_parser.add_argument(
+        '--jitter',
+        type=float,
+        default=0.0,
+        help='up to this many seconds are added to each delivery, at random')
+    arg_parser.add_argument(
+        '--notification-interval',
+        type=float,
+        default=0.0,
+        help='minimum seconds between notifications, e.g. 0.0075 for one per 7.5ms connection interval')
+    arg_parser.add_argument(
+        '--loss',
+        type=float,
+        default=0.0,
+        help='probability that a notification or write without response is lost')
+    arg_parser.add_argument(
+        '--write-interval',
+        type=float,
+        default=0.0,
+        help='minimum seconds between writes without response crossing the link')
+    arg_parser.add_argument(
+        '--tx-buffers',
+        type=int,
+        default=None,
+        help='transmit buffers for writes without response; without pacing, writes that find them full are lost. Defaults to unlimited')
+    arg_parser.add_argument(
+        '--writes',
+        type=int,
+        default=2000,
+        help='size of the pacing benchmark\'s burst of writes. Defaults to 2000')
+    arg_parser.add_argument(
+        '--samples',
+        type=int,
+        default=10000,
+        help='HRS samples to read. Defaults to 10000')
+    arg_parser.add_argument(
+        '--image-size',
+        type=int,
+        default=64*1024,
+        help='size of the firmware image to flash, in bytes. Defaults to 64KB')
+    arg_parser.add_argument(
+        '--packet-size',
+        type=hello.dfu.packet_size_argument,
+        default=None,
+        help='bytes in each DFU packet, or "mtu" for as many as the link allows. Defaults to %d' % hello.dfu.PACKET_SIZE)
+    arg_parser.add_argument(
+        '-w', '--wait',
+        dest='packet_notification_count',
+        type=int,
+        default=10,
+        help='DFU packet receipt notification interval. Defaults to 10')
+    arg_parser.add_argument(
+        '--disconnect-probability',
+        type=float,
+        default=0.0005,
+        help='probability that the resume benchmark\'s bootloaders drop the link on each DFU packet. Defaults to 0.0005')
+    arg_parser.add_argument(
+        '--devices',
+        type=int,
+        default=4,
+        help='bootloaders for the fleet benchmark to flash, besides one it never finds, and Bands for the collector benchmark to sync. Defaults to 4')
+    arg_parser.add_argument(
+        '--sync-size',
+        type=int,
+        default=20000,
+        help='bytes of sensor data each of the collector benchmark\'s Bands sends. Defaults to 20000')
+    arg_parser.add_argument(
+        '--notifications',
+        type=int,
+        default=10000,
+        help='size of the notification burst. Defaults to 10000')
+    arg_parser.add_argument(
+        '--queue-capacity',
+        type=int,
+        default=256,
+        help='subscription queue capacity for the overflow benchmark. Defaults to 256')
+    arg_parser.add_argument(
+        '--reader-delay',
+        type=float,
+        default=0.00002,
+        help='seconds the overflow benchmark\'s reader spends on each notification. Defaults to 0.00002')
+    arg_parser.add_argument(
+        '--runs',
+        type=int,
+        default=5,
+        help='script runs to average for the daemon benchmark. Defaults to 5')
+    arg_parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='random seed, for repeatable runs')
+    args = arg_parser.parse_args(argv[1:])
+
+    log.basicConfig(level=log.WARNING)
+
+    names = args.benchmarks
+    if not names:
+        names = sorted(BENCHMARKS) if not args.loss else ['notifications']
+    for name in names:
+        if name not in BENCHMARKS:
+            arg_parser.error('unknown benchmark %s' % name)
+
+    for name in names:
+        BENCHMARKS[name](args, new_link(args))
+
+if __name__ == '__main__':
+    main(sys.argv)
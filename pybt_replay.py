@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+Run a script against a trace of an earlier run, recorded with
+PYBT_TRACE, instead of the Bluetooth hardware, and time it.  With
+--fast, Bluetooth takes no time at all, and what is left is the
+script's own: e.g.
+
+    PYBT_TRACE=hrs.trace ./bandsh Band <<< 'hrs 50 10000'
+    ./pybt_replay.py --fast --runs 10 hrs.trace bandsh Band <<< 'hrs 50 10000'
+"""
+
+import argparse
+import logging as log
+import runpy
+import StringIO
+import sys
+import time
+
+import hello.pybt as pybt
+import hello.pybt.replay as replay
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description='Run a script against a recorded trace, and time it.')
+    arg_parser.add_argument(
+        'trace',
+        help='the trace to replay, as PYBT_TRACE recorded it')
+    arg_parser.add_argument(
+        'script',
+        help='the script to run')
+    arg_parser.add_argument(
+        'args',
+        nargs=argparse.REMAINDER,
+        help="the script's arguments")
+    arg_parser.add_argument(
+        '--fast',
+        action='store_true',
+        help='replay as fast as possible, instead of at the recorded speed')
+    arg_parser.add_argument(
+        '-n', '--runs',
+        type=int,
+        default=1,
+        help='times to run the script, each against the whole trace. Defaults to 1')
+    args = arg_parser.parse_args(argv[1:])
+
+    log.basicConfig(level=log.WARNING)
+    # each run reads the same input
+    stdin = sys.stdin.read() if args.runs > 1 and not sys.stdin.isatty() else None
+
+    times = []
+    for run in range(args.runs):
+        pybt.use_backend('replay')
+        played = replay.load(args.trace, realtime=not args.fast)
+        sys.argv = [args.script] + args.args
+        if stdin is not None:
+            sys.stdin = StringIO.StringIO(stdin)
+
+        started = time.time()
+        try:
+            runpy.run_path(args.script, run_name='__main__')
+        except SystemExit as e:
+            if e.code:
+                print >>sys.stderr, '%s exited with %r' % (args.script, e.code)
+        times.append(time.time() - started)
+        print >>sys.stderr, 'run %d: %.3fs, %s' % (run + 1, times[-1], played)
+
+    if args.runs > 1:
+        times.sort()
+        print >>sys.stderr, '%d runs: min %.3fs, median %.3fs, max %.3fs' % (
+            args.runs, times[0], times[len(times) // 2], times[-1])
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
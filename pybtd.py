@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""
+Keep Bluetooth warm between scripts: pybtd scans, connects and discovers
+once, and the scripts run while it does attach to it through its socket
+instead of starting from nothing (see hello.pybt.client).
+"""
+
+import argparse
+import logging as log
+import os
+import sys
+
+import hello.pybt as pybt
+from hello.pybt.daemon import Daemon
+
+log.basicConfig(level=log.INFO)
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description='Serve Bluetooth LE to pybt scripts over a Unix domain socket.')
+    arg_parser.add_argument(
+        '-s', '--socket',
+        help='path of the socket. Defaults to $PYBT_SOCKET, or /tmp/pybtd-<uid>.sock')
+    arg_parser.add_argument(
+        '--simulate',
+        nargs='+',
+        metavar='band_name',
+        help='serve simulated Bands with these names instead of the radio, e.g. for trying scripts out')
+    args = arg_parser.parse_args(argv[1:])
+
+    if args.simulate:
+        import hello.pybt.simulated as simulated
+        from hello.band.simulator import SimulatedBand
+
+        pybt.use_backend('simulated')
+        for name in args.simulate:
+            simulated.add_peripheral(SimulatedBand(name).peripheral)
+    elif os.environ.get('PYBT_BACKEND', 'corebluetooth') == 'daemon':
+        print >> sys.stderr, "pybtd cannot serve the daemon backend"
+        return 1
+    else:
+        pybt.use_backend(os.environ.get('PYBT_BACKEND', 'corebluetooth'))
+
+    daemon = Daemon(args.socket)
+    pybt.start_scan()
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pybt.stop_scan()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
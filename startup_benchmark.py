@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+Time how long each script takes to start: to print its --help, and to
+import the hello packages, each in a fresh interpreter.  Also lists the
+heavy modules (numpy, PyObjC and the frameworks, PyBT.dylib's wrapper)
+that got loaded on the way, which none of these should need.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ENTRY_POINTS = ['bandsh', 'band_dfu.py', 'pill_dfu.py', 'band_sync.py']
+PACKAGES = ['hello.pybt', 'hello.band', 'hello.dfu']
+
+HEAVY_MODULES = ['numpy', 'objc', 'Foundation', 'Cocoa', 'IOBluetooth', 'hello.pybt.corebluetooth', 'httplib']
+
+# runs in the fresh interpreter: sys.argv[1] is what to time, a script or
+# a package, and it prints the seconds that took and the heavy modules
+# loaded
+PROBE = '''
+import json, runpy, StringIO, sys, time
+target = sys.argv[1]
+started = time.time()
+if target.startswith('hello'):
+    __import__(target)
+else:
+    sys.argv = [target, '--help']
+    stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+    try:
+        runpy.run_path(target, run_name='__main__')
+    except SystemExit:
+        pass
+    sys.stdout = stdout
+elapsed = time.time() - started
+print json.dumps([elapsed, [name for name in %r if name in sys.modules]])
+''' % (HEAVY_MODULES,)
+
+def probe(target):
+    """Returns the seconds the whole interpreter took, the seconds the
+    target took, and the heavy modules it loaded."""
+
+    started = time.time()
+    output = subprocess.check_output([sys.executable, '-c', PROBE, target], stderr=open(os.devnull, 'w'))
+    total = time.time() - started
+    elapsed, modules = json.loads(output.splitlines()[-1])
+    return total, elapsed, modules
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description='Time the start-up of the scripts and the hello packages.')
+    arg_parser.add_argument(
+        'targets',
+        nargs='*',
+        help='scripts or packages to time. Defaults to %s' % ', '.join(ENTRY_POINTS + PACKAGES))
+    arg_parser.add_argument(
+        '-n', '--runs',
+        type=int,
+        default=5,
+        help='runs to take the median of, after one to warm up. Defaults to 5')
+    args = arg_parser.parse_args(argv[1:])
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    for target in args.targets or ENTRY_POINTS + PACKAGES:
+        probe(target)
+        runs = [probe(target) for i in range(args.runs)]
+        label = 'import %s' % target if target.startswith('hello') else '%s --help' % target
+        print "%-24s %7.1fms  (%6.1fms after start-up)  loads: %s" % (
+            label,
+            median(run[0] for run in runs) * 1000,
+            median(run[1] for run in runs) * 1000,
+            ', '.join(runs[-1][2]) or 'nothing heavy')
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))